@@ -4,7 +4,7 @@
 Author: Martin Savko 
 Contact: savko@synchrotron-soleil.fr
 Date: 2020-02-11
-Version: 0.0.6
+Version: 0.0.7
 
 This script saves datasets stored in Eiger HDF5 format into series of CBF files.
 
@@ -12,8 +12,9 @@ It takes path to the master file as an argument (-m option) and generates .cbf
 files with correct header information. 
 
 It first extracts header information for individual images from the master file,
-creates cbf header as a text file, uses H5ToXds binary (www.dectris.com) to
-generate the cbf and and merges them together using cat GNU command.
+then reads the images directly from the HDF5 data files, compresses them using
+the CBF byte offset algorithm and writes the header and the binary section 
+into the cbf file in one go.
 
 '''
 
@@ -23,9 +24,16 @@ import os
 import shutil
 import traceback
 import multiprocessing
+import threading
+import Queue
 import sys
 import glob
 import logging
+import hashlib
+import base64
+import bz2
+import gzip
+import numpy as np
 
 log = logging.getLogger()
 stream_handler = logging.StreamHandler(sys.stdout)
@@ -68,8 +76,37 @@ _array_data.header_contents
 ;
 
 '''
+binary_section_template = '''_array_data.data
+;
+--CIF-BINARY-FORMAT-SECTION--
+Content-Type: application/octet-stream;
+     conversions="x-CBF_BYTE_OFFSET"
+Content-Transfer-Encoding: BINARY
+X-Binary-Size: {binary_size}
+X-Binary-ID: 1
+X-Binary-Element-Type: "signed 32-bit integer"
+X-Binary-Element-Byte-Order: LITTLE_ENDIAN
+Content-MD5: {md5}
+X-Binary-Number-of-Elements: {number_of_elements}
+X-Binary-Size-Fastest-Dimension: {fastest_dimension}
+X-Binary-Size-Second-Dimension: {second_dimension}
+X-Binary-Size-Padding: {padding}
+
+'''
+
+binary_section_end = '''
+--CIF-BINARY-FORMAT-SECTION----
+;
+
+'''
+
+binary_start_marker = b'\x0c\x1a\x04\xd5'
+binary_padding = 4095
+
 #making header line endings consistent with the H5ToXds output
 header_template = header_template.replace('\n', '\r\n') 
+binary_section_template = binary_section_template.replace('\n', '\r\n')
+binary_section_end = binary_section_end.replace('\n', '\r\n')
 
 # storing hdf5 paths into mnemonic variables
 sensor_thickness = "/entry/instrument/detector/sensor_thickness"
@@ -155,6 +192,97 @@ def get_image_numbers(master_file):
             log.exception(traceback.format_exc())
     return image_numbers
 
+def get_frame(master_file, n, data_files=None):
+    '''returns n-th image of the dataset, counting across all the data files
+    
+    data_files, as returned by get_data_files, spares resolving the links to all the data files on every call'''
+    if data_files is None:
+        data_files = get_data_files(master_file)
+    for file_start, file_end, dataset in data_files:
+        if file_start <= n < file_end:
+            return dataset[n - file_start]
+    raise IndexError('image index out of range of the dataset')
+
+def get_signed_values(image):
+    '''converts image to int64, marking pixels at the maximum of an unsigned type (masked or defective) by -1 as the PILATUS does
+    and clipping the rest to the signed 32-bit range of the cbf elements'''
+    values = image.astype(np.int64).ravel()
+    if image.dtype.kind == 'u':
+        values[values == np.iinfo(image.dtype).max] = -1
+    np.clip(values, -1, np.iinfo(np.int32).max, out=values)
+    return values
+
+def put_little_endian(compressed, positions, values, dtype):
+    value_bytes = values.astype(dtype).view(np.uint8).reshape((len(values), np.dtype(dtype).itemsize))
+    for k in range(value_bytes.shape[1]):
+        compressed[positions + k] = value_bytes[:, k]
+        
+def compress_byte_offset(image):
+    '''CBF byte offset compression: differences between consecutive pixels are stored on 1 byte 
+    if they fit, otherwise 0x80 is followed by a 2 byte difference or by 0x8000 and a 4 byte one 
+    or by 0x80000000 and a 8 byte one.'''
+    values = get_signed_values(image)
+    delta = np.empty_like(values)
+    delta[0] = values[0]
+    delta[1:] = values[1:] - values[:-1]
+    absolute = np.abs(delta)
+    
+    small = absolute < 2**7
+    medium = np.logical_and(~small, absolute < 2**15)
+    large = np.logical_and(~(small | medium), absolute < 2**31)
+    huge = ~(small | medium | large)
+    
+    sizes = np.ones(values.shape, dtype=np.int64)
+    sizes[medium] = 3
+    sizes[large] = 7
+    sizes[huge] = 15
+    offsets = np.cumsum(sizes) - sizes
+    
+    compressed = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    compressed[offsets[small]] = delta[small].astype(np.int8).view(np.uint8)
+    
+    escaped = ~small
+    compressed[offsets[escaped]] = 0x80
+    
+    positions = offsets[medium]
+    put_little_endian(compressed, positions + 1, delta[medium], '<i2')
+    
+    positions = offsets[large | huge]
+    compressed[positions + 2] = 0x80
+    positions = offsets[large]
+    put_little_endian(compressed, positions + 3, delta[large], '<i4')
+    
+    positions = offsets[huge]
+    compressed[positions + 6] = 0x80
+    put_little_endian(compressed, positions + 7, delta[huge], '<i8')
+    
+    return compressed.tobytes()
+
+def get_binary_section(image):
+    compressed = compress_byte_offset(image)
+    second_dimension, fastest_dimension = image.shape
+    binary_section = binary_section_template.format(binary_size=len(compressed),
+                                                    md5=base64.b64encode(hashlib.md5(compressed).digest()).decode('ascii'),
+                                                    number_of_elements=image.size,
+                                                    fastest_dimension=fastest_dimension,
+                                                    second_dimension=second_dimension,
+                                                    padding=binary_padding)
+    return b''.join([binary_section.encode('ascii'), 
+                     binary_start_marker, 
+                     compressed, 
+                     b'\x00' * binary_padding, 
+                     binary_section_end.encode('ascii')])
+
+def write_cbf(filename, cbf, compress=None):
+    if compress == 'bzip2':
+        f = bz2.BZ2File('%s.bz2' % filename, 'wb')
+    elif compress == 'gzip':
+        f = gzip.open('%s.gz' % filename, 'wb')
+    else:
+        f = open(filename, 'wb')
+    f.write(cbf)
+    f.close()
+    
 def get_oscillation_axis(master_file):
     if master_file['/entry/sample/goniometer/omega_range_total'][()] > 0:
         return 'OMEGA'
@@ -204,7 +332,83 @@ def get_n_cpu():
        n_cpu = multiprocessing.cpu_count()/2  
     return n_cpu
 
-def extract_cbfs(master_file, master_file_absolute_path, destination_directory, first=0, last=-1, n_cpu=0, compress=None):
+def get_data_files(master_file):
+    '''returns (first, end, dataset) of each of the data files, first and end being image indices across the whole dataset'''
+    data_items = master_file['/entry/data'].items()
+    data_items.sort(key=lambda x: x[0])
+    data_files = []
+    start = 0
+    for key, value in data_items:
+        if value is None:
+            continue
+        data_files.append((start, start + value.shape[0], value))
+        start += value.shape[0]
+    return data_files
+
+def get_data_file_ranges(master_file):
+    '''returns (first, end) image indices of each of the data files'''
+    return [(file_start, file_end) for file_start, file_end, dataset in get_data_files(master_file)]
+
+def get_runs(master_file, first, nimages, run_length=16):
+    '''splits images to extract into runs of consecutive images, each run read from a single data file'''
+    end = first + nimages
+    runs = []
+    for file_start, file_end in get_data_file_ranges(master_file):
+        low = max(first, file_start)
+        high = min(end, file_end)
+        for run_start in range(low, high, run_length):
+            runs.append(range(run_start, min(run_start + run_length, high)))
+    return runs
+
+worker_master_file = None
+worker_header_dictionary = None
+worker_data_files = None
+
+def initialize_worker(header_dictionary, master_file_absolute_path):
+    global worker_master_file, worker_header_dictionary, worker_data_files
+    worker_header_dictionary = header_dictionary
+    worker_master_file = h5py.File(master_file_absolute_path, 'r')
+    worker_data_files = get_data_files(worker_master_file)
+    
+def convert_run(run):
+    return [get_cbf(worker_header_dictionary, n, worker_master_file, data_files=worker_data_files) for n in run]
+
+def write_cbfs(queue, destination_directory, compress, nimages, start, errors):
+    '''writes the runs of cbfs taken from queue until it gets None, 
+    after a failure the error is appended to errors and the remaining runs are only taken off the queue'''
+    written = 0
+    while True:
+        cbfs = queue.get()
+        if cbfs is None:
+            break
+        if errors:
+            continue
+        try:
+            for filename, cbf in cbfs:
+                write_cbf(os.path.join(destination_directory, filename), cbf, compress)
+                written += 1
+                duration = time.time() - start
+                log.info('%s written (%d of %d), total processing time %5.1f s, which is %6.4f s per image' % (filename, written, nimages, duration, duration/written))
+        except Exception as e:
+            log.error('writing cbfs failed %s' % traceback.format_exc())
+            errors.append(e)
+    
+def put_to_writer(queue, item, writer, timeout=1.):
+    '''puts item on the queue of the writer thread, returns False if the writer is not running anymore'''
+    while writer.is_alive():
+        try:
+            queue.put(item, timeout=timeout)
+            return True
+        except Queue.Full:
+            pass
+    return False
+    
+
+def extract_cbfs(master_file, master_file_absolute_path, destination_directory, first=0, last=-1, n_cpu=0, compress=None, run_length=16, queue_size=None):
+    '''Converts images in a pool of long lived processes, each of them opening the master file only once.
+    
+    Images are handed out in runs of consecutive images from the same data file. Converted images 
+    are written by a separate thread fed through a bounded queue so that conversion and writing overlap.'''
     nimages = get_nimages(master_file, first, last)
     
     header_dictionary = get_header_information(master_file)
@@ -214,25 +418,40 @@ def extract_cbfs(master_file, master_file_absolute_path, destination_directory,
     if n_cpu <= 0:
        n_cpu = get_n_cpu()
     
-    wedges = get_wedges(first, nimages, n_cpu)
-    k = 0
-    for wedge in wedges:
-        wedge_start = time.time()
-        jobs = []
-        for num in wedge:
-            p = multiprocessing.Process(target=save_image, args=(header_dictionary, master_file_absolute_path, destination_directory, num, compress))
-            jobs.append(p)
-            p.start()
-        for job in jobs:
-            job.join()
-        k += 1
-        nsofar = k*len(wedge)
-        wedge_end = time.time()
-        log.info('wedge %3d (of %d), wedge processing time %6.4f s, time per image in this wedge %6.4f s; total processing time %5.1f s, which is %6.4f s per image' % (k, len(wedges), wedge_end - wedge_start, (wedge_end-wedge_start)/len(wedge), time.time()-start, (time.time()-start)/nsofar))
+    if queue_size is None:
+        queue_size = 2*n_cpu
+        
+    runs = get_runs(master_file, first, nimages, run_length)
+    log.info('%d images in %d runs of up to %d images, using %d processes' % (nimages, len(runs), run_length, n_cpu))
+    
+    queue = Queue.Queue(queue_size)
+    errors = []
+    writer = threading.Thread(target=write_cbfs, args=(queue, destination_directory, compress, nimages, start, errors))
+    writer.daemon = True
+    writer.start()
+    
+    pool = multiprocessing.Pool(n_cpu, initializer=initialize_worker, initargs=(header_dictionary, master_file_absolute_path))
+    try:
+        for cbfs in pool.imap(convert_run, runs):
+            if errors:
+                raise errors[0]
+            if not put_to_writer(queue, cbfs, writer):
+                raise RuntimeError('cbf writer thread stopped')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        put_to_writer(queue, None, writer)
+        pool.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+        
     end = time.time()
     log.info('total processing time %.1f s, which is %.3f s per image' % (end-start, (end-start)/nimages))
-        
-def save_image(header_dictionary, master_file_absolute_path, destination_directory, n, compress=None):
+
+def get_cbf(header_dictionary, n, master_file, data_files=None):
     filename_template = header_dictionary['filename_template']
     image_number = header_dictionary['image_numbers'][n] # n+1
     filename = os.path.basename(filename_template.replace('#####', str(image_number).zfill(5)))
@@ -242,7 +461,6 @@ def save_image(header_dictionary, master_file_absolute_path, destination_directo
     kappas = header_dictionary['kappas']
     chis = header_dictionary['chis']
     oscillation_axis_values = header_dictionary['oscillation_axis_values']
-    image_path = header_dictionary['image_path']
     try:
         if type(omegas) == float:
             header_dictionary['omega'] = omegas
@@ -264,35 +482,20 @@ def save_image(header_dictionary, master_file_absolute_path, destination_directo
         header_dictionary['chi'] = chis
         header_dictionary['start_angle'] = oscillation_axis_values
 
-    
     header = header_template.format(**header_dictionary)
-    header_filename = 'header_%s' % (str(image_number).zfill(5))
-    f = open(header_filename, 'w')
-    f.write(header)
-    f.close()
-    
-    raw_cbf_filename = '%s.cbf' % str(image_number).zfill(5)
-    H5ToXds_line = 'H5ToXds %s %s %s' % (master_file_absolute_path, image_number, raw_cbf_filename)
-    os.system(H5ToXds_line)
-    log.debug(H5ToXds_line)
-    os.system('cat %s | tail -n +14 >> %s' % (raw_cbf_filename, header_filename))
-    
-    shutil.move(header_filename, os.path.join(destination_directory, filename))
-    try:
-        os.remove(os.path.realpath(raw_cbf_filename))
-    except:
-        log.info('%s already discarded' % os.path.realpath(raw_cbf_filename))
-    try:
-        os.remove(raw_cbf_filename)
-    except:
-        log.info('%s already discarded' % raw_cbf_filename)
-        
-    if compress == 'bzip2':
-        os.system('bzip2 -f %s &' % os.path.join(destination_directory, filename))
-    elif compress == 'gzip':
-        os.system('gzip -f %s &' % os.path.join(stardestination_directory, filename))
+    image = get_frame(master_file, n, data_files=data_files)
+    cbf = header.encode('ascii') + get_binary_section(image)
+    return filename, cbf
+
+def save_image(header_dictionary, master_file_absolute_path, destination_directory, n, compress=None, master_file=None):
+    if master_file is None:
+        _master_file = h5py.File(master_file_absolute_path, 'r')
+        filename, cbf = get_cbf(header_dictionary, n, _master_file)
+        _master_file.close()
     else:
-        pass
+        filename, cbf = get_cbf(header_dictionary, n, master_file)
+    write_cbf(os.path.join(destination_directory, filename), cbf, compress)
+    log.debug('%s saved' % filename)
    
 def get_dataset_filenames(master_file_absolute_path):
     name_pattern = os.path.basename(master_file_absolute_path)[:-10]
@@ -307,7 +510,7 @@ if __name__ == '__main__':
     parser.add_option('-m', '--master_file', type=str, help='Path to the master_file')
     parser.add_option('-d', '--destination_directory', default=None, type=str, help='destination directory')
     parser.add_option('-t', '--treatment_directory', default='/dev/shm', type=str, help='treatment directory')
-    parser.add_option('-n', '--n_cpu', default=0, type=int, help='Number of parallel extraction, by defalult it will determine the number of cores of the machine and use all of them.')
+    parser.add_option('-n', '--n_cpu', default=0, type=int, help='Number of parallel extraction processes, by defalult it will determine the number of cores of the machine and use all of them.')
     parser.add_option('-f', '--first', default=0, type=int, help='First image to extract. Default is the first one.')
     parser.add_option('-l', '--last', default=-1, type=int, help='Last image to extract. Default is the last one.')
     parser.add_option('-b', '--bzip2', action='store_true', help='Compress cbf files using bzip2.')
@@ -342,10 +545,9 @@ if __name__ == '__main__':
     
     os.chdir(options.treatment_directory)
     
-    master_file = h5py.File(os.path.basename(options.master_file))
+    master_file = h5py.File(os.path.basename(options.master_file), 'r')
    
     nimages = get_nimages(master_file, options.first, options.last) 
-    wedges = get_wedges(options.first, nimages, options.n_cpu)
 
     if options.bzip2:
         compress = 'bzip2'
@@ -362,7 +564,7 @@ if __name__ == '__main__':
         sys.exit()
         
     print 'Starting h5 to cbf conversion. The conversion time per image should be below 0.1 second. If it is more, there may be something wrong with the system.'
-    print '%d images to extract. Using %d threads. Processing in %d wedges of %d images.\n' % (nimages, options.n_cpu, len(wedges), len(wedges[0]))
+    print '%d images to extract. Using %d processes.\n' % (nimages, options.n_cpu)
  
     extract_cbfs(master_file, master_file_absolute_path.replace(source_directory, options.treatment_directory), destination_directory, options.first, options.last, options.n_cpu, compress)
     
@@ -12,6 +12,7 @@ import time
 import itertools
 import os
 import pickle
+import json
 import numpy as np
 import pylab
 import glob
@@ -21,7 +22,7 @@ except ImportError:
     print 'Can not import pandas'
 
 try:
-    from analyze_undulator_scan import get_energy_from_theta, get_flux, undulator_peak_energy, undulator_magnetic_field, undulator_strength, angular_flux_density, angular_flux_density, undulator_magnetic_field_from_K, undulator_strength_from_peak_position
+    from analyze_undulator_scan import get_energy_from_theta, get_flux, undulator_magnetic_field, undulator_strength, angular_flux_density, angular_flux_density, undulator_magnetic_field_from_K, undulator_strength_from_peak_position
 except:
     print traceback.print_exc()
     
@@ -42,6 +43,9 @@ from mpl_toolkits.mplot3d import axes3d
 #rc('text', usetex=True)
 
 from motor import tango_motor
+from sequence_overlap import find_overlap, merge_overlapping
+import undulator_model
+from observation_store import monitor_results, observation_results, open_results, get_observations_filename
 
 class scan_analysis:
     
@@ -55,9 +59,17 @@ class scan_analysis:
         return pickle.load(open(self.parameters_filename))
     
     def get_results(self):
-        return pickle.load(open(self.parameters_filename.replace('_parameters', '_results')))
+        results_filename = self.parameters_filename.replace('_parameters', '_results')
+        results = open_results(get_observations_filename(self.parameters_filename))
+        if results is None:
+            return pickle.load(open(results_filename))
+        if os.path.isfile(results_filename):
+            results.update(pickle.load(open(results_filename)))
+        return results
     
     def save_results(self, results):
+        if isinstance(results, observation_results):
+            results = results.extra
         f= open(self.parameters_filename.replace('_parameters', '_results'), 'w')
         pickle.dump(results, f)
         f.close()
@@ -79,6 +91,10 @@ class scan_analysis:
         return position_chronos_predictor
     
     def get_observations(self, results, monitor_name):
+        if isinstance(results[monitor_name], monitor_results):
+            # chronos and points straight from the columns of the observation store
+            chronos, points = results[monitor_name].get_columns(results[monitor_name]['observation_fields'][:2])
+            return np.asarray(chronos), np.asarray(points)
         observations = results[monitor_name]['observations']
         #if len(observations[0][1]) == 1:
             #observations = np.array(observations)
@@ -110,25 +126,17 @@ class scan_analysis:
         return seq1[:start] + seq2,  nvalues_seq1
     
     def merge_two_overlapping_buffers(self, seq1, seq2, alignment_length=1000):
-        start = seq1.index(seq2[:alignment_length])
-        return seq1[:start] + seq2
+        merged, new_values = merge_overlapping(seq1, seq2)
+        return merged.tostring()
         
     def from_character_sequence_to_number_sequence(self, character_sequence, separator=';'):
         return map(float, character_sequence.split(';'))
         
     def merge_two_overlapping_number_sequences(self, r1, r2, alignment_length=1000, separator=';'):
-        c1 = self.from_number_sequence_to_character_sequence(r1)
-        c2 = self.from_number_sequence_to_character_sequence(r2)
-        c, start = self.merge_two_overlapping_character_sequences(c1, c2, alignment_length)
-        r = self.from_character_sequence_to_number_sequence(c)
-        return r, start
+        return merge_overlapping(r1, r2)
     
     def find_overlap(self, r1, r2, alignment_length=1000, separator=';'):
-        c1 = self.from_number_sequence_to_character_sequence(r1)
-        c2 = self.from_number_sequence_to_character_sequence(r2)
-        start = c1.index(c2[:alignment_length])
-        start = c2.count(separator) - c2[start:].count(separator)
-        return start
+        return find_overlap(r1, r2)
         
 class slit_scan_analysis(scan_analysis):
         
@@ -288,9 +296,13 @@ class undulator_scan_analysis(scan_analysis):
         return peaks
         
     def get_diode_chronos_and_current(self, results, monitor):
-        calibrated_diode = results[monitor]['observations']
-        if type(calibrated_diode[0][1]) == float:
+        if isinstance(results[monitor], monitor_results):
+            calibrated_diode = zip(*self.get_observations(results, monitor))
+        else:
+            calibrated_diode = results[monitor]['observations']
+        if np.ndim(calibrated_diode[0][1]) == 0:
             diode_chronos, diode_current = self.get_observations(results, monitor)
+            starts = np.arange(len(diode_current))
         else:
             diode_chronos = [calibrated_diode[0][0]]
             diode_current = calibrated_diode[0][1]
@@ -299,7 +311,8 @@ class undulator_scan_analysis(scan_analysis):
                 start = self.find_overlap(calibrated_diode[k][1], observation[1])
                 #print 'start', start
                 starts.append(starts[-1] + start)
-                diode_current = np.hstack((diode_current, observation[1][-start:]))
+                if start > 0:
+                    diode_current = np.hstack((diode_current, observation[1][-start:]))
                 diode_chronos.append(observation[0])
        
         diode_current = np.array(diode_current)
@@ -326,6 +339,28 @@ class undulator_scan_analysis(scan_analysis):
 
         return diode_chronos, diode_current
     
+    def get_matches(self, theoretic_harmonic_energies, peak_energies):
+        '''pairs (harmonic number - 1, peak index) of the peaks closest to each theoretic harmonic energy'''
+        thr = [(t, 0) for t in theoretic_harmonic_energies]
+        ep = [(e, 0) for e in peak_energies]
+      
+        dm = distance_matrix(thr, ep)
+        
+        matches = np.where(dm<self.maximum_peak_theoretic_error)
+        
+        matches_0 = []
+        matches_1 = []
+        for harmonic_number_minus_one in set(matches[0]):
+            indices = np.where(harmonic_number_minus_one == matches[0])
+            closest = dm[matches[0][indices], matches[1][indices]].argmin()
+            matches_0.append(matches[0][indices[0][closest]])
+            matches_1.append(matches[1][indices[0][closest]])
+              
+        return (np.array(matches_0, dtype=int), np.array(matches_1, dtype=int))
+    
+    def publish_peaks(self, gap, results_filename):
+        publish_peaks(os.path.dirname(self.parameters_filename), gap, self.peaks, results_filename)
+        
     def analyze(self):
         parameters = self.get_parameters()
         results = self.get_results()
@@ -371,32 +406,16 @@ class undulator_scan_analysis(scan_analysis):
         
         harmonics = np.arange(1, 21)
 
-        theoretic_harmonic_energies = undulator_peak_energy(gap, harmonics, detune=False)
+        theoretic_harmonic_energies = undulator_model.peak_energy(gap, harmonics)
         
         peaks = self.get_peaks(self.diode_scan_energies, medfilt(self.diode_scan_flux, 27))
         
         print 'peaks'
         print peaks
         
-        thr = [(t, 0) for t in theoretic_harmonic_energies]
-        ep = [(e, 0) for e in self.diode_scan_energies[peaks]]
         fluxes = self.diode_scan_flux[peaks]
-      
-        dm = distance_matrix(thr, ep)
         
-        minimums = dm.argmin(axis=0)
-        
-        matches = np.where(dm<self.maximum_peak_theoretic_error)
-        
-        matches_0 = []
-        matches_1 = []
-        for harmonic_number_minus_one in set(matches[0]):
-            indices = np.where(harmonic_number_minus_one == matches[0])
-            closest = dm[matches[0][indices], matches[1][indices]].argmin()
-            matches_0.append(matches[0][indices[0][closest]])
-            matches_1.append(matches[1][indices[0][closest]])
-              
-        matches = (np.array(matches_0), np.array(matches_1))
+        matches = self.get_matches(theoretic_harmonic_energies, self.diode_scan_energies[peaks])
 
         ep_matched = self.diode_scan_energies[peaks][matches[1]]
         thr_matched = theoretic_harmonic_energies[matches[0]]
@@ -488,11 +507,178 @@ class undulator_scan_analysis(scan_analysis):
         results['gap'] = gap
         
         self.save_results(results)
+        self.publish_peaks(gap, self.parameters_filename.replace('_parameters', '_results'))
         
     def conclude(self):
         pass
 
 
+class undulator_scan_online_analysis(undulator_scan_analysis):
+    
+    '''Analysis of an undulator scan while it runs. Observations are added by chunks as they arrive, the dark current and the harmonic peak candidates are kept up to date and the final peaks are published to the peaks index of the directory.'''
+    
+    def __init__(self, 
+                 parameters_filename, 
+                 gap,
+                 fast_shutter_chronos_uncertainty=0.1, 
+                 monitor='calibrated_diode',
+                 maximum_peak_theoretic_error=210,
+                 peak_half_width = 50.,
+                 display=False):
+        
+        undulator_scan_analysis.__init__(self,
+                                         parameters_filename,
+                                         fast_shutter_chronos_uncertainty=fast_shutter_chronos_uncertainty,
+                                         monitor=monitor,
+                                         maximum_peak_theoretic_error=maximum_peak_theoretic_error,
+                                         peak_half_width=peak_half_width,
+                                         display=display)
+        self.gap = gap
+        self.actuator_observations = []
+        self.open_time = None
+        self.close_time = None
+        self.shutter_open = False
+        self.diode_current = np.array([])
+        self.last_buffer = None
+        self.diode_anchors = []
+        self.dark_sum = 0.
+        self.dark_count = 0
+        self.peak_candidates = []
+        
+    def add_observations(self, monitor_name, observations):
+        '''observations are the rows [chronos, point] of monitor_name received since the previous call'''
+        for chronos, point in [observation[:2] for observation in observations]:
+            if monitor_name == 'actuator':
+                self.actuator_observations.append([chronos, point])
+            elif monitor_name == 'fast_shutter':
+                self.add_shutter_state(chronos, point)
+            elif monitor_name == self.monitor:
+                self.add_diode_buffer(chronos, point)
+    
+    def add_shutter_state(self, chronos, state):
+        if state and not self.shutter_open and self.open_time is None:
+            self.open_time = chronos
+        elif not state and self.shutter_open and self.close_time is None:
+            self.close_time = chronos
+        self.shutter_open = bool(state)
+        
+    def add_diode_buffer(self, chronos, buffer):
+        '''merges the samples of the history buffer which were not in the previous one'''
+        buffer = np.atleast_1d(np.asarray(buffer, dtype=np.float64))
+        if self.last_buffer is None or len(buffer) == 1:
+            new_samples = buffer
+        else:
+            new_samples = buffer[len(buffer) - find_overlap(self.last_buffer, buffer):]
+        self.last_buffer = buffer
+        self.diode_current = np.hstack([self.diode_current, new_samples])
+        self.diode_anchors.append((len(self.diode_current) - 1, chronos))
+        if self.is_dark(chronos):
+            self.dark_sum += new_samples.sum()
+            self.dark_count += len(new_samples)
+    
+    def is_dark(self, chronos):
+        if self.shutter_open:
+            return False
+        if self.open_time is None:
+            return True
+        return self.close_time is not None and chronos > self.close_time + self.fast_shutter_chronos_uncertainty
+    
+    def get_dark_current(self):
+        if self.dark_count == 0:
+            return 0.
+        return self.dark_sum / self.dark_count
+    
+    def update(self):
+        '''recomputes the harmonic peak candidates from the observations received so far'''
+        if self.open_time is None or len(self.diode_anchors) < 2 or len(self.actuator_observations) < 2:
+            return self.peak_candidates
+        
+        end_chronos = self.close_time if self.close_time is not None else self.diode_anchors[-1][1]
+        
+        actuator = np.array(self.actuator_observations)
+        actuator_scan_indices = self.get_scan_indices(actuator[:, 0], self.open_time, end_chronos, self.fast_shutter_chronos_uncertainty)
+        if actuator_scan_indices.sum() < 2:
+            return self.peak_candidates
+        position_chronos_predictor = self.get_position_chronos_predictor(actuator[actuator_scan_indices, 0], actuator[actuator_scan_indices, 1])
+        
+        anchors = np.array(self.diode_anchors)
+        chronos_based_on_index_predictor = np.poly1d(np.polyfit(anchors[:, 0], anchors[:, 1], 1))
+        diode_chronos = chronos_based_on_index_predictor(np.arange(0, len(self.diode_current)))
+        
+        diode_scan_indices = self.get_scan_indices(diode_chronos, self.open_time, end_chronos, self.fast_shutter_chronos_uncertainty)
+        if diode_scan_indices.sum() < 30:
+            return self.peak_candidates
+        
+        self.diode_scan_current = self.diode_current[diode_scan_indices] - self.get_dark_current()
+        self.diode_scan_positions = position_chronos_predictor(diode_chronos[diode_scan_indices])
+        self.diode_scan_energies = get_energy_from_theta(self.diode_scan_positions, units_energy=eV, units_theta=degree)
+        self.diode_scan_flux = get_flux(self.diode_scan_current, self.diode_scan_energies)
+        
+        if self.diode_scan_energies[0] > self.diode_scan_energies[-1]:
+            self.diode_scan_energies = self.diode_scan_energies[::-1]
+            self.diode_scan_flux = self.diode_scan_flux[::-1]
+        
+        peaks = self.get_peaks(self.diode_scan_energies, medfilt(self.diode_scan_flux, 27))
+        if len(peaks) == 0:
+            return self.peak_candidates
+        
+        harmonics = np.arange(1, 21)
+        theoretic_harmonic_energies = undulator_model.peak_energy(self.gap, harmonics)
+        matches = self.get_matches(theoretic_harmonic_energies, self.diode_scan_energies[peaks])
+        
+        self.peak_candidates = []
+        for harmonic_number_minus_one, peak in zip(*matches):
+            e = self.diode_scan_energies[peaks][peak]
+            indices = np.logical_and(self.diode_scan_energies > e - self.peak_half_width, 
+                                     self.diode_scan_energies < e + self.peak_half_width)
+            relevant_fluxes = self.diode_scan_flux[indices]
+            maximum = self.diode_scan_energies[indices][relevant_fluxes.argmax()]
+            self.peak_candidates.append([self.gap, int(harmonic_number_minus_one + 1), maximum, self.diode_scan_flux[peaks][peak]])
+        self.peak_candidates.sort()
+        return self.peak_candidates
+    
+    def get_results_filename(self):
+        return self.parameters_filename.replace('_parameters', '_online_results')
+    
+    def finish(self):
+        '''final update, saves the spectrum and the peaks and publishes the peaks to the index'''
+        self.peaks = self.update()
+        results = {'peaks': self.peaks, 
+                   'flux': getattr(self, 'diode_scan_flux', np.array([])), 
+                   'energy': getattr(self, 'diode_scan_energies', np.array([])), 
+                   'gap': self.gap,
+                   'dark_current': self.get_dark_current()}
+        f = open(self.get_results_filename(), 'w')
+        pickle.dump(results, f)
+        f.close()
+        self.publish_peaks(self.gap, self.get_results_filename())
+        return self.peaks
+    
+
+def get_peaks_index_filename(directory):
+    return os.path.join(directory, 'undulator_peaks_index.jsonl')
+
+def get_scan_name(results_filename):
+    '''name of the scan the results file belongs to, the same for its online and offline results'''
+    name = os.path.basename(results_filename)
+    for suffix in ['_online_results.pickle', '_results.pickle']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def publish_peaks(directory, gap, peaks, results_filename):
+    '''appends the harmonic peaks found at gap to the peaks index of directory, one json record per line, 
+    a later record of the same scan replaces the earlier ones'''
+    record = {'gap': float(gap), 
+              'peaks': [[float(value) for value in peak] for peak in peaks], 
+              'results': os.path.basename(results_filename), 
+              'scan': get_scan_name(results_filename), 
+              'timestamp': time.time()}
+    f = open(get_peaks_index_filename(directory), 'a')
+    f.write(json.dumps(record) + '\n')
+    f.close()
+    
+
 class undulator_peaks_analysis:
     
     def __init__(self, 
@@ -513,23 +699,73 @@ class undulator_peaks_analysis:
         self.energies_on_grid = None
         self.fluxes_on_grid = None
         self.gaps = None
-        
+        self.index_offset = 0
+        self.indexed_peaks = {}
+        self.indexed_results = {}
+        self.result_peaks = {}
+        self.scans = {}
+    
+    def read_index(self):
+        '''reads the records appended to the peaks index since the last call, returns their number'''
+        f = open(get_peaks_index_filename(self.directory))
+        f.seek(self.index_offset)
+        records = 0
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):
+                # nothing more or a record still being written
+                break
+            self.index_offset += len(line)
+            record = json.loads(line)
+            scan = record.get('scan', get_scan_name(record['results']))
+            self.indexed_peaks[scan] = record['peaks']
+            self.indexed_results[scan] = os.path.join(self.directory, record['results'])
+            self.scans.pop(self.indexed_results[scan], None)
+            records += 1
+        f.close()
+        return records
+    
+    def get_results(self):
+        '''results file of every scan of the directory, the indexed ones and the results pickled before the index existed, 
+        offline results take precedence over online ones unless the index says otherwise'''
+        results = {}
+        # online results first so that the offline results of the same scan replace them
+        for result in sorted(glob.glob(os.path.join(self.directory, '*_results.pickle')), key=lambda r: not r.endswith('_online_results.pickle')):
+            results[get_scan_name(result)] = result
+        if os.path.isfile(get_peaks_index_filename(self.directory)):
+            self.read_index()
+            results.update(self.indexed_results)
+        return results
+    
+    def get_result_peaks(self, result):
+        '''peaks of a results file that is not in the index, unpickled only once'''
+        if result not in self.result_peaks:
+            self.result_peaks[result] = pickle.load(open(result))['peaks']
+        return self.result_peaks[result]
+    
     def get_peaks(self):
         peaks = []
-        for result in glob.glob(os.path.join(self.directory, '*_results.pickle')):
-            peaks += pickle.load(open(result))['peaks']
+        for scan, result in sorted(self.get_results().items()):
+            if scan in self.indexed_peaks:
+                peaks += self.indexed_peaks[scan]
+            else:
+                peaks += list(self.get_result_peaks(result))
         peaks = np.array(peaks)
         peaks = peaks[peaks[:, 3] > self.minimum_intensity]
         return peaks
     
+    def get_scan(self, result):
+        '''energy and flux of the scan, each results file is unpickled only once'''
+        if result not in self.scans:
+            r = pickle.load(open(result))
+            self.scans[result] = (r['gap'], {'energy': r['energy'], 'flux': r['flux']})
+        return self.scans[result]
+    
     def get_scans(self):
         scans = {}
-        for result in glob.glob(os.path.join(self.directory, '*_results.pickle')):
-            r = pickle.load(open(result))
-            flux = r['flux']
-            energy = r['energy']
-            gap = r['gap']
-            scans[gap] = {'energy': energy, 'flux': flux}
+        for scan, result in sorted(self.get_results().items()):
+            gap, scan = self.get_scan(result)
+            scans[gap] = scan
         return scans
     
     def get_harmonics(self):
@@ -540,22 +776,21 @@ class undulator_peaks_analysis:
         return harmonics
     
     def residual(self, x, peaks):
-        k0, k1, k2 = x
-        model = []
-        for gap, harmonics in peaks[:, 0:2]:
-            model.append(undulator_peak_energy(gap, harmonics, k0=k0, k1=k1, k2=k2))
-        model = np.array(model)
-        experiment = peaks[:, 2]
-        diff = experiment - model
-        return np.sum(diff**2)/(2*len(model)) #np.dot(diff, diff)/(2*len(model))
-            
-    def fit(self, method='nelder-mead'):
+        '''cost of the fit, the same model as the leastsq fit of undulator_model'''
+        diff = undulator_model.residual(x, peaks[:, 0], peaks[:, 1], peaks[:, 2])
+        return np.sum(diff**2)/(2*len(diff))
+            
+    def fit(self, method='leastsq'):
+        '''leastsq uses the analytic jacobian of undulator_model, any other method goes through minimize'''
         if self.peaks is None:
             peaks = self.get_peaks()
         else:
             peaks = self.peaks
         x0 = self.k0, self.k1, self.k2
-        self.fit_result = minimize(self.residual, x0, args=(peaks,), method=method)
+        if method == 'leastsq':
+            self.fit_result = undulator_model.fit_peaks(peaks, x0)
+        else:
+            self.fit_result = minimize(self.residual, x0, args=(peaks,), method=method)
         return self.fit_result
     
     def generate_undulator_tables(self):
@@ -566,6 +801,8 @@ class undulator_peaks_analysis:
             self.fit()
             k0, k1, k2 = self.fit_result.x
         
+        undulator_model.undulator_table(k=(k0, k1, k2), peaks=self.peaks).save()
+        
         pylab.figure(figsize=(16, 9))
         
         for n in harmonics:
@@ -574,7 +811,7 @@ class undulator_peaks_analysis:
             energies = selection[:, 2]
             X = np.vstack([energies/1e3, gaps]).T
             np.savetxt('GAP_ENERGY_HARMONICS%d.txt' % n, X, fmt='%6.3f', delimiter=' ', header='%d\n%d\nENERGY  GAP' % X.shape[::-1], comments='')
-            modeled_energies = undulator_peak_energy(gaps, n, k0=k0, k1=k1, k2=k2)
+            modeled_energies = undulator_model.peak_energy(gaps, n, (k0, k1, k2))
             X_model = np.vstack([modeled_energies, gaps]).T
             np.savetxt('fit_GAP_ENERGY_HARMONIC%d.txt' % n, X_model, fmt='%6.3f', delimiter=' ', header='%d\n%d\nENERGY  GAP' % X_model.shape[::-1], comments='')
             
@@ -17,6 +17,8 @@ from scipy.spatial import distance_matrix
 from scipy.signal import medfilt
 import glob
 
+import undulator_model
+
 def transmission(params, e):
     t = 0
     for k, p in enumerate(params):
@@ -97,11 +99,7 @@ def get_lambda_harmonic(lambda_peak, n, N=80, detune=False):
 
 
 def undulator_peak_energy(gap, n, k0=2.72898056, k1=-3.83864548, k2=0.60969562, N=80, detune=False):
-    if detune:
-        detune_parameter = 1 - 2. / (n * N)
-    else:
-        detune_parameter = 1
-    return undulator_harmonic_energy(gap, n, k0=k0, k1=k1, k2=k2) * detune_parameter
+    return undulator_model.peak_energy(gap, n, (k0, k1, k2), N=N, detune=detune)
 
 
 def undulator_magnetic_field(gap, k0=2.72898056, k1=-3.83864548, k2=0.60969562, period_length=24.):
@@ -126,10 +124,7 @@ def undulator_strength_from_peak_position(peak_energy, n, electron_energy=2.75,
 
     
 def undulator_harmonic_energy(gap, n, k0=2.72898056, k1=-3.83864548, k2=0.60969562, period_length=24.0, electron_energy=2.75):
-    k = 1e-3 * elementary_charge / (electron_mass * speed_of_light * 2 * pi)
-    B = undulator_magnetic_field(
-        gap, k0=k0, k1=k1, k2=k2, period_length=period_length)
-    return 1000 * 9.5 * n * electron_energy ** 2 / (period_length * (1 + undulator_strength(B) ** 2 / 2))
+    return undulator_model.peak_energy(gap, n, (k0, k1, k2), period_length=period_length, electron_energy=electron_energy)
 
 
 def undulator_peak_intensity(gap, n, k0=2.72898056, k1=-3.83864548, k2=0.60969562, period_length=24., N=80):
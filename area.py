@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import itertools
 import numpy as np
-import copy
 
 def shift(vertical_shift, horizontal_shift):
     s = np.array([[1., 0.,    vertical_shift], 
@@ -15,6 +13,47 @@ def scale(vertical_scale, horizontal_scale):
     s = np.diag([vertical_scale, horizontal_scale, 1.])
     return s
 
+class point_view(object):
+    '''read only dictionary view {index: point} of an (N, 2) array of points, point of index k being in row k-1'''
+    
+    def __init__(self, points):
+        self.points = points
+        
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        return self.points[index - 1]
+    
+    def __len__(self):
+        return len(self.points)
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __contains__(self, index):
+        return 1 <= index <= len(self.points)
+    
+    def __array__(self, dtype=None):
+        return np.asarray(self.points, dtype=dtype)
+    
+    def __reduce__(self):
+        # pickled as a plain dictionary as before
+        return (dict, (self.items(),))
+    
+    def keys(self):
+        return list(range(1, len(self.points) + 1))
+    
+    def values(self):
+        return list(self.points)
+    
+    def items(self):
+        return list(zip(self.keys(), self.points))
+    
+    def get(self, index, default=None):
+        if index in self:
+            return self[index]
+        return default
+
 class area:
     def __init__(self, range_y=1, range_x=1, rows=3, columns=1, center_y=0, center_x=0):
         self.range_y = range_y
@@ -35,60 +74,64 @@ class area:
         self.center = start + self.extent/2.
         self.shape = (self.rows, self.columns)
         
-    def get_grid_and_points(self):
-        vertical = np.linspace(0, 1, self.rows)
-        horizontal = np.linspace(0, 1, self.columns)
-
-        positions = itertools.product(vertical, horizontal)
-        points = np.array([np.array(position) for position in positions])
-        points = np.hstack([points, np.ones((points.shape[0], 1))])
-        
-        points = np.dot(shift(-0.5, -0.5), points.T).T
-        points = np.dot(scale(*self.extent), points.T).T
-        points = np.dot(shift(*self.center), points.T).T
-
-        points[:, 2] += np.arange(points.shape[0])
+    def get_grid_and_point_array(self):
+        '''returns grid of point indices (starting at 1) of shape (rows, columns) and (rows*columns, 2) array of (vertical, horizontal) positions, the point of index k being in row k-1'''
+        vertical = (np.linspace(0, 1, self.rows) - 0.5) * self.extent[0] + self.center[0]
+        horizontal = (np.linspace(0, 1, self.columns) - 0.5) * self.extent[1] + self.center[1]
         
-        indexes = map(int, points[:, 2])
-        points = dict(zip(indexes, points[:, :2]))
+        points = np.empty((self.rows * self.columns, 2))
+        points[:, 0] = np.repeat(vertical, self.columns)
+        points[:, 1] = np.tile(horizontal, self.rows)
         
-        grid = np.reshape(indexes, (self.rows, self.columns))
+        grid = np.arange(1, self.rows * self.columns + 1).reshape((self.rows, self.columns))
         
         return grid, points
     
+    def get_grid_and_points(self):
+        grid, points = self.get_grid_and_point_array()
+        return grid, point_view(points)
+    
+    def get_ordering(self, grid, scan_axis='horizontal', inverse_direction=False, against_gravity=False):
+        '''(lines, points per line) array of point indices in the order of collection, one row per line scanned, 
+        inverse_direction giving the serpentine raster and against_gravity vertical lines scanned upwards'''
+        if scan_axis == 'vertical':
+            if inverse_direction:
+                grid = self.get_vertical_raster(grid)
+            lines = grid.T
+            if against_gravity:
+                lines = lines[:, ::-1]
+        else:
+            if inverse_direction:
+                grid = self.get_horizontal_raster(grid)
+            lines = grid
+        return lines
+    
     def get_position_sequence(self, grid):
         return grid.ravel()
     
     def get_jump_sequence(self, grid, against_gravity=False):
+        '''(lines, 2) array of the indices of the start and end points of every line of grid'''
         if against_gravity:
-            jump_sequence = zip(grid[:, -1], grid[:, 0])
+            jump_sequence = np.column_stack([grid[:, -1], grid[:, 0]])
         else:
-            jump_sequence = zip(grid[:, 0], grid[:, -1])
+            jump_sequence = np.column_stack([grid[:, 0], grid[:, -1]])
         return jump_sequence
         
     def get_horizontal_raster(self, grid, start=1):
-        g = copy.deepcopy(grid)
-        if np.__version__ >= '1.8.3':
-            g[start::2, ::] = g[start::2, ::-1]
-        else:
-            raster = []
-            for k, line in enumerate(g):
-                if k % 2 == 1:
-                    line = line[::-1]
-                raster.append(line)
-            g = np.array(raster)
+        g = grid.copy()
+        g[start::2, ::] = g[start::2, ::-1]
         return g
         
     def get_vertical_raster(self, grid, start=1):
-        g = copy.deepcopy(grid)
-        if np.__version__ >= '1.8.3':
-            g[::, start::2] = g[::-1, start::2]
-        else:
-            g = self.get_horizontal_raster(g.T).T
+        g = grid.copy()
+        g[::, start::2] = g[::-1, start::2]
         return g
    
     def get_linearized_point_jumps(self, jumps, points):
-        return [(points[jump[0]], points[jump[1]]) for jump in jumps]
+        '''(len(jumps), 2, 2) array of start and end positions of the jumps'''
+        if isinstance(points, dict):
+            return [(points[jump[0]], points[jump[1]]) for jump in jumps]
+        return np.asarray(points)[np.asarray(jumps, dtype=int) - 1]
     
 def test():
     import optparse
@@ -2,12 +2,122 @@
 # -*- coding: utf-8 -*-
 
 from PyTango import DeviceProxy as dp
+import os
+import json
+import hashlib
+import logging
+import traceback
+from itertools import product
 import numpy as np
 #from monitor import xbpm
-from mucal import mucal
+from mucal import mucal_array, name_z, edges_table
 from energy import energy
 import gevent
 
+class transmission_table:
+    '''
+    Transmission of every combination of filters of the attenuator chain on a grid of photon energies.
+    
+    The natural logarithms of the transmissions are computed once with mucal_array and cached on disk
+    under a name derived from the filter definitions and the energy grid, so the table is recomputed
+    only when the filters change. The grid includes both sides of all absorption edges of the filter
+    elements, so linear interpolation of the logarithm is accurate up to the edges.
+    '''
+    
+    def __init__(self, definitions, energies=None, cache_directory='/tmp'):
+        '''definitions is a list of (positioner name, filters) pairs, filters being a dictionary of {filter name: {'element': ..., 'thickness': ... (cm)}}'''
+        self.definitions = definitions
+        self.filter_names = [sorted(filters.keys()) for name, filters in definitions]
+        self.configurations = list(product(*self.filter_names))
+        self.index = dict([(configuration, k) for k, configuration in enumerate(self.configurations)])
+        if energies is None:
+            energies = self.get_default_energies()
+        self.energies = np.array(energies, dtype=np.float64)
+        self.cache_file = os.path.join(cache_directory, 'attenuators_transmission_%s.npy' % self.get_key())
+        self.log_transmissions = self.load()
+    
+    def get_elements(self):
+        return set([f['element'] for name, filters in self.definitions for f in filters.values() if f['element'] != None])
+        
+    def get_default_energies(self, start=4000., end=20000., step=10.):
+        energies = [np.arange(start, end + step/2., step)]
+        for element in self.get_elements():
+            edges = edges_table[name_z(element)] * 1.e3
+            edges = edges[(edges > start) & (edges < end)]
+            energies += [edges - 1.e-3, edges]
+        return np.unique(np.hstack(energies))
+        
+    def get_key(self):
+        definitions = json.dumps([[name, filters] for name, filters in self.definitions], sort_keys=True)
+        return hashlib.md5(definitions.encode('utf-8') + self.energies.tobytes()).hexdigest()
+    
+    def get_filter_log_transmission(self, f, energies):
+        if f['element'] == None or f['thickness'] == 0.:
+            return np.zeros(len(energies))
+        return -mucal_array(f['element'], energies * 1.e-3)['mu'] * f['thickness']
+        
+    def compute(self):
+        log_transmissions = np.zeros((1, len(self.energies)))
+        for (name, filters), filter_names in zip(self.definitions, self.filter_names):
+            rows = np.array([self.get_filter_log_transmission(filters[filter_name], self.energies) for filter_name in filter_names])
+            log_transmissions = (log_transmissions[:, np.newaxis, :] + rows[np.newaxis, :, :]).reshape((-1, len(self.energies)))
+        return log_transmissions.astype(np.float32)
+    
+    def load(self):
+        try:
+            log_transmissions = np.load(self.cache_file)
+            if log_transmissions.shape == (len(self.configurations), len(self.energies)):
+                return log_transmissions
+        except (IOError, OSError, ValueError):
+            pass
+        log_transmissions = self.compute()
+        try:
+            np.save(self.cache_file, log_transmissions)
+        except (IOError, OSError):
+            logging.info('could not save transmission table %s %s' % (self.cache_file, traceback.format_exc()))
+        return log_transmissions
+    
+    def in_range(self, photon_energy):
+        return self.energies[0] <= photon_energy <= self.energies[-1]
+        
+    def get_transmission(self, configuration, photon_energy):
+        '''configuration is a tuple of filter names, one per positioner, photon_energy in eV'''
+        if not self.in_range(photon_energy):
+            filters = [dict(self.definitions[k][1])[filter_name] for k, filter_name in enumerate(configuration)]
+            return np.exp(sum([self.get_filter_log_transmission(f, np.array([photon_energy]))[0] for f in filters]))
+        return np.exp(np.interp(photon_energy, self.energies, self.log_transmissions[self.index[tuple(configuration)]]))
+    
+    def get_log_transmissions(self, photon_energy):
+        '''logarithms of transmissions of all configurations at photon_energy'''
+        if not self.in_range(photon_energy):
+            energies = np.array([photon_energy])
+            log_transmissions = np.zeros(1)
+            for (name, filters), filter_names in zip(self.definitions, self.filter_names):
+                rows = np.array([self.get_filter_log_transmission(filters[filter_name], energies)[0] for filter_name in filter_names])
+                log_transmissions = (log_transmissions[:, np.newaxis] + rows[np.newaxis, :]).ravel()
+            return log_transmissions
+        k = min(max(np.searchsorted(self.energies, photon_energy), 1), len(self.energies) - 1)
+        e0, e1 = self.energies[k-1], self.energies[k]
+        w = (photon_energy - e0) / (e1 - e0)
+        return (1 - w) * self.log_transmissions[:, k-1] + w * self.log_transmissions[:, k]
+    
+    def get_configuration(self, transmission, photon_energy, candidates=None, current=None, move_time=None, tolerance=0.05):
+        '''
+        returns the configuration giving transmission at photon_energy. Among the candidate configurations
+        (indices into self.configurations, all by default) within the relative tolerance of the requested
+        transmission the one fastest to reach from current according to move_time(current, configuration)
+        is chosen. If none is within tolerance, the closest one is returned.
+        '''
+        if candidates is None:
+            candidates = np.arange(len(self.configurations))
+        candidates = np.asarray(candidates)
+        error = np.abs(self.get_log_transmissions(photon_energy)[candidates] - np.log(transmission))
+        acceptable = np.flatnonzero(error <= np.log(1 + tolerance))
+        if len(acceptable) == 0 or current is None or move_time is None:
+            return self.configurations[candidates[np.argmin(error)]]
+        ranking = [(move_time(current, self.configurations[candidates[k]]), error[k], candidates[k]) for k in acceptable]
+        return self.configurations[min(ranking)[2]]
+
 class attenuators:
 
     def __init__(self):
@@ -86,15 +196,28 @@ class attenuators:
                             4: self.xbpm3,
                             5: self.imager1,
                             6: self.carousel}
-                                      
-
+        
+        # estimates used to rank configurations by the time needed to reach them
+        self.carousel_speed = 1000. # position units per second
+        self.actuator_time = 2. # seconds to insert or extract a diode or the imager
+        
+        self.table = None
+        
+    def get_filter_definitions(self):
+        return [(self.positioners[p].display_name, self.positioners[p].filters) for p in sorted(self.positioners)]
+        
+    def get_table(self):
+        if self.table is None:
+            self.table = transmission_table(self.get_filter_definitions())
+        return self.table
+        
     def get_transmission_from_element_and_thickness(self, element, thickness, photon_energy=None):
         # photon_energy should be given in eV
         if photon_energy == None:
            phot_e = self.energy.get_energy() * 1.e-3
         else:
            phot_e = photon_energy * 1.e-3
-        mu = mucal(element, phot_e)[1][5]
+        mu = mucal_array(element, phot_e)['mu'][0]
         return np.exp(-mu*thickness)
 
     def get_filter(self):
@@ -111,18 +234,50 @@ class attenuators:
         element, thickness = element_and_thickness['element'], element_and_thickness['thickness']
         return element, thickness
 
-    def get_transmission(self):
-        transmission = 1.
-        for p in self.positioners:
-            #print 'positioner', p, self.positioners[p].display_name,
-            element, thickness = self.get_element_and_thickness(self.positioners[p])
-            if element != None and thickness != 0.:
-               p_t = self.get_transmission_from_element_and_thickness(element, thickness)
+    def get_configuration(self):
+        return tuple([self.positioners[p].selectedAttributeName for p in sorted(self.positioners)])
+        
+    def get_transmission(self, photon_energy=None, configuration=None):
+        # photon_energy should be given in eV
+        if photon_energy == None:
+            photon_energy = self.energy.get_energy()
+        if configuration == None:
+            configuration = self.get_configuration()
+        return self.get_table().get_transmission(configuration, photon_energy)
+    
+    def get_move_time(self, current, configuration):
+        move_time = 0.
+        for p, current_name, name in zip(sorted(self.positioners), current, configuration):
+            if current_name == name:
+                continue
+            positioner = self.positioners[p]
+            if positioner is self.carousel:
+                start = positioner.filters[current_name]['position']
+                end = positioner.filters[name]['position']
+                if start is None or end is None:
+                    # unknown position, assume the longest move
+                    move_time += max([f['position'] for f in positioner.filters.values() if f['position'] != None]) / self.carousel_speed
+                else:
+                    move_time += abs(end - start) / self.carousel_speed
             else:
-               p_t = 1.
-            transmission *= p_t
-            #print 'absorbed', 1-p_t
-        return transmission
+                move_time += self.actuator_time
+        return move_time
+        
+    def get_reachable_configurations(self):
+        table = self.get_table()
+        reachable = product(*[set(self.positioners[p].positions.values()) for p in sorted(self.positioners)])
+        return np.array(sorted([table.index[configuration] for configuration in reachable]))
+    
+    def get_configuration_for_transmission(self, transmission, photon_energy=None, tolerance=0.05):
+        '''fastest to reach configuration of the filters giving transmission (fraction) at photon_energy (eV)'''
+        if photon_energy == None:
+            photon_energy = self.energy.get_energy()
+        return self.get_table().get_configuration(transmission, 
+                                                  photon_energy, 
+                                                  candidates=self.get_reachable_configurations(), 
+                                                  current=self.get_configuration(), 
+                                                  move_time=self.get_move_time, 
+                                                  tolerance=tolerance)
 
 def plot_levels():
     import pylab
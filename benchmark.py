@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of the experiment lifecycle against the mock devices.
+
+Each experiment class is executed as usual through execute(). The wall time
+of every phase (prepare, run, clean, analyze, ...), the number of round trips
+to every device, the number of bytes written and the dead time between the
+sweeps of the goniometer are recorded in a json results file. The results
+can be compared against a stored baseline, regressions are reported and
+make the script exit with a non zero status.
+
+Devices are wrapped in counting proxies, every method call, attribute read
+or attribute write counting as one round trip. The dead time between sweeps
+is taken from the task history of the simulated MD2 (md2_mockup).
+'''
+
+import os
+import sys
+import time
+import json
+import logging
+import traceback
+import importlib
+import numpy as np
+
+from md2_mockup import md2_mockup
+
+phases = ['prepare', 'run', 'clean', 'analyze', 'save_results', 'conclude', 'collect_parameters', 'save_parameters', 'save_log']
+
+devices = ['goniometer.md2', 'detector', 'energy_motor', 'resolution_motor', 'transmission_motor', 'machine_status', 'undulator', 'fast_shutter', 'safety_shutter', 'camera', 'flux_monitor', 'beam_center', 'actuator', 'attenuators']
+
+sweep_tasks = ['Scan', 'Helical scan', 'Raster scan']
+
+default_position = {'AlignmentX': 0., 'AlignmentY': 0., 'AlignmentZ': 0., 'CentringX': 0., 'CentringY': 0.}
+
+benchmarks = {'omega_scan': {'scan_range': 10., 'scan_exposure_time': 1., 'angle_per_frame': 0.1, 'simulation': True},
+              'helical_scan': {'scan_range': 10., 'scan_exposure_time': 1., 'angle_per_frame': 0.1, 'position_start': default_position, 'position_end': dict([(motor, 0.05) for motor in default_position]), 'simulation': True},
+              'raster_scan': {'vertical_range': 0.1, 'horizontal_range': 0.1, 'number_of_rows': 10, 'number_of_columns': 10, 'frame_time': 0.005, 'snapshot': False, 'analysis': False, 'conclusion': False, 'simulation': True},
+              'reference_images': {'scan_range': 1., 'scan_exposure_time': 0.1, 'scan_start_angles': '[0, 90, 180, 270]', 'angle_per_frame': 0.1, 'analysis': False, 'simulation': True},
+              'energy_scan': {'element': 'Se', 'edge': 'K', 'scan_range': 20., 'total_time': 5., 'display': False, 'diagnostic': False, 'analysis': False, 'simulation': True}}
+
+class counting_proxy(object):
+    '''forwards everything to device, counting calls, attribute reads and attribute writes'''
+
+    def __init__(self, device, counts):
+        object.__setattr__(self, 'device', device)
+        object.__setattr__(self, 'counts', counts)
+
+    def __getattr__(self, name):
+        device = object.__getattribute__(self, 'device')
+        counts = object.__getattribute__(self, 'counts')
+        value = getattr(device, name)
+        if not callable(value):
+            counts['reads'] += 1
+            return value
+        def counted(*args, **kwargs):
+            counts['calls'] += 1
+            return value(*args, **kwargs)
+        return counted
+
+    def __setattr__(self, name, value):
+        object.__getattribute__(self, 'counts')['writes'] += 1
+        setattr(object.__getattribute__(self, 'device'), name, value)
+
+def unwrap(device):
+    if isinstance(device, counting_proxy):
+        return object.__getattribute__(device, 'device')
+    return device
+
+def get_owner(experiment, path):
+    '''returns the object holding the last attribute of the dotted path and the name of that attribute'''
+    names = path.split('.')
+    owner = experiment
+    for name in names[:-1]:
+        owner = getattr(owner, name, None)
+        if owner is None:
+            return None, None
+    if not hasattr(owner, names[-1]):
+        return None, None
+    return owner, names[-1]
+
+def instrument_devices(experiment, time_scale=1.):
+    round_trips = {}
+    for path in devices:
+        owner, name = get_owner(experiment, path)
+        if owner is None:
+            continue
+        device = getattr(owner, name)
+        if device is None or isinstance(device, counting_proxy):
+            continue
+        if hasattr(device, 'time_scale'):
+            device.time_scale = time_scale
+        round_trips[path] = {'calls': 0, 'reads': 0, 'writes': 0}
+        setattr(owner, name, counting_proxy(device, round_trips[path]))
+    return round_trips
+
+def get_timed(phase, method, timings):
+    def timed(*args, **kwargs):
+        _start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timing = timings.setdefault(phase, {'duration': 0., 'count': 0})
+            timing['duration'] += time.time() - _start
+            timing['count'] += 1
+    return timed
+
+def instrument_phases(experiment):
+    timings = {}
+    for phase in phases:
+        method = getattr(experiment, phase, None)
+        if method is not None:
+            setattr(experiment, phase, get_timed(phase, method, timings))
+    return timings
+
+def get_bytes_written(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def get_sweeps(experiment, start_time):
+    '''sweeps and dead times between them from the task history of the simulated MD2'''
+    goniometer = getattr(experiment, 'goniometer', None)
+    md2 = unwrap(getattr(goniometer, 'md2', None))
+    if not isinstance(md2, md2_mockup):
+        return {}
+    tasks = [task for task in md2.tasks.values() if task['name'] in sweep_tasks and task['start'] >= start_time]
+    tasks.sort(key=lambda task: task['start'])
+    if not tasks:
+        return {'sweeps': 0}
+    starts = np.array([task['start'] for task in tasks])
+    ends = np.array([task['end'] for task in tasks])
+    dead_times = starts[1:] - ends[:-1]
+    sweeps = {'sweeps': len(tasks),
+              'time_to_first_sweep': starts[0] - start_time,
+              'sweep_time': float(np.sum(ends - starts)),
+              'dead_time_total': float(np.sum(dead_times))}
+    if len(dead_times):
+        sweeps['dead_time_mean'] = float(np.mean(dead_times))
+        sweeps['dead_time_max'] = float(np.max(dead_times))
+    return sweeps
+
+def run_benchmark(name, directory, parameters=None, time_scale=1., run=0):
+    if parameters is None:
+        parameters = benchmarks[name]
+    run_directory = os.path.join(directory, '%s_%s_%d' % (name, time.strftime('%Y%m%d_%H%M%S'), run))
+    if not os.path.isdir(run_directory):
+        os.makedirs(run_directory)
+    result = {'experiment': name, 'directory': run_directory, 'parameters': dict([(key, str(value)) for key, value in parameters.items()])}
+    try:
+        experiment_class = getattr(importlib.import_module(name), name)
+        _start = time.time()
+        experiment = experiment_class(name_pattern='%s_benchmark' % name, directory=run_directory, **parameters)
+        result['initialization'] = time.time() - _start
+        result['round_trips'] = instrument_devices(experiment, time_scale=time_scale)
+        result['phases'] = instrument_phases(experiment)
+        start_time = time.time()
+        experiment.execute()
+        result['execute'] = time.time() - start_time
+        result['sweeps'] = get_sweeps(experiment, start_time)
+    except:
+        logging.error('benchmark of %s failed %s' % (name, traceback.format_exc()))
+        result['error'] = traceback.format_exc()
+    result['bytes_written'] = get_bytes_written(run_directory)
+    return result
+
+def get_metrics(result):
+    '''flat dictionary of the numbers worth comparing between runs'''
+    metrics = {}
+    for key in ['initialization', 'execute', 'bytes_written']:
+        if key in result:
+            metrics[key] = result[key]
+    for phase, timing in result.get('phases', {}).items():
+        metrics['phase.%s' % phase] = timing['duration']
+    for device, counts in result.get('round_trips', {}).items():
+        metrics['round_trips.%s' % device] = sum(counts.values())
+    for key, value in result.get('sweeps', {}).items():
+        metrics['sweeps.%s' % key] = value
+    return metrics
+
+def summarize(results):
+    '''median of every metric over the repeated runs of each experiment'''
+    summary = {}
+    for name in results:
+        runs = [get_metrics(result) for result in results[name] if 'error' not in result]
+        if not runs:
+            continue
+        keys = set().union(*[run.keys() for run in runs])
+        summary[name] = dict([(key, float(np.median([run[key] for run in runs if key in run]))) for key in keys])
+    return summary
+
+def compare(summary, baseline, tolerance=0.1, absolute_tolerance=0.05):
+    '''returns the metrics exceeding their baseline value by more than tolerance (relative) and absolute_tolerance'''
+    regressions = []
+    for name in baseline:
+        for key, reference in baseline[name].items():
+            if name not in summary or key not in summary[name]:
+                continue
+            value = summary[name][key]
+            if value > reference * (1 + tolerance) + absolute_tolerance:
+                regressions.append((name, key, reference, value))
+    return regressions
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-e', '--experiments', default=','.join(sorted(benchmarks)), type=str, help='Comma separated experiment classes to benchmark default=%default')
+    parser.add_option('-d', '--directory', default='/tmp/benchmark', type=str, help='Directory for the data and the results default=%default')
+    parser.add_option('-r', '--results', default=None, type=str, help='Results file default=<directory>/benchmark_results.json')
+    parser.add_option('-b', '--baseline', default=None, type=str, help='Baseline results file to compare against')
+    parser.add_option('-s', '--save_baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_option('-n', '--repeats', default=1, type=int, help='Number of runs of each experiment default=%default')
+    parser.add_option('-t', '--tolerance', default=0.1, type=float, help='Relative tolerance before a metric is reported as regressed default=%default')
+    parser.add_option('-a', '--absolute_tolerance', default=0.05, type=float, help='Absolute tolerance before a metric is reported as regressed default=%default')
+    parser.add_option('-T', '--time_scale', default=1., type=float, help='Time scale of the simulated devices default=%default')
+
+    options, args = parser.parse_args()
+
+    if options.results is None:
+        options.results = os.path.join(options.directory, 'benchmark_results.json')
+    if not os.path.isdir(options.directory):
+        os.makedirs(options.directory)
+
+    results = {}
+    for name in options.experiments.split(','):
+        results[name] = []
+        for k in range(options.repeats):
+            result = run_benchmark(name, options.directory, time_scale=options.time_scale, run=k)
+            results[name].append(result)
+            if 'error' in result:
+                print '%s run %d failed' % (name, k)
+            else:
+                print '%s run %d: execute %.3f s, %d bytes written' % (name, k, result['execute'], result['bytes_written'])
+
+    summary = summarize(results)
+    report = {'timestamp': time.time(), 'date': time.ctime(), 'time_scale': options.time_scale, 'summary': summary, 'runs': results}
+    f = open(options.results, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+    print 'results saved in %s' % options.results
+
+    for name in sorted(summary):
+        print name
+        for key in sorted(summary[name]):
+            print '    %-40s %12.4f' % (key, summary[name][key])
+
+    if options.save_baseline and options.baseline is not None:
+        f = open(options.baseline, 'w')
+        json.dump(summary, f, indent=1, sort_keys=True)
+        f.close()
+        print 'baseline saved in %s' % options.baseline
+    elif options.baseline is not None:
+        baseline = json.load(open(options.baseline))
+        regressions = compare(summary, baseline, tolerance=options.tolerance, absolute_tolerance=options.absolute_tolerance)
+        for name, key, reference, value in regressions:
+            print 'REGRESSION %s %s: %.4f (baseline %.4f)' % (name, key, value, reference)
+        if regressions:
+            sys.exit(1)
+        print 'no regression with respect to %s' % options.baseline
+
+if __name__ == '__main__':
+    main()
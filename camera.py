@@ -10,6 +10,7 @@ import numpy as np
 import PyTango
 import logging
 import gevent
+import h5py
 
 from goniometer import goniometer
 import redis
@@ -188,18 +189,44 @@ class camera(object):
         for item in ['history_image_timestamp', 'history_state_vector', 'history_image_data']:
             self.redis.ltrim(item, 0, -2)
             
-    def get_history(self, start, end):
+    def get_history_timestamps(self):
+        return np.array([float(timestamp) for timestamp in self.redis.lrange('history_image_timestamp', 0, -1)])
+    
+    def get_history_window(self, timestamps, start, end):
+        '''returns indices of the first and one past the last history item recorded between start and end'''
+        first = np.searchsorted(timestamps, start, side='left')
+        last = np.searchsorted(timestamps, end, side='right')
+        return int(first), int(last)
+    
+    def get_history_batches(self, timestamps, first, last, batch_size=50):
+        '''yields history items first to last in batches of (timestamps, images, state_vectors), fetching each batch in a single round trip'''
+        for batch_start in range(first, last, batch_size):
+            batch_end = min(batch_start + batch_size, last)
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.lrange('history_image_data', batch_start, batch_end - 1)
+            pipeline.lrange('history_state_vector', batch_start, batch_end - 1)
+            image_data, state_vectors = pipeline.execute()
+            images = [np.frombuffer(data, dtype=np.uint8).reshape(self.shape) for data in image_data]
+            state_vectors = np.array([self.get_state_vector_with_float_values_from_state_vector_as_single_string(state_vector) for state_vector in state_vectors])
+            yield timestamps[batch_start:batch_end], images, state_vectors
+            
+    def get_history(self, start, end, batch_size=50):
         self.redis.set('can_clear_history', 0)
         try:
-            timestamps = np.array([float(self.redis.lindex('history_image_timestamp', i)) for i in range(self.redis.llen('history_image_timestamp'))])
+            timestamps = self.get_history_timestamps()
+            first, last = self.get_history_window(timestamps, start, end)
             
-            mask = np.logical_and(timestamps>=start, timestamps<=end)
+            interesting_stamps = timestamps[first:last]
+            interesting_images = np.empty((last - first,) + self.shape, dtype=np.uint8)
+            interesting_state_vectors = []
             
-            interesting_stamps = np.array([float(self.redis.lindex('history_image_timestamp', int(i))) for i in np.argwhere(mask)])
-            
-            interesting_images = np.array([self.get_rgbimage(image_data=self.redis.lindex('history_image_data', int(i))) for i in np.argwhere(mask)])
-            
-            interesting_state_vectors = np.array([self.get_state_vector_with_float_values_from_state_vector_as_single_string(self.redis.lindex('history_state_vector', int(i))) for i in np.argwhere(mask)])
+            k = 0
+            for stamps, images, state_vectors in self.get_history_batches(timestamps, first, last, batch_size):
+                for image in images:
+                    interesting_images[k] = image
+                    k += 1
+                interesting_state_vectors += list(state_vectors)
+            interesting_state_vectors = np.array(interesting_state_vectors)
             
         except:
             interesting_stamps = np.array([])
@@ -209,22 +236,53 @@ class camera(object):
         self.redis.set('can_clear_history', 1)
         return interesting_stamps, interesting_images, interesting_state_vectors
     
-    def get_image_corresponding_to_timestamp(self, timestamp):
+    def save_history(self, filename, start, end, batch_size=50, compression='gzip'):
+        '''writes history between start and end into hdf5 file batch by batch, without holding all of it in memory'''
         self.redis.set('can_clear_history', 0)
         try:
-            timestamps = np.array([float(self.redis.lindex('history_image_timestamp', i)) for i in range(self.redis.llen('history_image_timestamp'))])
+            timestamps = self.get_history_timestamps()
+            first, last = self.get_history_window(timestamps, start, end)
             
-            timestamps_before = timestamps[timestamps <= timestamp]
+            history_file = h5py.File(filename, 'w')
+            history_images = history_file.create_dataset('history_images',
+                                                         shape=(last - first,) + self.shape,
+                                                         chunks=(1,) + self.shape,
+                                                         compression=compression,
+                                                         dtype=np.uint8)
+            history_state_vectors = None
+            k = 0
+            for stamps, images, state_vectors in self.get_history_batches(timestamps, first, last, batch_size):
+                if history_state_vectors is None:
+                    history_state_vectors = history_file.create_dataset('history_state_vectors',
+                                                                        shape=(last - first, state_vectors.shape[1]),
+                                                                        dtype=state_vectors.dtype)
+                for image in images:
+                    history_images[k] = image
+                    k += 1
+                history_state_vectors[k - len(images): k] = state_vectors
+            if history_state_vectors is None:
+                history_file.create_dataset('history_state_vectors', data=np.array([]))
             
-            closest = np.argmin(np.abs(timestamps_before - timestamp))
+            history_file.create_dataset('history_timestamps',
+                                        data=timestamps[first:last])
+            history_file.close()
+        finally:
+            self.redis.set('can_clear_history', 1)
+        return last - first
+    
+    def get_image_corresponding_to_timestamp(self, timestamp):
+        self.redis.set('can_clear_history', 0)
+        try:
+            timestamps = self.get_history_timestamps()
             
-            corresponding_image = self.get_rgbimage(image_data=self.redis.lindex('history_image_data', int(closest)))
+            closest = np.searchsorted(timestamps, timestamp, side='right') - 1
+            if closest < 0:
+                raise IndexError('no image in history before %s' % timestamp)
             
-            #corresponding_state_vector =  self.get_state_vector_with_float_values_from_state_vector_as_single_string(self.redis.lindex('history_state_vector', int(closest)))
+            corresponding_image = self.get_rgbimage(image_data=self.redis.lindex('history_image_data', int(closest)))
             
         except:
             corresponding_image = self.get_rgbimage()
-            #corresponding_state_vector = None
         
         self.redis.set('can_clear_history', 1)
     
@@ -1,14 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Simulated Eiger detector.
+
+Frames are produced at the configured frame_time and written into HDF5
+master and data files laid out like the ones of the Eiger filewriter, in the
+directory of the name_pattern. In ints mode a series starts on trigger(), in
+exts mode on the scans of the simulated goniometer (md2_mockup). The same
+compressed frame is written over and over, so the simulation costs little
+more than the file system writes.
+'''
+
+import os
+import time
+import logging
+import traceback
+import threading
+import contextlib
+import zlib
+import numpy as np
+import h5py
+
+from md2_mockup import md2_mockup
+
 class detector_mockup:
     
-    def __init__(self, host='172.19.10.26', port=80):
+    def __init__(self, host='172.19.10.26', port=80, time_scale=1., background=0.01):
         self.host = host
         self.port = port
+        self.time_scale = time_scale
+        self.background = background
         attributes = [  "photon_energy",
                         "threshold_energy",
                         "data_collection_date",
                         "beam_center_x",
                         "beam_center_y",
-                        "detector_distance    ",
+                        "detector_distance",
                         "detector_translation",
                         "frame_time",
                         "count_time",
@@ -16,7 +44,7 @@ class detector_mockup:
                         "ntrigger",
                         "wavelength",
                         "summation_nimages",
-                        "nframes_sum    ",
+                        "nframes_sum",
                         "element",
                         "trigger_mode",
                         "omega_start",
@@ -42,19 +70,44 @@ class detector_mockup:
                         "pixel_mask_applied",
                         "flatfield_correction_applied",
                         "virtual_pixel_correction_applied",
-                        "efficiency_correction_applied"
+                        "efficiency_correction_applied",
                         "count_rate_correction_applied",
                         "compression",
                         "roi_mode",
-                        "roi_mode = roi_mode",
                         "x_pixels_in_detector",
-                        "y_pixels_in_detector    ",
+                        "y_pixels_in_detector",
                         "name_pattern",
                         "nimages_per_file",
                         "image_nr_start",
                         "compression_enabled"]
         for attribute in attributes:
             setattr(self, attribute, 0)
+        
+        self.trigger_mode = 'exts'
+        self.frame_time = 0.1
+        self.count_time = 0.1 - 1.e-5
+        self.detector_readout_time = 1.e-5
+        self.nimages = 1
+        self.ntrigger = 1
+        self.nimages_per_file = 100
+        self.image_nr_start = 1
+        self.bit_depth_image = 16
+        self.x_pixels_in_detector = 3110
+        self.y_pixels_in_detector = 3269
+        self.description = 'Dectris EIGER 9M (simulated)'
+        self.detector_number = 'simulated'
+        self.sensor_thickness = 0.00045
+        self.x_pixel_size = 7.5e-05
+        self.y_pixel_size = 7.5e-05
+        self.software_version = 'simulated'
+        self.name_pattern = 'series_$id'
+        
+        self.sequence_id = 0
+        self.state = 'idle'
+        self.series = None
+        self.writer = None
+        self.lock = threading.Lock()
+        md2_mockup.scan_listeners.add(self)
 
     # detector configuration
     def set_photon_energy(self, photon_energy):
@@ -145,59 +198,62 @@ class detector_mockup:
         return self.trigger_mode
         
     def set_omega(self, omega):
-        self.omega = omega
+        self.omega_start = omega
     def get_omega(self):
         return self.omega_start
     
     def set_omega_increment(self, omega_increment):
         self.omega_increment = omega_increment
-    def get_omega_range_average(self):
+        self.omega_range_average = omega_increment
+    def get_omega_increment(self):
         return self.omega_increment
         
     def set_omega_range_average(self, omega_increment):
-        self.omega_increment = omega_increment
+        self.set_omega_increment(omega_increment)
     def get_omega_range_average(self):
         return self.omega_range_average
         
     def set_phi(self, phi):
-        self.phi = phi
+        self.phi_start = phi
     def get_phi(self):
         return self.phi_start
         
     def set_phi_range_average(self, phi_increment):
         self.phi_increment = phi_increment
+        self.phi_range_average = phi_increment
     def get_phi_range_average(self):
         return self.phi_range_average
         
     def set_chi(self, chi):
-        self.chi = chi   
+        self.chi_start = chi
     def get_chi(self):
         return self.chi_start
         
-    def set_chi_range_average(self, phi_increment):
+    def set_chi_range_average(self, chi_increment):
         self.chi_increment = chi_increment
+        self.chi_range_average = chi_increment
     def get_chi_range_average(self):
         return self.chi_range_average
 
     def set_kappa(self, kappa):
-        self.kappa = kappa
+        self.kappa_start = kappa
     def get_kappa(self):
         return self.kappa_start
         
     def set_kappa_range_average(self, kappa_increment):
         self.kappa_increment = kappa_increment
-        return self.setDetectorConfig('kappa_range_average', kappa_increment)
-        
+        self.kappa_range_average = kappa_increment
     def get_kappa_range_average(self):
         return self.kappa_range_average
     
     def set_two_theta(self, two_theta):
-        self.two_theta = two_theta
+        self.two_theta_start = two_theta
     def get_two_theta(self):
         return self.two_theta_start
         
     def set_two_theta_range_average(self, two_theta_increment):
         self.two_theta_increment = two_theta_increment
+        self.two_theta_range_average = two_theta_increment
     def get_two_theta_range_average(self):
         return self.two_theta_range_average
     
@@ -260,7 +316,7 @@ class detector_mockup:
     def get_x_pixels_in_detector(self):
         return self.x_pixels_in_detector
     def get_y_pixels_in_detector(self):
-        self.y_pixels_in_detector    
+        return self.y_pixels_in_detector
         
     # filewriter
     def set_name_pattern(self, name_pattern):
@@ -302,14 +358,16 @@ class detector_mockup:
         return 'buffer_free'
         
     def get_filewriter_state(self):
-        return 'filewriter_state'
+        if self.state == 'acquire':
+            return 'acquire'
+        return 'ready'
         
     def get_filewriter_error(self):
         return 'filewriter_error'
         
     # detector status
     def get_detector_state(self):
-        return 'detector_state'
+        return self.state
         
     def get_detector_error(self):
         return 'detector_error'
@@ -323,24 +381,82 @@ class detector_mockup:
     def get_temperature(self):
         return 'board_000/th0_temp'
         
+    # configuration is applied immediately, sessions only need to nest
+    @contextlib.contextmanager
+    def configuration_session(self):
+        yield self
+    
     # detector commands
     def arm(self):
-        return u'arm'
+        if self.series is not None:
+            self.abort()
+        self.sequence_id += 1
+        self.series = {'id': self.sequence_id,
+                       'prefix': self.get_file_prefix(),
+                       'nimages': int(self.nimages),
+                       'ntrigger': int(self.ntrigger),
+                       'nimages_per_file': int(self.nimages_per_file) or int(self.nimages) * int(self.ntrigger),
+                       'frame_time': float(self.frame_time) * self.time_scale,
+                       'header': self.get_header(),
+                       'triggers': [],
+                       'stop_time': None,
+                       'condition': threading.Condition(self.lock)}
+        self.state = 'ready'
+        self.writer = threading.Thread(target=self.write_series, args=(self.series,))
+        self.writer.daemon = True
+        self.writer.start()
+        return {u'sequence id': self.sequence_id}
+    
+    def add_triggers(self, trigger_times, frame_time=None):
+        series = self.series
+        if series is None:
+            return
+        with series['condition']:
+            for trigger_time in trigger_times:
+                if len(series['triggers']) < series['ntrigger']:
+                    series['triggers'].append((trigger_time, frame_time or series['frame_time']))
+            series['condition'].notify_all()
+        
+    def goniometer_scan_started(self, trigger_times, exposure_time):
+        '''called by md2_mockup at the start of every scan'''
+        if self.trigger_mode == 'exts':
+            self.add_triggers(trigger_times)
+        elif self.trigger_mode == 'exte':
+            self.add_triggers(trigger_times, frame_time=exposure_time)
         
     def trigger(self, count_time=None):
-        if count_time == None:
-            return u'trigger'
-        else:
-            return u'trigger', count_time
+        if self.series is None or not self.trigger_mode.startswith('int'):
+            return
+        frame_time = None
+        if count_time != None and self.trigger_mode == 'inte':
+            frame_time = count_time * self.time_scale
+        self.add_triggers([time.time()], frame_time=frame_time)
+        # the real detector returns when the acquisition of the trigger is done
+        series = self.series
+        with series['condition']:
+            k = len(series['triggers'])
+            while series.get('triggers_done', 0) < k and series['stop_time'] is None:
+                series['condition'].wait(0.1)
+        
+    def stop_series(self, slack=0.5):
+        '''frames ending later than slack frames after now are dropped'''
+        series = self.series
+        if series is None:
+            return
+        with series['condition']:
+            series['stop_time'] = time.time() + slack * series['frame_time']
+            series['condition'].notify_all()
+        self.wait_for_collect_to_finish()
+        self.series = None
         
     def disarm(self):
-        return u'disarm'
+        self.stop_series()
         
     def cancel(self):
-        return u'cancel'
+        self.stop_series()
         
     def abort(self):
-        return u'abort'
+        self.stop_series(slack=0.)
         
     def initialize(self):
         return u'initialize'
@@ -430,7 +546,131 @@ class detector_mockup:
         return
         
     def wait_for_collect_to_finish(self):
-        return
+        if self.writer is not None:
+            self.writer.join()
+            
+    # simulated filewriter
+    def get_file_prefix(self):
+        '''name_pattern of the experiments starts with the user id, the directory follows'''
+        name_pattern = str(self.name_pattern).replace('$id', str(self.sequence_id))
+        parts = name_pattern.split('/')
+        if len(parts) > 2 and parts[0] == '' and parts[1].isdigit():
+            name_pattern = '/' + '/'.join(parts[2:])
+        return name_pattern
+    
+    def get_header(self):
+        if self.photon_energy:
+            wavelength = 12398.4193 / self.photon_energy
+        else:
+            wavelength = self.wavelength
+        header = {'wavelength': wavelength}
+        for attribute in ['count_time', 'frame_time', 'beam_center_x', 'beam_center_y', 'detector_distance', 'x_pixel_size', 'y_pixel_size', 'sensor_thickness', 'description', 'detector_number', 'threshold_energy', 'nimages', 'ntrigger', 'countrate_correction_count_cutoff', 'number_of_excluded_pixels', 'x_pixels_in_detector', 'y_pixels_in_detector', 'software_version', 'bit_depth_image', 'photon_energy']:
+            header[attribute] = getattr(self, attribute, 0)
+        header['data_collection_date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for axis in ['omega', 'phi', 'chi', 'kappa']:
+            header['%s_start' % axis] = getattr(self, '%s_start' % axis, 0)
+            header['%s_increment' % axis] = getattr(self, '%s_increment' % axis, 0)
+        return header
+    
+    def get_frame(self, header):
+        '''one frame, compressed the way the hdf5 deflate filter expects it'''
+        dtype = np.uint32 if header['bit_depth_image'] == 32 else np.uint16
+        shape = (int(header['y_pixels_in_detector']), int(header['x_pixels_in_detector']))
+        frame = np.random.poisson(self.background, shape).astype(dtype)
+        return zlib.compress(frame.tobytes(), 1), shape, dtype
+    
+    def create_data_file(self, series, file_number, shape, dtype):
+        filename = '%s_data_%06d.h5' % (series['prefix'], file_number)
+        data_file = h5py.File(filename, 'w')
+        entry = data_file.create_group('entry')
+        entry.attrs['NX_class'] = 'NXentry'
+        data = entry.create_group('data')
+        data.attrs['NX_class'] = 'NXdata'
+        dataset = data.create_dataset('data', shape=(0,) + shape, maxshape=(None,) + shape, chunks=(1,) + shape, dtype=dtype, compression='gzip')
+        return data_file, dataset
+    
+    def close_data_file(self, data_file, dataset, first_image):
+        dataset.attrs['image_nr_low'] = first_image
+        dataset.attrs['image_nr_high'] = first_image + dataset.shape[0] - 1
+        data_file.close()
+    
+    def write_series(self, series):
+        data_file = None
+        images_written = 0
+        try:
+            self.check_dir(os.path.dirname(series['prefix']) or '.')
+            chunk, shape, dtype = self.get_frame(series['header'])
+            for k in range(series['ntrigger']):
+                with series['condition']:
+                    while len(series['triggers']) <= k and series['stop_time'] is None:
+                        series['condition'].wait(0.1)
+                    if len(series['triggers']) <= k:
+                        break
+                    trigger_time, frame_time = series['triggers'][k]
+                self.state = 'acquire'
+                for n in range(series['nimages']):
+                    frame_end = trigger_time + (n + 1) * frame_time
+                    while time.time() < frame_end and (series['stop_time'] is None or series['stop_time'] >= frame_end):
+                        time.sleep(min(frame_end - time.time(), 0.1))
+                    if series['stop_time'] is not None and series['stop_time'] < frame_end:
+                        break
+                    if images_written % series['nimages_per_file'] == 0:
+                        if data_file is not None:
+                            self.close_data_file(data_file, dataset, images_written - dataset.shape[0] + 1)
+                        data_file, dataset = self.create_data_file(series, images_written // series['nimages_per_file'] + 1, shape, dtype)
+                    index = dataset.shape[0]
+                    dataset.resize(index + 1, axis=0)
+                    dataset.id.write_direct_chunk((index, 0, 0), chunk)
+                    images_written += 1
+                with series['condition']:
+                    series['triggers_done'] = k + 1
+                    series['condition'].notify_all()
+            if data_file is not None:
+                self.close_data_file(data_file, dataset, images_written - dataset.shape[0] + 1)
+                data_file = None
+            self.write_master(series, images_written)
+            self.state = 'idle'
+        except:
+            logging.error('simulated detector failed to write series %d %s' % (series['id'], traceback.format_exc()))
+            self.state = 'error'
+        with series['condition']:
+            series['triggers_done'] = series['ntrigger']
+            series['condition'].notify_all()
+    
+    def write_master(self, series, images_written):
+        header = series['header']
+        prefix = series['prefix']
+        master = h5py.File('%s_master.h5' % prefix, 'w')
+        entry = master.create_group('entry')
+        entry.attrs['NX_class'] = 'NXentry'
+        data = entry.create_group('data')
+        data.attrs['NX_class'] = 'NXdata'
+        number_of_files = int(np.ceil(images_written / float(series['nimages_per_file'])))
+        for file_number in range(1, number_of_files + 1):
+            data['data_%06d' % file_number] = h5py.ExternalLink('%s_data_%06d.h5' % (os.path.basename(prefix), file_number), '/entry/data/data')
+        detector = entry.create_group('instrument/detector')
+        for name in ['count_time', 'frame_time', 'beam_center_x', 'beam_center_y', 'detector_distance', 'x_pixel_size', 'y_pixel_size', 'sensor_thickness', 'threshold_energy']:
+            detector[name] = float(header[name])
+        detector['description'] = header['description']
+        detector['detector_number'] = header['detector_number']
+        specific = detector.create_group('detectorSpecific')
+        for name in ['nimages', 'ntrigger', 'countrate_correction_count_cutoff', 'number_of_excluded_pixels', 'x_pixels_in_detector', 'y_pixels_in_detector']:
+            specific[name] = int(header[name])
+        specific['data_collection_date'] = header['data_collection_date']
+        specific['software_version'] = header['software_version']
+        specific['photon_energy'] = float(header['photon_energy'])
+        beam = entry.create_group('instrument/beam')
+        beam['incident_wavelength'] = float(header['wavelength'])
+        goniometer = entry.create_group('sample/goniometer')
+        nframes = header['nimages'] * header['ntrigger']
+        for axis in ['omega', 'phi', 'chi', 'kappa']:
+            start, increment = float(header['%s_start' % axis]), float(header['%s_increment' % axis])
+            goniometer[axis] = start + increment * np.arange(nframes)
+            goniometer['%s_end' % axis] = start + increment * np.arange(1, nframes + 1)
+            goniometer['%s_increment' % axis] = increment
+            goniometer['%s_range_average' % axis] = increment
+            goniometer['%s_range_total' % axis] = increment * nframes
+        master.close()
     def check_dir(self, download):
         if os.path.isdir(download):
             pass
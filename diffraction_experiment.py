@@ -6,6 +6,7 @@ import time
 import os
 import logging
 from xray_experiment import xray_experiment
+from tracing import traced
 
 class diffraction_experiment(xray_experiment):
     
@@ -310,54 +311,56 @@ class diffraction_experiment(xray_experiment):
     def get_beam_center_y(self):
         return self.beam_center_y
         
+    @traced
     def program_detector(self):
         _start = time.time()
-        if self.detector.get_trigger_mode() != 'exts':
-            self.detector.set_trigger_mode('exts')
+        with self.detector.configuration_session():
+            if self.detector.get_trigger_mode() != 'exts':
+                self.detector.set_trigger_mode('exts')
             
-        self.detector.set_standard_parameters()
-        self.detector.clear_monitor()
-        self.detector.set_ntrigger(self.get_ntrigger())
-        self.detector.set_nimages_per_file(self.get_nimages_per_file())
-        self.detector.set_nimages(self.get_nimages())
-        self.detector.set_name_pattern(self.get_full_name_pattern())
-        self.detector.set_frame_time(self.get_frame_time())
-        count_time = self.get_frame_time() - self.detector.get_detector_readout_time()
-        self.detector.set_count_time(count_time)
-        self.detector.set_omega(self.scan_start_angle)
-        if self.angle_per_frame <= 0.001:
-            self.detector.set_omega_increment(0)
-        else:
-            self.detector.set_omega_increment(self.angle_per_frame)
-        
-        self.detector.set_kappa(self.kappa)
-        self.detector.set_phi(self.phi)
-        self.detector.set_chi(self.chi)
-        
-        self.detector.set_photon_energy(self.photon_energy)
-        
-        if self.detector.get_image_nr_start() != self.image_nr_start:
-            self.detector.set_image_nr_start(self.image_nr_start)
-        
-        if self.simulation != True:
-            beam_center_x, beam_center_y = self.beam_center.get_beam_center(wavelength=self.wavelength, ts=self.detector_distance, tx=self.detector_horizontal, tz=self.detector_vertical)
-            beam_stop_x, beam_stop_y = self.beam_center.get_beamstop_position(wavelength=self.wavelength, ts=self.detector_distance, tx=self.detector_horizontal, tz=self.detector_vertical)
+            self.detector.set_standard_parameters()
+            self.detector.clear_monitor()
+            self.detector.set_ntrigger(self.get_ntrigger())
+            self.detector.set_nimages_per_file(self.get_nimages_per_file())
+            self.detector.set_nimages(self.get_nimages())
+            self.detector.set_name_pattern(self.get_full_name_pattern())
+            self.detector.set_frame_time(self.get_frame_time())
+            count_time = self.get_frame_time() - self.detector.get_detector_readout_time()
+            self.detector.set_count_time(count_time)
+            self.detector.set_omega(self.scan_start_angle)
+            if self.angle_per_frame <= 0.001:
+                self.detector.set_omega_increment(0)
+            else:
+                self.detector.set_omega_increment(self.angle_per_frame)
+        
+            self.detector.set_kappa(self.kappa)
+            self.detector.set_phi(self.phi)
+            self.detector.set_chi(self.chi)
+        
+            self.detector.set_photon_energy(self.photon_energy)
+        
+            if self.detector.get_image_nr_start() != self.image_nr_start:
+                self.detector.set_image_nr_start(self.image_nr_start)
+        
+            if self.simulation != True:
+                beam_center_x, beam_center_y = self.beam_center.get_beam_center(wavelength=self.wavelength, ts=self.detector_distance, tx=self.detector_horizontal, tz=self.detector_vertical)
+                beam_stop_x, beam_stop_y = self.beam_center.get_beamstop_position(wavelength=self.wavelength, ts=self.detector_distance, tx=self.detector_horizontal, tz=self.detector_vertical)
             
             
-            self.detector.beamstop.set_x(beam_stop_x)
-            self.detector.beamstop.set_z(beam_stop_y)
+                self.detector.beamstop.set_x(beam_stop_x)
+                self.detector.beamstop.set_z(beam_stop_y)
 
-        else:
-            beam_center_x, beam_center_y = 1430, 1550
+            else:
+                beam_center_x, beam_center_y = 1430, 1550
         
-        self.beam_center_x, self.beam_center_y = beam_center_x, beam_center_y
+            self.beam_center_x, self.beam_center_y = beam_center_x, beam_center_y
         
-        self.detector.set_beam_center_x(beam_center_x)
-        self.detector.set_beam_center_y(beam_center_y)
+            self.detector.set_beam_center_x(beam_center_x)
+            self.detector.set_beam_center_y(beam_center_y)
         
-        if self.simulation == True:
-            self.detector_distance = 250.
-        self.detector.set_detector_distance(self.detector_distance/1000.)
+            if self.simulation == True:
+                self.detector_distance = 250.
+            self.detector.set_detector_distance(self.detector_distance/1000.)
         self.sequence_id = self.detector.arm()[u'sequence id']
         print 'program_detector took %s' % (time.time()-_start)
     
@@ -9,6 +9,9 @@ import re
 import logging
 import traceback
 import urllib2
+import contextlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from eigerclient import DEigerClient
 
 '''
@@ -62,12 +65,198 @@ e.print_stream_config()
 e.print_monitor_status()
 e.print_detector_status()
 
+Programming of the detector may be grouped in a configuration session. Within a session
+all get methods are served from a snapshot of the configuration of the detector, filewriter
+and stream modules, each parameter being read from the detector the first time it is needed
+and kept across sessions. Set methods only record values differing from the snapshot and the
+changes are pushed to the detector when the session ends, the parameters reported as changed
+are read again when next needed:
+
+with e.configuration_session():
+    e.set_standard_parameters()
+    e.set_nimages(100)
+    e.set_photon_energy(12650)
+e.arm()
+
 '''
 
 class eiger(DEigerClient):
     
     def __init__(self, host='172.19.10.26', port=80):
         DEigerClient.__init__(self, host=host, port=port)
+        self.config_snapshot = None
+        self.pending_config = None
+        
+    # configuration snapshot and sessions
+    snapshot_modules = ['detector', 'filewriter', 'stream']
+    snapshot_skip = ['flatfield', 'pixel_mask']
+    
+    def get_config_getter(self, module):
+        return {'detector': lambda param: DEigerClient.detectorConfig(self, param),
+                'filewriter': lambda param: DEigerClient.fileWriterConfig(self, param),
+                'stream': lambda param: DEigerClient.streamConfig(self, param)}[module]
+    
+    def get_config_setter(self, module):
+        return {'detector': lambda param, value: DEigerClient.setDetectorConfig(self, param, value),
+                'filewriter': lambda param, value: DEigerClient.setFileWriterConfig(self, param, value),
+                'stream': lambda param, value: DEigerClient.setStreamConfig(self, param, value)}[module]
+        
+    def load_config_snapshot(self):
+        '''reads configuration parameters of all modules at once, the requests run concurrently over the connection pool'''
+        _start = time.time()
+        self.config_snapshot = dict([(module, {}) for module in self.snapshot_modules])
+        jobs = []
+        for module in self.snapshot_modules:
+            jobs += [(module, param) for param in self.get_config_getter(module)('keys') if param not in self.snapshot_skip]
+        pool = ThreadPool(self._maxConnections)
+        try:
+            entries = pool.map(self.read_config_entry, jobs)
+        finally:
+            pool.close()
+        for (module, param), entry in zip(jobs, entries):
+            if entry is not None:
+                self.config_snapshot[module][param] = entry
+        logging.debug('config snapshot took %.3f' % (time.time() - _start))
+        return self.config_snapshot
+    
+    def read_config_entry(self, job):
+        module, param = job
+        try:
+            return self.get_config_getter(module)(param)
+        except:
+            logging.debug('could not read %s config %s %s' % (module, param, traceback.format_exc()))
+    
+    def clear_config_snapshot(self):
+        self.config_snapshot = None
+    
+    def invalidate_config(self, module, changed):
+        if self.config_snapshot is None or changed is None:
+            return
+        for param in changed:
+            self.config_snapshot[module].pop(param, None)
+    
+    def update_config(self, module, param, entry):
+        if self.config_snapshot is not None and isinstance(entry, dict):
+            self.config_snapshot[module][param] = entry
+        return entry
+    
+    def get_config(self, module, param):
+        '''configuration entry served from the snapshot (with pending value if any), read from the detector when missing'''
+        if param not in self.config_snapshot[module]:
+            self.config_snapshot[module][param] = self.get_config_getter(module)(param)
+        entry = self.config_snapshot[module][param]
+        if self.pending_config is not None and (module, param) in self.pending_config:
+            entry = dict(entry)
+            entry['value'] = self.pending_config[(module, param)]
+        return entry
+    
+    def set_config(self, module, param, value):
+        '''records value to be written at the end of the session, provided it differs from the snapshot'''
+        key = (module, param)
+        if self.get_config(module, param).get('value') == value:
+            return []
+        if key in self.pending_config and self.config_snapshot[module][param].get('value') == value:
+            del self.pending_config[key]
+        else:
+            self.pending_config[key] = value
+        return []
+    
+    def is_configuration_session(self):
+        return self.pending_config is not None
+    
+    def start_configuration_session(self):
+        if self.config_snapshot is None:
+            self.config_snapshot = dict([(module, {}) for module in self.snapshot_modules])
+        self.pending_config = OrderedDict()
+        
+    def commit_configuration(self):
+        '''writes pending changes, detector parameters in a single setDetectorConfigMultiple call, returns list of changed parameters'''
+        pending = self.pending_config
+        self.pending_config = None
+        changed = []
+        try:
+            detector_params = []
+            for (module, param), value in pending.items():
+                if module == 'detector':
+                    detector_params += [param, value]
+            if detector_params:
+                detector_changed = list(self.setDetectorConfigMultiple(*detector_params) or [])
+                self.invalidate_config('detector', detector_params[::2] + detector_changed)
+                changed += detector_changed
+            for (module, param), value in pending.items():
+                if module != 'detector':
+                    module_changed = self.get_config_setter(module)(param, value)
+                    self.invalidate_config(module, [param] + list(module_changed or []))
+                    changed += list(module_changed or [])
+        finally:
+            self.pending_config = OrderedDict()
+        return changed
+    
+    def end_configuration_session(self, commit=True):
+        try:
+            if commit:
+                return self.commit_configuration()
+        finally:
+            self.pending_config = None
+    
+    @contextlib.contextmanager
+    def configuration_session(self):
+        '''pending changes are written if the block completes and discarded if it raises, nested sessions join the outer one'''
+        if self.is_configuration_session():
+            yield self
+            return
+        self.start_configuration_session()
+        try:
+            yield self
+        except:
+            self.end_configuration_session(commit=False)
+            raise
+        self.end_configuration_session()
+    
+    def detectorConfig(self, param=None, dataType=None):
+        if self.is_configuration_session() and param not in [None, 'keys'] and dataType in [None, 'native']:
+            return self.get_config('detector', param)
+        entry = DEigerClient.detectorConfig(self, param=param, dataType=dataType)
+        if param not in [None, 'keys'] and dataType in [None, 'native']:
+            self.update_config('detector', param, entry)
+        return entry
+    
+    def setDetectorConfig(self, param, value, dataType=None):
+        if self.is_configuration_session() and dataType in [None, 'native']:
+            return self.set_config('detector', param, value)
+        changed = DEigerClient.setDetectorConfig(self, param, value, dataType=dataType)
+        self.invalidate_config('detector', [param] + list(changed or []))
+        return changed
+    
+    def fileWriterConfig(self, param='keys'):
+        if self.is_configuration_session() and param not in [None, 'keys']:
+            return self.get_config('filewriter', param)
+        entry = DEigerClient.fileWriterConfig(self, param=param)
+        if param not in [None, 'keys']:
+            self.update_config('filewriter', param, entry)
+        return entry
+    
+    def setFileWriterConfig(self, param, value):
+        if self.is_configuration_session():
+            return self.set_config('filewriter', param, value)
+        changed = DEigerClient.setFileWriterConfig(self, param, value)
+        self.invalidate_config('filewriter', [param] + list(changed or []))
+        return changed
+    
+    def streamConfig(self, param='keys'):
+        if self.is_configuration_session() and param not in [None, 'keys']:
+            return self.get_config('stream', param)
+        entry = DEigerClient.streamConfig(self, param=param)
+        if param not in [None, 'keys']:
+            self.update_config('stream', param, entry)
+        return entry
+    
+    def setStreamConfig(self, param, value):
+        if self.is_configuration_session():
+            return self.set_config('stream', param, value)
+        changed = DEigerClient.setStreamConfig(self, param, value)
+        self.invalidate_config('stream', [param] + list(changed or []))
+        return changed
         
     # detector configuration
     def set_photon_energy(self, photon_energy):
@@ -321,7 +510,7 @@ class eiger(DEigerClient):
         return self.detectorConfig("auto_summation")['value']
         
     def set_countrate_correction_applied(self, countrate_correction_applied=True):
-        self.countrate_correction_applied = count_rate_correction_applied
+        self.countrate_correction_applied = countrate_correction_applied
         return self.setDetectorConfig('countrate_correction_applied', countrate_correction_applied)
     
     def get_countrate_correction_applied(self):
@@ -511,6 +700,8 @@ class eiger(DEigerClient):
         return self.sendDetectorCommand(u'abort')
         
     def initialize(self):
+        # initialization restores the default configuration
+        self.clear_config_snapshot()
         return self.sendDetectorCommand(u'initialize')
     
     def status_update(self):
@@ -773,24 +964,16 @@ class eiger(DEigerClient):
         self.write_destination_namepattern(image_path=self.directory, name_pattern=self.name_pattern)
 
     def set_standard_parameters(self):
-        for angle in ['two_theta', 'phi', 'chi', 'kappa']:
-            if getattr(self, 'get_%s' % angle)() != 0:
+        with self.configuration_session():
+            for angle in ['two_theta', 'phi', 'chi', 'kappa']:
                 getattr(self, 'set_%s' % angle)(0)
-            if getattr(self, 'get_%s_increment' % angle)() != 0:
                 getattr(self, 'set_%s_increment' % angle)(0)
-            if getattr(self, 'get_%s_increment' % angle)() != 0:
-                getattr(self, 'set_%s_increment' % angle)(0)
-        for option in ['compression_enabled', 'flatfield_correction_applied', 'countrate_correction_applied', 'virtual_pixel_correction_applied']:
-            if not getattr(self, 'get_%s' % option)():
-                setattr(self, 'set_%s' % option)(True)
-        if self.get_compression() != 'bslz4':
+            for option in ['compression_enabled', 'flatfield_correction_applied', 'countrate_correction_applied', 'virtual_pixel_correction_applied']:
+                getattr(self, 'set_%s' % option)(True)
             self.set_compression('bslz4')
-        if self.get_trigger_mode() != 'exts':
             self.set_trigger_mode('exts')
-        if self.get_nimages_per_file() != 100:
             self.set_nimages_per_file(100)
 
-
 if __name__ == '__main__':
     import optparse
     parser = optparse.OptionParser() 
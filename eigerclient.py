@@ -20,15 +20,57 @@ import socket
 import fnmatch
 import shutil
 import urllib2
+import threading
+import time
+import tracing
 
 Version = '1.6.0'
 
+class ConnectionPool(object):
+    """
+    Thread safe pool of persistent (keep-alive) HTTP connections to the same host.
+    At most maxConnections requests are in flight at any time, further requests wait for a free connection.
+    """
+
+    def __init__(self, host, port, timeout, maxConnections = 4):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxConnections)
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return httplib.HTTPConnection(self._host, self._port, timeout = self._timeout)
+
+    def release(self, connection, reuse = True):
+        """
+        Give the connection back to the pool. Connections that failed or that the server
+        is going to close are closed instead of being reused.
+        """
+        if reuse:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
 class DEigerClient(object):
     """
     class DEigerClient provides a low level interface to the EIGER API
     """
 
-    def __init__(self, host = '127.0.0.1', port = 80, verbose = False, urlPrefix = None, user = None):
+    def __init__(self, host = '127.0.0.1', port = 80, verbose = False, urlPrefix = None, user = None, maxConnections = 4):
         """
         Create a client object to talk to the EIGER API.
         Args:
@@ -37,6 +79,7 @@ class DEigerClient(object):
             verbose: bool value
             urlPrefix: String prepended to the urls. Should be None. Added for future convenience.
             user: "username:password". Should be None. Added for future convenience.
+            maxConnections: number of requests which may be in flight at the same time (from different threads)
         """
         super(DEigerClient,self).__init__()
         self._host = host
@@ -46,8 +89,13 @@ class DEigerClient(object):
         self._urlPrefix = ""
         self._user = None
         self._connectionTimeout = 24*3600
-        self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
+        self._maxConnections = maxConnections
+        self._pool = ConnectionPool(self._host, self._port, self._connectionTimeout, self._maxConnections)
         self._serializer = None
+        self._retries = 50
+        self._backoff = 0.01
+        self._maxBackoff = 2.
+        self._bufferSize = 4*1024*1024
         
         self.setUrlPrefix(urlPrefix)
         self.setUser(user)
@@ -83,7 +131,27 @@ class DEigerClient(object):
             timeout timeout in seconds
         """
         self._connectionTimeout = timeout
-        self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
+        self._pool.close()
+        self._pool = ConnectionPool(self._host, self._port, self._connectionTimeout, self._maxConnections)
+
+    def setRetryPolicy(self, retries = 50, backoff = 0.01, maxBackoff = 2.):
+        """
+        Failed connection attempts are retried after a delay starting at backoff seconds
+        and doubling after each failure up to maxBackoff seconds.
+        Args:
+            retries: number of attempts before the error is raised
+            backoff: initial delay in seconds
+            maxBackoff: maximal delay in seconds
+        """
+        self._retries = retries
+        self._backoff = backoff
+        self._maxBackoff = maxBackoff
+
+    def setBufferSize(self, bufferSize):
+        """
+        Set size in bytes of the reads used to stream downloads to files.
+        """
+        self._bufferSize = bufferSize
         
     def setUrlPrefix(self, urlPrefix):
         """Set url prefix, which is the string that is prepended to the 
@@ -293,13 +361,9 @@ class DEigerClient(object):
             [ self.fileWriterSave(f,targetDir)  for f in self.fileWriterFiles() if fnmatch.fnmatch(f, urllib2.quote(filename)) ]
         else:
             targetPath = os.path.join(targetDir,filename)
-            url = 'http://{0}:{1}/{2}data/{3}'.format(self._host,self._port,self._urlPrefix, filename)
-            req = urllib2.urlopen(url, timeout = self._connectionTimeout)
             with open(targetPath, 'wb') as fp:
                 self._log('Writing ', targetPath)
-                shutil.copyfileobj(req, fp, 512*1024)
-            # self._getRequest(url = '/{0}data/{1}'.format(self._urlPrefix, filename), dataType = 'hdf5',fileId = targetFile)
-            # targetFile.write(self.fileWriterFiles(filename))
+                self._getRequest(url = '/{0}data/{1}'.format(self._urlPrefix, filename), dataType = 'hdf5', fileId = fp)
             assert os.access(targetPath,os.R_OK)
         return
 
@@ -357,23 +421,17 @@ class DEigerClient(object):
         Returns:
             None
         """
-        data = None
         if param in ["next","monitor"]:
-            data = self.monitorImages(param)
+            parameter = param
         else :
             try:
-                int(param[0])
-                int(param[1])
-                data = self.monitorImages(param)
+                parameter = "{0}/{1}".format(int(param[0]), int(param[1]))
             except (TypeError, ValueError):
-                pass
-        if data is None:
-            raise RuntimeError('Invalid parameter {0}'.format(param))
-        else:
-            with open(path,'wb') as f:
-                self._log('Writing ', path)
-                f.write(data)
-            assert os.access(path,os.R_OK)
+                raise RuntimeError('Invalid parameter {0}'.format(param))
+        with open(path,'wb') as f:
+            self._log('Writing ', path)
+            self._getRequest(self._url('monitor','images',parameter = parameter), dataType = 'tif', fileId = f)
+        assert os.access(path,os.R_OK)
         return
 
     def monitorStatus(self, param = "keys"):
@@ -483,34 +541,37 @@ class DEigerClient(object):
 
         self._log('sending request to {0}'.format(url))
         numberOfTries = 0
-        response = None
-        while response is None:
+        tracing.count('http.%s' % method)
+        while True:
+            connection = self._pool.acquire()
             try:
-                self._connection.request(method,url, body = data, headers = headers)
-                response = self._connection.getresponse()
+                connection.request(method,url, body = data, headers = headers)
+                response = connection.getresponse()
+                break
             except Exception as e:
+                self._pool.release(connection, reuse = False)
                 numberOfTries += 1
-                if numberOfTries == 50:
+                tracing.count('http.retries')
+                if numberOfTries >= self._retries:
                     self._log("Terminate after {0} tries\n".format(numberOfTries))
                     raise e
-                self._log("Failed to connect to host. Retrying\n")
-                self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
-                continue
-
+                delay = min(self._maxBackoff, self._backoff * 2**(numberOfTries - 1))
+                self._log("Failed to connect to host. Retrying in {0} s\n".format(delay))
+                time.sleep(delay)
+
+        try:
+            status = response.status
+            reason = response.reason
+            if fileId is None or not status in range(200,300):
+                data = response.read()
+            else:
+                data = None
+                shutil.copyfileobj(response, fileId, self._bufferSize)
+        except:
+            self._pool.release(connection, reuse = False)
+            raise
+        self._pool.release(connection, reuse = not response.will_close)
 
-        status = response.status
-        reason = response.reason
-        if fileId is None:
-            data = response.read()
-        else:
-            bufferSize = 8*1024
-            while True:
-                data = response.read(bufferSize)
-                if len(data) > 0:
-                    fileId.write(data)
-                else:
-                    break
-            
         mimeType = response.getheader('content-type','text/plain')
         self._log('Return status: ', status, reason)
         if not response.status in range(200,300):
@@ -13,6 +13,8 @@ import scipy
 
 from xabs_lib import McMaster
 from xray_experiment import xray_experiment
+from observation_store import observation_store, observation_results
+import undulator_model
 from fluorescence_detector import fluorescence_detector as detector
 from motor_scan import motor_scan
 from motor import tango_motor
@@ -409,6 +411,9 @@ class energy_scan(xray_experiment):
                 x = self.actuator.get_energy(thetabragg=self.actuator.get_position())
                 
                 self.shuttered_observations.append([x, y])
+            
+            readout_times = [observation[1][-1] for observation in self.shuttered_observations]
+            self.log.info('fluorescence detector readout time per point: mean %.4f s, max %.4f s' % (np.mean(readout_times), np.max(readout_times)))
                 
                         
     def clean(self):
@@ -516,6 +521,10 @@ class energy_scan(xray_experiment):
         chooch_results['chooch_output'] = chooch_output
         print 'chooch_output', chooch_output
         chooch_results = self.parse_chooch_output(chooch_output)
+        try:
+            chooch_results['undulator_settings'] = self.get_undulator_settings([self.pk, self.ip])
+        except:
+            self.log.error('undulator settings lookup failed %s' % traceback.format_exc())
             
         chooch_results['chooch_results'] = chooch_results
         
@@ -524,6 +533,13 @@ class energy_scan(xray_experiment):
         f.close()
 
 
+    def get_undulator_settings(self, energies):
+        '''expected undulator harmonic, gap and flux at the energies [eV]'''
+        energies = [energy for energy in energies if energy is not None]
+        harmonics, gaps, fluxes = undulator_model.get_lookup().lookup(energies)
+        return dict([(energy, {'harmonic': int(harmonic), 'gap': gap, 'flux': flux}) for energy, harmonic, gap, flux in zip(energies, harmonics, gaps, fluxes)])
+    
+    
     def get_theta_chronos_predictor(self):
         
         all_observations = self.get_all_observations()
@@ -588,6 +604,8 @@ class energy_scan(xray_experiment):
             pass
         elif os.path.isfile(self.get_all_observations_filename()):
             self.all_observations = self.load_all_observations()
+        elif os.path.isfile(self.get_observations_filename()):
+            self.all_observations = self.load_stored_observations()
         else:
             print 'get_all_observations gathering'
             all_observations = {}
@@ -610,6 +628,13 @@ class energy_scan(xray_experiment):
 
     def save_all_observations(self):
         print 'save_all_observations'
+        if os.path.isfile(self.get_observations_filename()):
+            # monitors were recorded in the observation store during the scan
+            if self.shutterless == False:
+                store = observation_store(self.get_observations_filename(), mode='a')
+                store.append('shuttered_observations', ['energy', 'observation'], self.shuttered_observations)
+                store.close()
+            return
         f = open(self.get_all_observations_filename(), 'w')
         pickle.dump(self.get_all_observations(), f)
         f.close()
@@ -618,6 +643,15 @@ class energy_scan(xray_experiment):
     def load_all_observations(self):
         return pickle.load(open(self.get_all_observations_filename()))
 
+    
+    def load_stored_observations(self):
+        store = observation_store(self.get_observations_filename())
+        results = observation_results(store, aliases={'actuator_monitor': 'actuator'})
+        all_observations = dict([(name, results[name]) for name in results.keys()])
+        if 'shuttered_observations' in all_observations:
+            all_observations['shuttered_observations'] = store.get_observations('shuttered_observations')
+        return all_observations
+
                 
     def stop(self):
         self.stop_monitor()
@@ -26,7 +26,20 @@ import logging
 import time
 import os
 import pickle
+import gevent
+from gevent.threadpool import ThreadPool
 import scipy.misc
+import tracing
+from tracing import traced
+
+collection_pool = None
+
+def get_collection_pool(size):
+    '''thread pool shared by all parameter collections, getters which time out are left to finish in it on their own'''
+    global collection_pool
+    if collection_pool is None:
+        collection_pool = ThreadPool(size)
+    return collection_pool
 
 class experiment(object):
     
@@ -46,6 +59,16 @@ class experiment(object):
                                  {'name': 'user_id', 'type': 'int', 'description': 'User id'},
                                  {'name': 'mxcube_parent_id', 'type': 'int', 'description': ''},
                                  {'name': 'mxcube_gparent_id', 'type': 'int', 'description': ''}]
+    
+    # collect_parameters runs the getters concurrently in a thread pool, getters
+    # not done in parameter_timeout seconds are given up and recorded as slow
+    parameter_timeout = 5.
+    parameter_timeouts = {'image': 10., 'rgbimage': 10.}
+    slow_parameter_time = 0.5
+    collection_threads = 16
+    collection_check_time = 0.05
+    # getters still waiting for a free thread of the pool after this long are given up
+    parameter_queue_timeout = 10.
                 
         
     def __init__(self, 
@@ -196,65 +219,146 @@ class experiment(object):
 
     def execute(self):
         self.start_time = time.time()
+        tracing.instrument_tango()
+        self.tracer = tracing.tracer(self.get_trace_filename(), experiment=self.__class__.__name__, name_pattern=self.name_pattern, directory=self.directory)
+        previous_tracer = tracing.set_tracer(self.tracer)
         try:
-            self.prepare()
-            logging.debug('experiment prepare finished')
-            #print 'self.diagnostic', self.diagnostic
-            if self.diagnostic == True:
-                #print 'Starting monitoring'
-                self.start_monitor()
-                logging.debug('experiment monitors started')
-            self.run()
-            logging.debug('experiment run finished')
-            if self.diagnostic == True:
-                #print 'Stopping monitors'
-                self.stop_monitor()
-                logging.debug('experiment monitors stopped')
-        except:
-            print 'Problem in preparation or execution %s' % self.__module__
-            print traceback.print_exc()
+            with self.tracer.span('execute'):
+                try:
+                    with self.tracer.span('prepare'):
+                        self.prepare()
+                    logging.debug('experiment prepare finished')
+                    #print 'self.diagnostic', self.diagnostic
+                    if self.diagnostic == True:
+                        #print 'Starting monitoring'
+                        with self.tracer.span('start_monitor'):
+                            self.start_monitor()
+                        logging.debug('experiment monitors started')
+                    with self.tracer.span('run'):
+                        self.run()
+                    logging.debug('experiment run finished')
+                    if self.diagnostic == True:
+                        #print 'Stopping monitors'
+                        with self.tracer.span('stop_monitor'):
+                            self.stop_monitor()
+                        logging.debug('experiment monitors stopped')
+                except:
+                    print 'Problem in preparation or execution %s' % self.__module__
+                    print traceback.print_exc()
+                finally:
+                    self.end_time = time.time()
+                    with self.tracer.span('clean'):
+                        self.clean()
+                    logging.debug('experiment clean finished')
+                if self.analysis == True:
+                    with self.tracer.span('analyze'):
+                        self.analyze()
+                    with self.tracer.span('save_results'):
+                        self.save_results()
+                    logging.debug('experiment analysis finished')
+                if self.conclusion == True:
+                    with self.tracer.span('conclude'):
+                        self.conclude()
+                    logging.debug('experiment conclusion finished')
         finally:
-            self.end_time = time.time()
-            self.clean()
-            logging.debug('experiment clean finished')
-        if self.analysis == True:
-            self.analyze()
-            self.save_results()
-            logging.debug('experiment analysis finished')
-        if self.conclusion == True:
-            self.conclude()
-            logging.debug('experiment conclusion finished')
+            tracing.set_tracer(previous_tracer)
+            self.tracer.close()
             
         logging.debug('experiment execute took %s' % (time.time() - self.start_time))
 
 
 
-    def collect_parameters(self):
-        _start = time.time()
-        #self.parameter_fields = set(self.parameter_fields)
-        logging.debug('collect_parameters len(self.parameters_fields) %d' % len(self.parameter_fields))
+    def get_parameter_getter(self, name):
+        getter = getattr(self, 'get_%s' % name)
+        return lambda: {name: getter()}
+    
+    
+    def get_slits_parameter_names(self, k):
+        return ['slits%d_%s_%s' % (k, direction, attribute) for direction in ['vertical', 'horizontal'] for attribute in ['gap', 'position']]
+    
+    
+    def get_parameter_jobs(self):
+        '''returns (name, function, keys) triples, each function returning a dictionary of the parameters keys'''
+        jobs = []
         for parameter in self.parameter_fields:
             if parameter['name'] != 'slit_configuration':
                 try:
-                    self.parameters[parameter['name']] = getattr(self, 'get_%s' % parameter['name'])()
-                except:
-                    logging.debug('experiment collect_parameters %s' % traceback.format_exc())
-                    logging.debug('parameter %s' % parameter['name'])
+                    jobs.append((parameter['name'], self.get_parameter_getter(parameter['name']), [parameter['name']]))
+                except AttributeError:
+                    logging.debug('experiment collect_parameters no getter for %s' % parameter['name'])
                     self.parameters[parameter['name']] = None
-                    
             else:
-                slit_configuration = self.get_slit_configuration()
-                for key in slit_configuration:
-                    self.parameters[key] = slit_configuration[key]
+                for k in self.slits:
+                    jobs.append(('slits%d' % k, lambda k=k: self.get_slits_configuration(k), self.get_slits_parameter_names(k)))
         
         if self.snapshot == True:
-            self.parameters['camera_zoom'] = self.get_zoom()
-            self.parameters['camera_calibration_horizontal'] = self.camera.get_horizontal_calibration()
-            self.parameters['camera_calibration_vertical'] = self.camera.get_vertical_calibration()
-            self.parameters['beam_position_vertical'] = self.camera.get_beam_position_vertical()
-            self.parameters['beam_position_horizontal'] = self.camera.get_beam_position_horizontal()
-            self.parameters['image'] = self.get_image()
-            self.parameters['rgbimage'] = self.get_rgbimage()
+            jobs.append(('camera_zoom', lambda: {'camera_zoom': self.get_zoom()}, ['camera_zoom']))
+            jobs.append(('camera_calibration_horizontal', lambda: {'camera_calibration_horizontal': self.camera.get_horizontal_calibration()}, ['camera_calibration_horizontal']))
+            jobs.append(('camera_calibration_vertical', lambda: {'camera_calibration_vertical': self.camera.get_vertical_calibration()}, ['camera_calibration_vertical']))
+            jobs.append(('beam_position_vertical', lambda: {'beam_position_vertical': self.camera.get_beam_position_vertical()}, ['beam_position_vertical']))
+            jobs.append(('beam_position_horizontal', lambda: {'beam_position_horizontal': self.camera.get_beam_position_horizontal()}, ['beam_position_horizontal']))
+            jobs.append(('image', lambda: {'image': self.get_image()}, ['image']))
+            jobs.append(('rgbimage', lambda: {'rgbimage': self.get_rgbimage()}, ['rgbimage']))
+        return jobs
+    
+    
+    def get_parameter_timeout(self, name):
+        return self.parameter_timeouts.get(name, self.parameter_timeout)
+    
+    
+    @traced
+    def collect_parameters(self):
+        _start = time.time()
+        jobs = self.get_parameter_jobs()
+        logging.debug('collect_parameters %d getters' % len(jobs))
+        
+        pool = get_collection_pool(self.collection_threads)
+        started = {}
+        def run(name, function):
+            started[name] = time.time()
+            return function()
+        pending = {}
+        keys = {}
+        for name, function, parameter_keys in jobs:
+            pending[pool.spawn(run, name, function)] = name
+            keys[name] = parameter_keys
+        
+        slow_parameters = {}
+        while pending:
+            gevent.wait(pending.keys(), timeout=self.collection_check_time, count=1)
+            now = time.time()
+            for result in pending.keys():
+                name = pending[result]
+                duration = now - started.get(name, now)
+                if result.ready():
+                    del pending[result]
+                    if result.successful():
+                        self.parameters.update(result.value)
+                        status = 'ok'
+                    else:
+                        logging.debug('experiment collect_parameters %s failed: %s' % (name, result.exception))
+                        for key in keys[name]:
+                            self.parameters[key] = None
+                        status = 'error'
+                elif name not in started and now - _start > self.parameter_queue_timeout:
+                    del pending[result]
+                    logging.warning('experiment collect_parameters %s did not start in %.3f s' % (name, now - _start))
+                    for key in keys[name]:
+                        self.parameters[key] = None
+                    status = 'not started'
+                elif name in started and duration > self.get_parameter_timeout(name):
+                    del pending[result]
+                    logging.warning('experiment collect_parameters %s timed out after %.3f s' % (name, duration))
+                    for key in keys[name]:
+                        self.parameters[key] = None
+                    status = 'timeout'
+                else:
+                    continue
+                if status != 'ok' or duration > self.slow_parameter_time:
+                    slow_parameters[name] = {'status': status, 'duration': duration}
+        # getters which timed out are not waited for, they finish in the pool on their own
+        
+        self.parameters['slow_parameters'] = slow_parameters
         logging.debug('collect_parameters took %s' % (time.time() - _start))
 
     def get_parameters(self):
@@ -268,6 +372,15 @@ class experiment(object):
         return '%s_parameters.pickle' % self.get_template()
     
     
+    def get_trace_filename(self):
+        return '%s_trace.jsonl' % self.get_template()
+    
+    
+    def get_observations_filename(self):
+        return '%s_observations.h5' % self.get_template()
+    
+    
+    @traced
     def save_parameters(self):
         _start = time.time()
         parameters = self.get_parameters()
@@ -291,6 +404,7 @@ class experiment(object):
                 self.parameters[parameter] = None
     
 
+    @traced
     def save_log(self, exclude_parameters=['image', 'rgbimage']):
         '''method to save the experiment details in the log file'''
         _start = time.time()
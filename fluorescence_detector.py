@@ -9,13 +9,17 @@ from goniometer import goniometer
 
 class fluorescence_detector(monitor):
     
+    observation_attributes = ['roi00_01', 'roi00_03', 'deadTime00', 'inputCountRate00', 'outputCountRate00', 'realTime00', 'eventsInRun00']
+    
     def __init__(self,
                  device_name='i11-ma-cx1/dt/dtc-mca_xmap.1',
                  channel='channel00',
-                 sleeptime=0.001):
+                 sleeptime=0.001,
+                 record_spectrum=False):
     
         self.device = PyTango.DeviceProxy(device_name)
         self.channel = channel
+        self.record_spectrum = record_spectrum
         self.goniometer = goniometer()
         self.sleeptime = sleeptime
         self._calibration = -16.1723871876, 9.93475667754, 0.0
@@ -132,26 +136,39 @@ class fluorescence_detector(monitor):
                 gevent.sleep(self.sleeptime)
                 
     
-    def get_single_observation(self, chronos=None):
+    def read_observation_attributes(self, spectrum=False):
+        '''values of the observation attributes, and of the spectrum if asked for, read in a single request'''
+        names = self.observation_attributes[:]
+        if spectrum:
+            names.append(self.channel)
+        attributes = self.device.read_attributes(names)
+        return dict([(name, attribute.value) for name, attribute in zip(names, attributes)])
+        
+    
+    def get_single_observation(self, chronos=None, spectrum=None):
+        if spectrum is None:
+            spectrum = self.record_spectrum
         measure_start_time = time.time()
         self.measure()
         measure_end_time = time.time()
         
         readout_start_time = time.time()
-        counts_in_roi = self.get_counts_in_roi()
-        counts_uptoend_roi = self.get_counts_uptoend_roi()
-        counts_compton = self.get_counts_compton_roi()
-        normalized_counts = 1000. * counts_in_roi/counts_compton
+        values = self.read_observation_attributes(spectrum=spectrum)
         readout_end_time = time.time()
-        spectrum = self.get_spectrum()
-        dead_time = self.get_dead_time()
-        input_count_rate = self.get_input_count_rate()
-        output_count_rate = self.get_output_count_rate()
-        real_time = self.get_real_time()
-        events_in_run = self.get_events_in_run()
+        
+        counts_in_roi = float(values['roi00_01'])
+        counts_compton = float(values['roi00_03'])
+        normalized_counts = 1000. * counts_in_roi/counts_compton
+        dead_time = values['deadTime00']
+        input_count_rate = float(values['inputCountRate00'])
+        output_count_rate = float(values['outputCountRate00'])
+        real_time = values['realTime00']
+        events_in_run = float(values['eventsInRun00'])
         readout_time = readout_end_time - readout_start_time
         measure_time = measure_end_time - measure_start_time
-        return [chronos + measure_time/2., spectrum, counts_in_roi, normalized_counts, dead_time, input_count_rate, output_count_rate, real_time, events_in_run, measure_time, readout_time]
+        if chronos is not None:
+            chronos += measure_time/2.
+        return [chronos, values.get(self.channel), counts_in_roi, normalized_counts, dead_time, input_count_rate, output_count_rate, real_time, events_in_run, measure_time, readout_time]
         
     
     def monitor(self, start_time):
@@ -5,6 +5,10 @@ from slits import slits1, slits2
 import pickle
 from scipy.interpolate import interp1d
 import numpy as np
+import time
+import logging
+import traceback
+import gevent
 from transmission import transmission
 from energy import energy
 from machine_status import machine_status
@@ -18,8 +22,15 @@ class flux_mockup:
         return self.flux
 
 class flux:
-
-    def __init__(self, flux_table='/usr/local/experimental_methods/flux_table.pickle', reference_current=500.):
+    '''
+    Flux estimate from the machine current, the MD2 aperture, the slits transmission, the attenuators and the energy.
+    
+    The inputs are kept in a timestamped snapshot and read from the devices only when they are older than
+    staleness seconds. start() keeps the snapshot fresh by polling in the background, so get_flux and
+    get_hypothetical_flux are answered from memory.
+    '''
+    
+    def __init__(self, flux_table='/usr/local/experimental_methods/flux_table.pickle', reference_current=500., staleness=1., sleeptime=0.5):
         
         self.table = pickle.load(open(flux_table))
         self.flux_as_f_of_energy = interp1d(self.table[:, 0], self.table[:, 1], bounds_error=False, fill_value='extrapolate')
@@ -33,8 +44,56 @@ class flux:
         self.aperture_transmission = {0: 0.95, 1: 0.822, 2: 0.287, 3: 0.134, 4: 0.081, 5: 1.}
         self.capillary_transmission = 1.
         
+        self.staleness = staleness
+        self.sleeptime = sleeptime
+        self.snapshot = {}
+        self.observe = False
+        self.poller = None
+        self.readers = {'machine_current': lambda: round(self.machine_status.get_current(), 1),
+                        'aperture': lambda: self.goniometer.md2.currentaperturediameterindex,
+                        'transmission': lambda: self.transmission.get_transmission()/100.,
+                        'energy': lambda: self.energy.get_energy(),
+                        'attenuators': lambda: self.attenuators.get_configuration()}
+    
+    def read_input(self, name):
+        value = self.readers[name]()
+        self.snapshot[name] = (time.time(), value)
+        return value
+    
+    def get_input(self, name):
+        timestamp, value = self.snapshot.get(name, (None, None))
+        if timestamp is None or time.time() - timestamp > self.staleness:
+            value = self.read_input(name)
+        return value
+    
+    def get_snapshot(self):
+        return dict([(name, self.get_input(name)) for name in self.readers])
+    
+    def refresh(self):
+        for name in self.readers:
+            try:
+                self.read_input(name)
+            except:
+                logging.debug('flux: could not read %s %s' % (name, traceback.format_exc()))
+    
+    def poll(self):
+        while self.observe == True:
+            self.refresh()
+            gevent.sleep(self.sleeptime)
+            
+    def start(self):
+        if self.poller is not None and not self.poller.dead:
+            return
+        self.observe = True
+        self.poller = gevent.spawn(self.poll)
+    
+    def stop(self):
+        self.observe = False
+        if self.poller is not None:
+            self.poller.join()
+        
     def get_current_aperture(self):
-        return self.goniometer.md2.currentaperturediameterindex
+        return self.get_input('aperture')
     
     def get_aperture_transmission(self):
         return self.aperture_transmission[self.get_current_aperture()]
@@ -43,19 +102,28 @@ class flux:
         return self.capillary_transmission
     
     def get_machine_current(self):
-        return round(self.machine_status.get_current(), 1)
+        return self.get_input('machine_current')
     
     def get_transmission(self):
-        return self.transmission.get_transmission()/100.
+        return self.get_input('transmission')
+    
+    def get_photon_energy(self):
+        return self.get_input('energy')
+    
+    def get_attenuators_transmission(self, photon_energy=None):
+        if photon_energy is None:
+            photon_energy = self.get_photon_energy()
+        return self.attenuators.get_transmission(photon_energy=photon_energy, configuration=self.get_input('attenuators'))
     
     def get_flux(self):
         current_factor = self.get_machine_current()/self.reference_current
         capillary_factor = self.get_capillary_transmission()
         aperture_factor = self.get_aperture_transmission()
         transmission = self.get_transmission()
-        attenuators_factor = self.attenuators.get_transmission()
+        photon_energy = self.get_photon_energy()
+        attenuators_factor = self.get_attenuators_transmission(photon_energy=photon_energy)
 
-        tabulated_flux = self.flux_as_f_of_energy(self.energy.get_energy())
+        tabulated_flux = self.flux_as_f_of_energy(photon_energy)
         
         return tabulated_flux * current_factor * capillary_factor * aperture_factor * attenuators_factor * transmission 
                     
@@ -70,9 +138,30 @@ class flux:
         current_factor = self.get_machine_current()/self.reference_current
         capillary_factor = self.get_capillary_transmission()
         aperture_factor = self.get_aperture_transmission()
-        attenuators_factor = self.attenuators.get_transmission()
+        attenuators_factor = self.get_attenuators_transmission(photon_energy=photon_energy)
         
         return tabulated_flux * current_factor * capillary_factor * aperture_factor * attenuators_factor * transmission 
+    
+    def get_flux_grid(self, photon_energies, transmissions=[100.], apertures=None):
+        '''
+        flux for every combination of photon_energies (eV), transmissions (percent) and aperture indices
+        (all apertures by default) at the current machine current and attenuators, 
+        returned as an array of shape (len(photon_energies), len(transmissions), len(apertures))
+        '''
+        photon_energies = np.array(photon_energies, dtype=np.float64, ndmin=1)
+        photon_energies[photon_energies < 1.e3] *= 1.e3
+        transmissions = np.array(transmissions, dtype=np.float64, ndmin=1) / 100.
+        if apertures is None:
+            apertures = sorted(self.aperture_transmission)
+        aperture_factors = np.array([self.aperture_transmission[aperture] for aperture in apertures])
+        
+        current_factor = self.get_machine_current()/self.reference_current
+        capillary_factor = self.get_capillary_transmission()
+        configuration = self.get_input('attenuators')
+        attenuators_factors = np.array([self.attenuators.get_transmission(photon_energy=photon_energy, configuration=configuration) for photon_energy in photon_energies])
+        
+        energy_factors = self.flux_as_f_of_energy(photon_energies) * attenuators_factors * current_factor * capillary_factor
+        return energy_factors[:, np.newaxis, np.newaxis] * transmissions[np.newaxis, :, np.newaxis] * aperture_factors[np.newaxis, np.newaxis, :]
         
     def set_flux(self, flux, wait=True):
         return
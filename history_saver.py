@@ -1,10 +1,8 @@
 #!/usr/bin/env python
 
 from camera import camera
-import h5py
 import time
 import os
-import numpy as np
 
 def main():
     
@@ -19,36 +17,17 @@ def main():
     
     options, args = parser.parse_args()
 
-    cam = camera()
-    s = time.time()
-    history_timestamps, history_images, history_state_vectors = cam.get_history(options.start, options.end)
-    e = time.time()
-    
-    print('history read in %.3f seconds' % (e-s))
-    print('history size %d' % len(history_timestamps))
-    
     if not os.path.isdir(options.directory):
         os.makedirs(options.directory)
         
-    s = time.time()
-    history_file = h5py.File('%s_history.h5' % os.path.join(options.directory, options.name_pattern), 'w')
-    
-    history_file.create_dataset('history_images',
-                                data=history_images, 
-                                compression='gzip',
-                                dtype=np.uint8)
-        
-    history_file.create_dataset('history_state_vectors',
-                                data=history_state_vectors)
-    
-    history_file.create_dataset('history_timestamps',
-                                data=history_timestamps)
-    
-    history_file.close()
+    cam = camera()
     
+    s = time.time()
+    history_size = cam.save_history('%s_history.h5' % os.path.join(options.directory, options.name_pattern), options.start, options.end)
     e = time.time()
     
-    print('history written in %.3f seconds' % (e-s))
+    print('history size %d' % history_size)
+    print('history read and written in %.3f seconds' % (e-s))
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
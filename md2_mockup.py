@@ -1,41 +1,387 @@
-class md2_mockup:
-    positions = ['OmegaPosition', 'AlignmentXPosition', 'AlignmentYPosition', 'AlignmentZPosition', 'CentringXPosition', 'CentringYPosition', 'CoaxialCameraZoomValue', 'ZoomPosition', 'BackLightLevel', 'FrontLightLevel', 'BackLightFactor', 'FrontLightFactor']
-    motors = ['Omega', 'AlignmentX', 'AlignmentY', 'AlignmentZ', 'CentringX', 'CentringY', 'ApertureHorizontal', 'ApertureVertical', 'CapillaryHorizontal', 'CapillaryVertical', 'ScintillatorHorizontal', 'ScintillatorVertical', 'Zoom']
-    booleans = ['DetectorGatePulseEnabled', 'CryoIsBack', 'FluoIsBack', 'SampleIsOn', 'BackLightIsOn', 'FrontLightIsOn', 'FastShutterIsEnabled', 'FastShutterIsOpen']
-    attributes = [('ScanRange', 180), ('ScanExposureTime', 1), ('ScanStartAngle', 0), ('ScanSpeed', 1), ('ScanNumberOfFrames', 1), ('MotorPositions', ('Omega=0','AlignmentX=1','AlignmentY=1','AlignmentZ=1','CentringX=1','CentringY=1'))]
-    def __init__(self):
-        for attribute in self.positions:
-            setattr(self, attribute, 0.)
-            setattr(self, attribute.lower(), 0.)
-        for motor in self.motors:
-            setattr(self, motor, None)
-            setattr(self, motor.lower(), None)
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Simulated MD2 goniometer.
+
+Motors move with trapezoidal velocity profiles given by their velocities and
+accelerations. Moves, scans and phase changes run as tasks, reported through
+istaskrunning, gettaskinfo and lasttaskinfo the way the device server does,
+and last as long as on the real instrument. Nothing runs in the background,
+positions and task states are computed from the clock when they are read.
+All durations are multiplied by time_scale.
+
+Detectors registered in scan_listeners are told when the exposure part of a
+scan starts, so that a simulated detector in exts mode produces its frames
+in step with the goniometer.
+'''
+
+import time
+import weakref
+import numpy as np
+
+class md2_value(object):
+    def __init__(self, value=None, name=None):
+        self.value = value
+        self.name = name
+
+class md2_motor_move(object):
+    '''move of a single motor, trapezoidal or, during the exposure part of scans, at constant speed'''
+    def __init__(self, start_time, start, end, velocity, acceleration, constant_speed=False, duration=None):
+        self.start_time = start_time
+        self.start = start
+        self.end = end
+        self.distance = abs(end - start)
+        self.direction = np.sign(end - start)
+        self.constant_speed = constant_speed
+        if constant_speed:
+            self.duration = duration
+            return
+        if self.distance < velocity**2 / acceleration:
+            # the motor never reaches its nominal velocity
+            velocity = np.sqrt(self.distance * acceleration)
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.ramp_time = velocity / acceleration
+        self.duration = get_move_time(self.distance, velocity, acceleration)
+
+    def get_end_time(self):
+        return self.start_time + self.duration
+
+    def get_position(self, t):
+        elapsed = t - self.start_time
+        if elapsed <= 0:
+            return self.start
+        if elapsed >= self.duration:
+            return self.end
+        if self.constant_speed:
+            return self.start + (self.end - self.start) * elapsed / self.duration
+        if elapsed < self.ramp_time:
+            travelled = 0.5 * self.acceleration * elapsed**2
+        elif elapsed < self.duration - self.ramp_time:
+            travelled = self.velocity * (elapsed - 0.5 * self.ramp_time)
+        else:
+            remaining = self.duration - elapsed
+            travelled = self.distance - 0.5 * self.acceleration * remaining**2
+        return self.start + self.direction * travelled
+
+def get_move_time(distance, velocity, acceleration):
+    distance = abs(distance)
+    if distance == 0:
+        return 0.
+    if distance < velocity**2 / acceleration:
+        return 2 * np.sqrt(distance / acceleration)
+    return distance / velocity + velocity / acceleration
+
+class md2_mockup(object):
+
+    motors = ['Omega', 'Kappa', 'Phi', 'Chi', 'AlignmentX', 'AlignmentY', 'AlignmentZ', 'CentringX', 'CentringY', 'ApertureHorizontal', 'ApertureVertical', 'CapillaryHorizontal', 'CapillaryVertical', 'ScintillatorHorizontal', 'ScintillatorVertical', 'Zoom']
+    velocities = {'Omega': 360., 'Kappa': 45., 'Phi': 90., 'Chi': 10., 'AlignmentX': 2., 'AlignmentY': 2., 'AlignmentZ': 2., 'CentringX': 1., 'CentringY': 1., 'ApertureHorizontal': 2., 'ApertureVertical': 10., 'CapillaryHorizontal': 2., 'CapillaryVertical': 10., 'ScintillatorHorizontal': 2., 'ScintillatorVertical': 10., 'Zoom': 2.}
+    accelerations = {'Omega': 1440., 'Kappa': 90., 'Phi': 360., 'Chi': 20., 'AlignmentX': 10., 'AlignmentY': 10., 'AlignmentZ': 10., 'CentringX': 5., 'CentringY': 5., 'ApertureHorizontal': 10., 'ApertureVertical': 40., 'CapillaryHorizontal': 10., 'CapillaryVertical': 40., 'ScintillatorHorizontal': 10., 'ScintillatorVertical': 40., 'Zoom': 10.}
+    positions = {'Zoom': 1., 'ApertureVertical': 83., 'CapillaryVertical': 83.}
+    phase_times = {'Centring': 6., 'DataCollection': 8., 'BeamLocation': 6., 'Transfer': 10., 'Unknown': 0.}
+    phase_positions = {'Centring': {'ApertureVertical': 83., 'CapillaryVertical': 83.},
+                       'DataCollection': {'ApertureVertical': 0., 'CapillaryVertical': 0.},
+                       'BeamLocation': {'ApertureVertical': 0., 'CapillaryVertical': 0.},
+                       'Transfer': {'ApertureVertical': 83., 'CapillaryVertical': 83.}}
+    booleans = ['DetectorGatePulseEnabled', 'CryoIsBack', 'FluoDetectorIsBack', 'SampleIsLoaded', 'SampleIsOn', 'BackLightIsOn', 'FrontLightIsOn', 'FastShutterIsEnabled', 'FastShutterIsOpen']
+    attributes = [('ScanRange', 180.), ('ScanExposureTime', 1.), ('ScanStartAngle', 0.), ('ScanSpeed', 1.), ('ScanNumberOfFrames', 1), ('ScanNumberOfPasses', 1), ('ScanAnticipation', 0.), ('CoaxialCameraZoomValue', 1), ('BackLightLevel', 0.), ('FrontLightLevel', 0.), ('BackLightFactor', 1.), ('FrontLightFactor', 1.), ('BeamPositionVertical', 0.), ('BeamPositionHorizontal', 0.), ('HeadType', 'MiniKappa')]
+
+    # time between the acceptance of a command and the start of the motion
+    command_latency = 0.05
+    # time the fast shutter takes to open before the exposure part of a scan
+    shutter_time = 0.01
+
+    scan_listeners = weakref.WeakSet()
+
+    def __init__(self, time_scale=1.):
+        self.time_scale = time_scale
+        self.moves = dict([(motor, [self.get_stop(0., self.positions.get(motor, 0.))]) for motor in self.motors])
+        self.values = {}
         for b in self.booleans:
-            setattr(self, b, False)
-            setattr(self, b.lower(), False)
-        for attribute in self.attributes:
-            setattr(self, attribute[0], attribute[1])
-            setattr(self, attribute[0].lower(), attribute[1])
+            self.values[b.lower()] = False
+        for name, value in self.attributes:
+            self.values[name.lower()] = value
+        self.tasks = {}
+        self.task_id = 0
+        self.last_task_id = None
+        self.phase = 'Centring'
+        self.motor_names = dict([(motor.lower(), motor) for motor in self.motors])
+
+    # tango attributes are case insensitive, positions are computed on the fly
+    def __getattr__(self, name):
+        lower = name.lower()
+        values = self.__dict__.get('values', {})
+        if lower.endswith('position') and lower[:-len('position')] in self.__dict__.get('motor_names', {}):
+            return self.get_motor_position(self.motor_names[lower[:-len('position')]])
+        if lower in values:
+            return values[lower]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        lower = name.lower()
+        if lower.endswith('position') and lower[:-len('position')] in self.__dict__.get('motor_names', {}):
+            self.startSimultaneousMoveMotors('%s=%s' % (self.motor_names[lower[:-len('position')]], value))
+        elif lower in self.__dict__.get('values', {}):
+            self.values[lower] = value
+        else:
+            object.__setattr__(self, name, value)
+
+    def read_attribute(self, name):
+        lower = name.lower()
+        if lower == 'state':
+            return md2_value(value=md2_value(name=self.get_state()))
+        if lower == 'status':
+            return md2_value(value=self.get_status())
+        return md2_value(value=getattr(self, name))
+
+    def write_attribute(self, name, value):
+        setattr(self, name, value)
+
+    def now(self):
+        return time.time()
+
+    def scale(self, duration):
+        return duration * self.time_scale
+
+    # motors
+    def get_stop(self, t, position):
+        return md2_motor_move(t, position, position, 1., 1.)
+
+    def get_motor_position(self, motor, t=None):
+        if t is None:
+            t = self.now()
+        moves = self.moves[motor]
+        for move in moves[::-1]:
+            if move.start_time <= t:
+                return move.get_position(t)
+        return moves[0].start
+
+    def add_move(self, motor, move):
+        '''appends a move to the trajectory of motor, forgetting the moves finished before now'''
+        now = self.now()
+        moves = [m for m in self.moves[motor] if m.start_time < move.start_time]
+        finished = [m for m in moves if m.get_end_time() <= now]
+        self.moves[motor] = finished[-1:] + [m for m in moves if m.get_end_time() > now] + [move]
+        return move.get_end_time()
+
+    def get_motor_positions(self, t=None):
+        if t is None:
+            t = self.now()
+        return dict([(motor, self.get_motor_position(motor, t)) for motor in self.motors])
+
+    @property
+    def motorpositions(self):
+        t = self.now()
+        return tuple(['%s=%.6f' % (motor, self.get_motor_position(motor, t)) for motor in self.motors])
+
+    MotorPositions = motorpositions
+
     def getMotorState(self, motor_name):
-        return
-    def startscan(self):
-        return
-    def startscanex(self, parameters):
-        return
-    def startsetphase(self, phase_name):
-        return
-    def gettaskinfo(self, task_id):
-        return
-    def istaskrunning(self, task_id):
-        return False
-    def setStartScan4DEx(self, parameters):
-        return
+        if self.now() < self.moves[motor_name][-1].get_end_time():
+            return md2_value(name='MOVING')
+        return md2_value(name='STANDBY')
+
     def get_motor_state(self, motor_name):
-        return
-    def setstartscan4d(self, start):
-        return
-    def setstopscan4d(self, start):
-        return
+        return self.getMotorState(motor_name).name
+
+    def move_motor(self, motor, destination, start_time):
+        start = self.get_motor_position(motor, start_time)
+        return self.add_move(motor, md2_motor_move(start_time, start, destination, self.velocities[motor] / self.time_scale, self.accelerations[motor] / self.time_scale**2))
+
+    def move_motors(self, destinations, start_time):
+        end = start_time
+        for motor in destinations:
+            end = max(end, self.move_motor(motor, destinations[motor], start_time))
+        return end
+
+    def scan_motors(self, starts, stops, start_time, duration):
+        '''moves motors at constant speed from starts to stops'''
+        for motor in starts:
+            self.add_move(motor, md2_motor_move(start_time, starts[motor], stops[motor], None, None, constant_speed=True, duration=duration))
+        return start_time + duration
+
+    def get_ramp_time(self, motor, speed):
+        '''time to get motor up to speed, speed being expressed in scaled time'''
+        return abs(speed) * self.time_scale**2 / self.accelerations[motor]
+
+    # tasks
+    def start_task(self, name, duration, end=None):
+        if self.is_busy():
+            raise RuntimeError('MD2 busy, task %d still running' % self.last_task_id)
+        self.task_id += 1
+        start = self.now()
+        if end is None:
+            end = start + self.scale(duration)
+        self.tasks[self.task_id] = {'name': name, 'start': start, 'end': end}
+        self.last_task_id = self.task_id
+        return self.task_id
+
+    def is_busy(self):
+        return self.last_task_id is not None and self.istaskrunning(self.last_task_id)
+
+    def istaskrunning(self, task_id):
+        task = self.tasks.get(task_id)
+        return task is not None and self.now() < task['end']
+
+    def get_time_string(self, t):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) + ('%.3f' % (t % 1))[1:]
+
+    def gettaskinfo(self, task_id):
+        task = self.tasks[task_id]
+        if self.now() < task['end']:
+            end, result = 'null', 'null'
+        else:
+            end, result = self.get_time_string(task['end']), '1'
+        return [task['name'], '0', self.get_time_string(task['start']), end, result, 'null', str(task_id)]
+
+    @property
+    def lasttaskinfo(self):
+        if self.last_task_id is None:
+            return ['null', '0', 'null', 'null', 'null', 'null', 'null']
+        return self.gettaskinfo(self.last_task_id)
+
+    def abort(self):
+        t = self.now()
+        for motor in self.motors:
+            self.moves[motor] = [self.get_stop(t, self.get_motor_position(motor, t))]
+        if self.is_busy():
+            self.tasks[self.last_task_id]['end'] = t
+
+    def get_state(self):
+        if self.is_busy():
+            return 'RUNNING'
+        if any([self.now() < moves[-1].get_end_time() for moves in self.moves.values()]):
+            return 'MOVING'
+        return 'STANDBY'
+
+    def get_status(self):
+        if self.is_busy():
+            return 'Running'
+        return 'Ready'
+
+    def get_state_object(self):
+        return md2_value(name=self.get_state())
+
+    State = property(get_state_object)
+    Status = property(get_status)
+
+    # commands
+    def parse_motor_positions(self, command_string):
+        destinations = {}
+        for item in command_string.split(','):
+            motor, value = item.split('=')
+            destinations[motor.strip()] = float(value)
+        return destinations
+
+    def startSimultaneousMoveMotors(self, command_string):
+        destinations = self.parse_motor_positions(command_string)
+        task_id = self.start_task('Move', 0)
+        start = self.now() + self.scale(self.command_latency)
+        self.tasks[task_id]['end'] = self.move_motors(destinations, start)
+        return task_id
+
+    def startsetphase(self, phase_name):
+        task_id = self.start_task('Set phase %s' % phase_name, self.phase_times.get(phase_name, 0.))
+        end = self.move_motors(self.phase_positions.get(phase_name, {}), self.now() + self.scale(self.command_latency))
+        self.tasks[task_id]['end'] = max(end, self.tasks[task_id]['end'])
+        self.phase = phase_name
+        return task_id
+
+    @property
+    def currentphase(self):
+        if self.is_busy():
+            return 'Unknown'
+        return self.phase
+
+    def notify_scan_listeners(self, trigger_times, exposure_time):
+        for listener in list(self.scan_listeners):
+            listener.goniometer_scan_started(trigger_times, exposure_time)
+
+    def schedule_scan(self, name, starts, stops, exposure_time, number_of_passes=1):
+        '''moves the motors to their starts, scans them at constant speed to their stops in exposure_time and back for further passes'''
+        task_id = self.start_task(name, 0)
+        exposure_time = self.scale(exposure_time)
+        t = self.now() + self.scale(self.command_latency)
+        speeds = {}
+        for motor in starts:
+            speeds[motor] = abs(stops[motor] - starts[motor]) / exposure_time if exposure_time > 0 else 0.
+        # all motors get up to speed together, in the time needed by the slowest one
+        ramp_time = max([0.] + [self.get_ramp_time(motor, speeds[motor]) for motor in starts])
+        trigger_times = []
+        for k in range(number_of_passes):
+            if k % 2 == 0:
+                begin, end = starts, stops
+            else:
+                begin, end = stops, starts
+            run_up = dict([(motor, begin[motor] - np.sign(end[motor] - begin[motor]) * 0.5 * speeds[motor] * ramp_time) for motor in begin])
+            t = self.move_motors(run_up, t)
+            t = self.scan_motors(run_up, begin, t, ramp_time)
+            t += self.scale(self.shutter_time)
+            trigger_times.append(t)
+            t = self.scan_motors(begin, end, t, exposure_time)
+            t += ramp_time
+        self.tasks[task_id]['end'] = t
+        self.notify_scan_listeners(trigger_times, exposure_time)
+        return task_id
+
+    def startscanex(self, parameters):
+        frame_number, start_angle, scan_range, exposure_time, number_of_passes = parameters
+        start_angle, scan_range, exposure_time = float(start_angle), float(scan_range), float(exposure_time)
+        return self.schedule_scan('Scan', {'Omega': start_angle}, {'Omega': start_angle + scan_range}, exposure_time, int(number_of_passes))
+
+    def startscan(self):
+        return self.startscanex([self.scannumberofframes, self.scanstartangle, self.scanrange, self.scanexposuretime, self.scannumberofpasses])
+
+    def startScan4DEx(self, parameters):
+        start_angle, scan_range, exposure_time, start_y, start_z, start_cx, start_cy, stop_y, stop_z, stop_cx, stop_cy = map(float, parameters)
+        starts = {'Omega': start_angle, 'AlignmentY': start_y, 'AlignmentZ': start_z, 'CentringX': start_cx, 'CentringY': start_cy}
+        stops = {'Omega': start_angle + scan_range, 'AlignmentY': stop_y, 'AlignmentZ': stop_z, 'CentringX': stop_cx, 'CentringY': stop_cy}
+        return self.schedule_scan('Helical scan', starts, stops, exposure_time)
+
+    def setstartscan4d(self):
+        self.scan_4d_start = self.get_motor_positions()
+
+    def setstopscan4d(self):
+        self.scan_4d_stop = self.get_motor_positions()
+
+    def startscan4d(self):
+        motors = ['AlignmentY', 'AlignmentZ', 'CentringX', 'CentringY']
+        start, stop = self.scan_4d_start, self.scan_4d_stop
+        parameters = [self.scanstartangle, self.scanrange, self.scanexposuretime] + [start[m] for m in motors] + [stop[m] for m in motors]
+        return self.startScan4DEx(parameters)
+
+    def startRasterScan(self, parameters):
+        '''vertical lines scanned one after the other, each one in ScanExposureTime while omega sweeps ScanRange'''
+        vertical_range, horizontal_range, number_of_rows, number_of_columns, direction_inversion = parameters
+        number_of_columns = int(number_of_columns)
+        task_id = self.start_task('Raster scan', 0)
+        exposure_time = self.scale(float(self.scanexposuretime))
+        center = self.get_motor_positions()
+        t = self.now() + self.scale(self.command_latency)
+        trigger_times = []
+        for column in range(number_of_columns):
+            if number_of_columns > 1:
+                y = center['AlignmentY'] - horizontal_range/2. + column * horizontal_range / (number_of_columns - 1)
+            else:
+                y = center['AlignmentY']
+            z_start, z_stop = center['AlignmentZ'] - vertical_range/2., center['AlignmentZ'] + vertical_range/2.
+            if direction_inversion and column % 2 == 1:
+                z_start, z_stop = z_stop, z_start
+            omega_start = float(self.scanstartangle)
+            t = self.move_motors({'AlignmentY': y, 'AlignmentZ': z_start, 'Omega': omega_start}, t)
+            t += self.scale(self.shutter_time)
+            trigger_times.append(t)
+            t = self.scan_motors({'AlignmentZ': z_start, 'Omega': omega_start}, {'AlignmentZ': z_stop, 'Omega': omega_start + float(self.scanrange)}, t, exposure_time)
+        self.tasks[task_id]['end'] = t
+        self.notify_scan_listeners(trigger_times, exposure_time)
+        return task_id
+
     def savecentringpositions(self):
         return
 
+    def saveaperturebeamposition(self):
+        return
+
+    def savecapillarybeamposition(self):
+        return
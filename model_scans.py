@@ -22,17 +22,12 @@ rc('font', **{'family':'serif','serif':['Palatino']})
 rc('text', usetex=True)
 
 from plot_scans import get_gap, get_slit_opening, get_ring_current
+import undulator_model
 
 
-def residual(x, data_matrix):
-    k0, k1, k2 = x
-    data = pickle.load(open(data_matrix))
-    theory = []
-    for gap, n in data[:, 0:2]:
-        theory.append(undulator_peak_energy(gap, n, k0=k0, k1=k1, k2=k2))
-    theory = np.array(theory)
-    experiment = data[:, 2]
-    return 1. / (2 * len(theory)) * np.sum((experiment - theory) ** 2)
+def residual(x, data):
+    diff = undulator_model.residual(x, data[:, 0], data[:, 1], data[:, 2])
+    return 1. / (2 * len(diff)) * np.sum(diff ** 2)
 
 def residual2(x, gaps, bs):
     k0, k1, k2 = x
@@ -63,11 +58,7 @@ def get_lambda_harmonic(lambda_peak, n, N=80, detune=False):
 
 
 def undulator_peak_energy(gap, n, k0=2.72142696, k1=-3.83321034, k2=0.6322541, N=80, detune=False):
-    if detune:
-        detune_parameter = 1 - 1 / (n * N)
-    else:
-        detune_parameter = 1
-    return undulator_harmonic_energy(gap, n, k0=k0, k1=k1, k2=k2) * detune_parameter
+    return undulator_model.peak_energy(gap, n, (k0, k1, k2), N=N, detune=detune)
 
 
 def undulator_magnetic_field(gap, k0=2.72142696, k1=-3.83321034, k2=0.6322541, period_length=24.):
@@ -92,10 +83,7 @@ def undulator_strength_from_peak_position(peak_energy, n, electron_energy=2.75,
 
     
 def undulator_harmonic_energy(gap, n, k0=2.72142696, k1=-3.83321034, k2=0.6322541, period_length=24.0, electron_energy=2.75):
-    k = 1e-3 * elementary_charge / (electron_mass * speed_of_light * 2 * pi)
-    B = undulator_magnetic_field(
-        gap, k0=k0, k1=k1, k2=k2, period_length=period_length)
-    return 1000 * 9.5 * n * electron_energy ** 2 / (period_length * (1 + undulator_strength(B) ** 2 / 2))
+    return undulator_model.peak_energy(gap, n, (k0, k1, k2), period_length=period_length, electron_energy=electron_energy)
 
 
 def undulator_peak_intensity(gap, n, k0=2.72142696, k1=-3.83321034, k2=0.6322541, period_length=24., N=80):
@@ -151,9 +139,13 @@ def get_experimental_peaks(theory, exp_energy, exp_flux, gap, data):
     return peak_positions
 
 
-def fit(data_matrix, method='powell'):
+def fit(data_matrix, method='leastsq'):
     x0 = 2.73096921, -3.84082989,  0.60382274
-    result = minimize(residual, x0, args=(data_matrix,), method=method)
+    data = undulator_model.load_data_matrix(data_matrix)
+    if method == 'leastsq':
+        result = undulator_model.fit_peaks(data, x0)
+    else:
+        result = minimize(residual, x0, args=(data,), method=method)
     print result
     return result
 
@@ -513,10 +505,11 @@ def main():
     parser.add_option('-d', '--data_matrix', default='data_0.1x0.1mm_450mA.pkl', type=str, help='Data matrix file')
     parser.add_option('-f', '--fit', action='store_true', help='Perform a fit and print out the fitted parameters')
     parser.add_option('-p', '--plot', action='store_true', help='Show the results and generate figures') 
+    parser.add_option('-m', '--method', default='leastsq', type=str, help='Fit method, leastsq or any method of scipy.optimize.minimize (default=%default)')
     options, args = parser.parse_args()
     print options, args
     if options.fit:
-        fit(options.data_matrix)
+        fit(options.data_matrix, method=options.method)
     else:
         plot(options.data_matrix)
 
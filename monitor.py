@@ -12,11 +12,13 @@ from scipy.constants import elementary_charge as q
 from scipy.optimize import leastsq
 
 from motor import tango_motor, tango_named_positions_motor
+from ring_buffer import ring_buffer
+from sequence_overlap import find_overlap, merge_overlapping
 import redis
 
 class monitor:
     
-    def __init__(self, integration_time=None, sleeptime=0.05, use_redis=False, name='monitor', history_size_threshold=1000):
+    def __init__(self, integration_time=None, sleeptime=0.05, use_redis=False, name='monitor', history_size_threshold=1000, history_backend=None, history_dtype=np.float64):
         self.integration_time = integration_time
         self.sleeptime = sleeptime
         self.observe = None
@@ -24,6 +26,11 @@ class monitor:
         self.use_redis = use_redis
         self.name = name
         self.history_size_threshold = history_size_threshold
+        if history_backend is None:
+            history_backend = 'redis' if use_redis else 'mmap'
+        self.history_backend = history_backend
+        self.history_dtype = history_dtype
+        self.history = None
         if self.use_redis == True:
             self.redis = redis.StrictRedis()
             self.last_data_key = '%s_last_data' % self.name
@@ -94,59 +101,36 @@ class monitor:
             self.observations.append([chronos, point])
             gevent.sleep(self.sleeptime)
     
-    def can_clear_history(self):
-        current_history_size = self.redis.llen(self.history_timestamp_key)
-        return current_history_size > self.history_size_threshold * 1.2 and self.redis.get(self.clear_flag_key) == '1' or current_history_size >= 2*self.history_size_threshold
+    def get_history_buffer(self):
+        if self.history is None:
+            self.history = ring_buffer('%s_history' % self.name, capacity=self.history_size_threshold, dtype=self.history_dtype, backend=self.history_backend)
+        return self.history
     
     def run_history(self):
+        history = self.get_history_buffer()
         while True:
             last_point_data = self.get_point()
             last_point_timestamp = time.time()
-            self.redis.set(self.last_data_key, last_point_data)
-            self.redis.set(self.last_timestamp_key, last_point_timestamp)
-            self.redis.rpush(self.history_data_key, last_point_data)
-            self.redis.rpush(self.history_timestamp_key, last_point_timestamp)
-            
-            if self.can_clear_history():
-                for item in [self.history_data_key, self.history_timestamp_key]:
-                    self.redis.ltrim(item, self.history_size_threshold, self.redis.llen(item))
-                    
+            if self.redis is not None:
+                self.redis.set(self.last_data_key, last_point_data)
+                self.redis.set(self.last_timestamp_key, last_point_timestamp)
+            history.append(last_point_timestamp, last_point_data)
             gevent.sleep(self.sleeptime)
            
     def get_history(self, start=-np.inf, end=np.inf):
-        self.redis.set(self.clear_flag_key, 0)
         try:
-            timestamps = np.array([float(self.redis.lindex(self.history_timestamp_key, i)) for i in range(self.redis.llen(self.history_timestamp_key))])
-            
-            mask = np.logical_and(timestamps>=start, timestamps<=end)
-            
-            interesting_stamps = np.array( [float(self.redis.lindex(self.history_timestamp_key, int(i))) for i in np.argwhere(mask)] )
-            
-            interesting_points = np.array([self.get_rgbimage(image_data=self.redis.lindex(self.history_data_key, int(i))) for i in np.argwhere(mask)])
-            
+            interesting_stamps, interesting_points = self.get_history_buffer().get_window(start, end)
         except:
             interesting_stamps = np.array([])
             interesting_points = np.array([])
-            
-        self.redis.set(self.clear_flag_key, 1)
         
         return interesting_stamps, interesting_points
     
     def get_point_corresponding_to_timestamp(self, timestamp):
-        self.redis.set(self.clear_flag_key, 0)
         try:
-            timestamps = np.array([float(self.redis.lindex(self.history_timestamp_key, i)) for i in range(self.redis.llen(self.history_timestamp_key))])
-            
-            timestamps_before = timestamps[timestamps <= timestamp]
-            
-            closest = np.argmin(np.abs(timestamps_before - timestamp))
-            
-            corresponding_point = self.get_rgbimage(image_data=self.redis.lindex(self.history_data_key, int(closest)))
-                        
+            point_timestamp, corresponding_point = self.get_history_buffer().get_record_before(timestamp)
         except:
             corresponding_point = self.get_point()
-        
-        self.redis.set(self.clear_flag_key, 1)
     
         return corresponding_point
     
@@ -176,23 +160,14 @@ class monitor:
         return map(float, character_sequence.split(';'))
         
     def merge_two_overlapping_number_sequences(self, r1, r2, alignment_length=1000, separator=';'):
-        c1 = self.from_number_sequence_to_character_sequence(r1)
-        c2 = self.from_number_sequence_to_character_sequence(r2)
-        c, start = self.merge_two_overlapping_character_sequences(c1, c2, alignment_length)
-        r = self.from_character_sequence_to_number_sequence(c)
-        return r, start
+        return merge_overlapping(r1, r2)
     
     def find_overlap(self, r1, r2, alignment_length=1000, separator=';'):
-        c1 = self.from_number_sequence_to_character_sequence(r1)
-        c2 = self.from_number_sequence_to_character_sequence(r2)
-        start = c1.index(c2[:alignment_length])
-        start = c2.count(separator) - c2[start:].count(separator)
-        return start
+        return find_overlap(r1, r2)
     
     def merge_two_overlapping_buffers(self, seq1, seq2, alignment_length=1000):
-        start = seq1.index(seq2[:alignment_length])
-        merged = seq1[:start] + seq2 
-        return merged, (len(merged) - len(seq1))/8
+        merged, new_values = merge_overlapping(seq1, seq2)
+        return merged.tostring(), new_values
     
 class counter(monitor):
     
@@ -290,7 +265,7 @@ class sai(monitor):
     def run_history(self):
         for channel in range(self.number_of_channels):
             for key in self.keys[channel]:
-                self.redis.set(key, 0)
+                self.redis.delete(key)
         
         self.redis.set(self.clear_flag_key, 1)
         
@@ -301,33 +276,29 @@ class sai(monitor):
                 last_point_data = self.get_historized_channel_values(channel) # about 1ms
                 last_timestamp = time.time()
                 
-                last_point_data_buffer = last_point_data.tostring() # 2.5 us
-                history_data = self.redis.get(history_data_key)
+                history_size = self.redis.strlen(history_data_key)/8
                 
-                if history_data != '0':
-                    history_data, new_values = self.merge_two_overlapping_buffers(history_data, last_point_data_buffer)
+                if history_size > 0:
+                    history_tail = self.redis.getrange(history_data_key, -8*len(last_point_data), -1)
+                    new_values = find_overlap(history_tail, last_point_data)
                     previous_timestamp = float(self.redis.get(last_timestamp_key))
-                    history_timestamp = self.redis.get(history_timestamp_key)
                 else:
-                    history_data, new_values = last_point_data_buffer, len(last_point_data)
+                    new_values = len(last_point_data)
                     previous_timestamp = last_timestamp - new_values*self.get_integration_time()*1.e-3
-                    history_timestamp = ''
-                
-                new_history_timestamps = np.linspace(last_timestamp, previous_timestamp, new_values, endpoint=False)[::-1]
-                                
-                history_timestamp += new_history_timestamps.tostring()
                 
-                self.redis.set(last_timestamp_key, last_timestamp)
-                self.redis.set(history_data_key, history_data)
-                self.redis.set(history_timestamp_key, history_timestamp)
+                if new_values > 0:
+                    new_history_timestamps = np.linspace(last_timestamp, previous_timestamp, new_values, endpoint=False)[::-1]
+                    self.redis.append(history_data_key, np.asarray(last_point_data[-new_values:], dtype=np.float64).tostring())
+                    self.redis.append(history_timestamp_key, new_history_timestamps.tostring())
+                    self.redis.set(last_timestamp_key, last_timestamp)
                 
-                self.history_sizes[channel] = len(history_data)/8
+                self.history_sizes[channel] = history_size + new_values
             
             if np.any(self.history_sizes > 1.2*self.history_size_threshold) and self.redis.get(self.clear_flag_key) == '1' or self.history_sizes.max() > 2*self.history_size_threshold: 
                 for channel in range(self.number_of_channels):
                     last_timestamp_key, history_timestamp_key, history_data_key = self.keys[channel]
-                    self.redis.set(history_timestamp_key, history_timestamp[-self.history_size_threshold:])
-                    self.redis.set(history_data_key, history_data[-self.history_size_threshold:])
+                    for key in [history_timestamp_key, history_data_key]:
+                        self.redis.set(key, self.redis.getrange(key, -8*int(self.history_size_threshold), -1))
                         
             gevent.sleep(self.sleeptime)
 
@@ -148,6 +148,9 @@ class monochromator_pitch_scan(xray_experiment):
         f.close()
         
     def save_results(self):        
+        if os.path.isfile(self.get_observations_filename()):
+            # recorded in the observation store during the scan
+            return
         f = open(os.path.join(self.directory, '%s_results.pickle' % self.name_pattern), 'w')
         pickle.dump(self.get_results(), f)
         f.close()
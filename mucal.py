@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import re
 import numpy as np
 
 #/* mucal.c, version 1.2 
@@ -1429,6 +1430,32 @@ n_fit = {
 #*            E N D   O F    D A T A   S E C T I O N
 #************************************************************************/
 
+#/*--------------------------------------------------------------- 
+#* tables indexed by Z, precompiled into contiguous arrays for the
+#* vectorised mucal_array (row 0 is unused)
+#*---------------------------------------------------------------*/ 
+
+zmax = 94
+no_data = [85, 86, 87, 88, 89, 91, 93]
+
+element_z = dict([(name, z+1) for z, name in enumerate(element)])
+
+def compile_table(table):
+    width = np.size(table[1])
+    compiled = np.zeros((zmax + 1, width))
+    for z in table:
+        compiled[z] = table[z]
+    return np.ascontiguousarray(compiled.squeeze())
+
+# columns: k, l1, l2, l3 and m edge energies in keV
+edges_table = np.ascontiguousarray(np.vstack([compile_table(table) for table in [k_edge, l1_edge, l2_edge, l3_edge, m_edge]]).T)
+# rows: k, l, m and n shell photoelectric fits, coherent and incoherent fits
+fits_table = np.ascontiguousarray(np.stack([compile_table(table) for table in [k_fit, l_fit, m_fit, n_fit, xsect_coh, xsect_ncoh]], axis=1))
+at_weight_table = compile_table(at_weight)
+density_table = compile_table(density)
+conv_fac_table = compile_table(conv_fac)
+
+
 
 #/*--------------------------------------------------------------- 
  #* name_z 
@@ -1442,7 +1469,10 @@ def name_z(name):
     name = name[:2]
     name = name.lower()
     name = name.capitalize()
-    return element.index(name) + 1
+    try:
+        return element_z[name]
+    except KeyError:
+        raise ValueError('%s is not a known element' % name)
 
 #/*--------------------------------------------------------------- 
 #* mcmaster
@@ -1471,7 +1501,7 @@ def mucal(name, ephot, unit='a'):
     Z = name_z(name)
     
     if Z in [85, 86, 87, 88, 89, 91, 93] or Z > len(element):
-        print('no data for element %s (atomic number %d)' % (name, ZZ))
+        print('no data for element %s (atomic number %d)' % (name, Z))
         return
     
     if ephot<0.:
@@ -1552,3 +1582,75 @@ def mucal(name, ephot, unit='a'):
     return energy, xsec, fluo
 
 
+#/*--------------------------------------------------------------- 
+#* mucal_array
+#*    vectorised version of mucal for an element or a compound
+#*    and an array of photon energies
+#*---------------------------------------------------------------*/ 
+
+def mcmaster_array(log_e, coefficients):
+    '''McMaster fit evaluated by Horner's scheme, coefficients has shape log_e.shape + (4,) or (4,)'''
+    xsec = np.zeros(np.shape(log_e))
+    for k in range(coefficients.shape[-1] - 1, -1, -1):
+        xsec = xsec * log_e + coefficients[..., k]
+    return np.exp(xsec)
+
+def element_cross_sections(Z, ephot):
+    '''photoelectric, coherent and incoherent cross sections in barns/atom of element Z at photon energies ephot (keV)'''
+    if Z < 1 or Z > zmax or Z in no_data:
+        raise ValueError('no data for element of atomic number %d' % Z)
+    log_e = np.log(ephot)
+    log_e[ephot == 1.] = 1. # as in mcmaster
+    k, l1, l2, l3, m = edges_table[Z]
+    shell = np.select([ephot >= k, ephot >= l3, ephot >= m], [0, 1, 2], 3)
+    photo = mcmaster_array(log_e, fits_table[Z][shell])
+    l_shell = shell == 1
+    photo[l_shell & (ephot < l1) & (ephot >= l2)] /= l1_jump
+    photo[l_shell & (ephot < l2)] /= (l1_jump * l2_jump)
+    coh = mcmaster_array(log_e, fits_table[Z, 4])
+    ncoh = mcmaster_array(log_e, fits_table[Z, 5])
+    return photo, coh, ncoh
+
+def get_mass_fractions(material):
+    '''material is an element ('Fe'), a chemical formula ('Si3N4') or a dictionary of mass fractions ({'C': 0.9, 'H': 0.1})'''
+    if isinstance(material, dict):
+        total = float(sum(material.values()))
+        return dict([(name_z(name), fraction/total) for name, fraction in material.items()])
+    counts = {}
+    for name, count in re.findall('([A-Z][a-z]?)([0-9]*\.?[0-9]*)', material.strip()):
+        Z = name_z(name)
+        counts[Z] = counts.get(Z, 0.) + (float(count) if count else 1.)
+    if not counts:
+        raise ValueError('could not parse material %s' % material)
+    masses = dict([(Z, count * at_weight_table[Z]) for Z, count in counts.items()])
+    total = sum(masses.values())
+    return dict([(Z, mass/total) for Z, mass in masses.items()])
+
+def mucal_array(material, ephot, unit='a', density=None):
+    '''
+    returns photoelectric, coherent, incoherent and total cross sections and the
+    absorption coefficient mu (cm^-1) of material at photon energies ephot (keV)
+    as a dictionary of arrays of the shape of ephot.
+    
+    For a single element the cross sections are in barns/atom (unit 'a') or cm^2/g (unit 'c')
+    and the tabulated density is used unless density (g/cm^3) is given. For compounds the cross
+    sections are always in cm^2/g and mu is nan unless density is given.
+    '''
+    ephot = np.array(ephot, dtype=np.float64, ndmin=1)
+    if np.any(ephot <= 0.):
+        raise ValueError('photon energy must be positive')
+    fractions = get_mass_fractions(material)
+    single = len(fractions) == 1
+    result = dict([(key, np.zeros(ephot.shape)) for key in ['photo', 'coh', 'ncoh', 'total', 'mu']])
+    for Z, fraction in fractions.items():
+        for key, barns in zip(['photo', 'coh', 'ncoh'], element_cross_sections(Z, ephot)):
+            result[key] += fraction * barns / conv_fac_table[Z]
+    result['total'] = result['photo'] + result['coh'] + result['ncoh']
+    if density is None:
+        density = density_table[list(fractions)[0]] if single else np.nan
+    result['mu'] = result['total'] * density
+    if single and unit.lower() != 'c':
+        Z = list(fractions)[0]
+        for key in ['photo', 'coh', 'ncoh', 'total']:
+            result[key] *= conv_fac_table[Z]
+    return result
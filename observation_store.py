@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Columnar store of monitor observations.
+
+Observations of a monitor are rows, e.g. [chronos, point], with the names of
+the columns given by its observation_fields. Each monitor gets an HDF5 group
+and each field a dataset, so that reading chronos and one monitor column
+does not touch the spectra or images stored next to them.
+
+Rows are appended during the scan into chunked, extensible datasets. When
+the store is closed, datasets up to compact_limit bytes are rewritten
+contiguous, and get_column can then memory-map them directly.
+
+Scalars are stored as float64, arrays keep their shape and dtype, anything
+else (strings, dictionaries, rows of varying shapes) is pickled. Missing
+values (None) become nan in float columns and 0 in integer columns.
+'''
+
+import os
+import pickle
+import logging
+import numpy as np
+import h5py
+
+class observation_store(object):
+
+    def __init__(self, filename, mode='r', flush_size=100, compact_limit=2**29):
+        self.filename = filename
+        self.mode = mode
+        self.flush_size = flush_size
+        self.compact_limit = compact_limit
+        self.file = h5py.File(filename, mode)
+        self.buffers = {}
+
+    # writing
+    def create_group(self, name, observation_fields):
+        group = self.file.require_group(name)
+        group.attrs['observation_fields'] = np.array([str(field) for field in observation_fields], dtype='S')
+        return group
+
+    def get_kind(self, value):
+        if isinstance(value, (bool, int, long, float, np.number, np.bool_)):
+            return 'scalar', None, np.float64
+        try:
+            array = np.asarray(value)
+        except:
+            return 'pickle', None, None
+        if array.dtype.kind in 'biuf' and array.ndim > 0:
+            return 'array', array.shape, array.dtype
+        return 'pickle', None, None
+
+    def create_column(self, group, field, values):
+        defined = [value for value in values if value is not None]
+        if defined:
+            kind, shape, dtype = self.get_kind(defined[0])
+        else:
+            kind, shape, dtype = 'scalar', None, np.float64
+        if kind == 'pickle':
+            dataset = group.create_dataset(field, shape=(0,), maxshape=(None,), chunks=(256,), dtype=h5py.special_dtype(vlen=np.dtype('uint8')))
+        else:
+            shape = shape or ()
+            row_bytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            chunk_rows = max(1, min(1024, 2**20 // row_bytes))
+            dataset = group.create_dataset(field, shape=(0,) + shape, maxshape=(None,) + shape, chunks=(chunk_rows,) + shape, dtype=dtype)
+        dataset.attrs['kind'] = kind
+        return dataset
+
+    def get_rows(self, dataset, values):
+        kind = dataset.attrs['kind']
+        if kind == 'pickle':
+            return [np.frombuffer(pickle.dumps(value, 2), dtype=np.uint8) for value in values]
+        fill = np.nan if dataset.dtype.kind == 'f' else 0
+        if kind == 'scalar':
+            return np.array([fill if value is None else value for value in values], dtype=dataset.dtype)
+        rows = np.empty((len(values),) + dataset.shape[1:], dtype=dataset.dtype)
+        for k, value in enumerate(values):
+            value = None if value is None else np.asarray(value)
+            if value is None or value.shape != dataset.shape[1:]:
+                if value is not None:
+                    logging.warning('observation_store %s: row of shape %s does not fit column of shape %s' % (dataset.name, value.shape, dataset.shape[1:]))
+                rows[k] = fill
+            else:
+                rows[k] = value
+        return rows
+
+    def append(self, name, observation_fields, observations):
+        '''appends rows of observations of the monitor name, written by bunches of flush_size rows'''
+        if name not in self.buffers:
+            self.buffers[name] = (list(observation_fields), [])
+        self.buffers[name][1].extend(observations)
+        if len(self.buffers[name][1]) >= self.flush_size:
+            self.flush(name)
+
+    def flush(self, name=None):
+        names = self.buffers.keys() if name is None else [name]
+        for name in names:
+            observation_fields, rows = self.buffers[name]
+            if not rows:
+                continue
+            group = self.create_group(name, observation_fields)
+            for k, field in enumerate(observation_fields):
+                values = [row[k] if len(row) > k else None for row in rows]
+                if field in group:
+                    dataset = group[field]
+                else:
+                    dataset = self.create_column(group, field, values)
+                new_rows = self.get_rows(dataset, values)
+                start = dataset.shape[0]
+                dataset.resize(start + len(values), axis=0)
+                if dataset.attrs['kind'] == 'pickle':
+                    for i, row in enumerate(new_rows):
+                        dataset[start + i] = row
+                else:
+                    dataset[start:] = new_rows
+            self.buffers[name] = (observation_fields, [])
+        self.file.flush()
+
+    def compact(self):
+        '''rewrites the chunked numeric datasets contiguous, so that they can be memory-mapped'''
+        for name in self.get_monitor_names():
+            group = self.file[name]
+            for field in group:
+                dataset = group[field]
+                if dataset.attrs['kind'] == 'pickle' or dataset.chunks is None or dataset.size * dataset.dtype.itemsize > self.compact_limit:
+                    continue
+                data = dataset[()]
+                attrs = dict(dataset.attrs)
+                del group[field]
+                dataset = group.create_dataset(field, data=data)
+                for key, value in attrs.items():
+                    dataset.attrs[key] = value
+
+    def close(self, compact=True):
+        if self.mode != 'r':
+            self.flush()
+            if compact:
+                self.compact()
+        self.file.close()
+
+    # reading
+    def get_monitor_names(self):
+        return list(self.file.keys())
+
+    def get_observation_fields(self, name):
+        return [field.decode() if isinstance(field, bytes) else str(field) for field in self.file[name].attrs['observation_fields']]
+
+    def get_column(self, name, field, mmap=True):
+        dataset = self.file[name][field]
+        kind = dataset.attrs['kind']
+        if kind == 'pickle':
+            return [pickle.loads(row.tobytes()) for row in dataset[()]]
+        offset = dataset.id.get_offset()
+        if mmap and self.mode == 'r' and offset is not None and dataset.compression is None:
+            return np.memmap(self.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+        return dataset[()]
+
+    def get_columns(self, name, fields=None, mmap=True):
+        if fields is None:
+            fields = self.get_observation_fields(name)
+        return [self.get_column(name, field, mmap=mmap) for field in fields]
+
+    def get_observations(self, name):
+        '''observations as rows, the way monitors keep them in memory'''
+        columns = self.get_columns(name, mmap=False)
+        return [list(row) for row in zip(*columns)]
+
+    def get_results(self):
+        return observation_results(self)
+
+class monitor_results(object):
+    '''observations of one monitor, read on demand, indexable like the pickled results dictionaries'''
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get_columns(self, fields=None):
+        return self.store.get_columns(self.name, fields)
+
+    def __getitem__(self, key):
+        if key == 'observation_fields':
+            return self.store.get_observation_fields(self.name)
+        if key == 'observations':
+            return self.store.get_observations(self.name)
+        raise KeyError(key)
+
+    def keys(self):
+        return ['observation_fields', 'observations']
+
+class observation_results(object):
+    '''all monitors of a store, indexable like the pickled results dictionaries
+
+    Entries set on it (e.g. the outcome of an analysis) are kept in extra and
+    take precedence over the monitors of the store.'''
+
+    def __init__(self, store, aliases={}):
+        self.store = store
+        self.aliases = aliases
+        self.extra = {}
+
+    def get_name(self, key):
+        return self.aliases.get(key, key)
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        if self.get_name(key) not in self.store.file:
+            raise KeyError(key)
+        return monitor_results(self.store, self.get_name(key))
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+
+    def update(self, entries):
+        self.extra.update(entries)
+
+    def __contains__(self, key):
+        return key in self.extra or self.get_name(key) in self.store.file
+
+    def keys(self):
+        names = dict([(name, alias) for alias, name in self.aliases.items()])
+        return [names.get(name, name) for name in self.store.get_monitor_names() if names.get(name, name) not in self.extra] + list(self.extra.keys())
+
+def get_observations_filename(parameters_filename):
+    return parameters_filename.replace('_parameters.pickle', '_observations.h5')
+
+def open_results(filename):
+    '''results of an experiment from its observation store if there is one'''
+    if os.path.isfile(filename):
+        return observation_store(filename).get_results()
+    return None
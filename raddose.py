@@ -7,6 +7,122 @@ import numpy as np
 import shutil
 import csv
 import pickle
+import json
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+
+def normalize_parameters(parameters):
+    '''parameters with numbers converted to floats rounded to 6 significant digits, so that e.g. 10 and 10.0000001 share a key'''
+    normalized = {}
+    for key, value in parameters.items():
+        if isinstance(value, (bool, np.bool_)):
+            value = bool(value)
+        elif isinstance(value, (int, long, float, np.integer, np.floating)):
+            value = float('%.6g' % value)
+        normalized[str(key)] = value
+    return normalized
+
+def get_parameters_key(parameters):
+    return hashlib.sha1(json.dumps(normalize_parameters(parameters), sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_summary(filename):
+    f = open(filename)
+    a = csv.reader(f)
+    lines = [i for i in a]
+    keys = [i.strip() for i in lines[0]]
+    values = [float(i.strip()) for i in lines[1]]
+    f.close()
+    return dict(zip(keys, values))
+
+def run_raddose3d(parameters, binary='/usr/local/bin/raddose3d.jar'):
+    '''runs RADDOSE-3D locally in a temporary directory and returns the summary'''
+    directory = tempfile.mkdtemp(prefix='raddose3d_')
+    try:
+        input_filename = os.path.join(directory, 'input.txt')
+        f = open(input_filename, 'w')
+        f.write(raddose.template.format(**parameters))
+        f.close()
+        prefix = os.path.join(directory, 'output-')
+        log = open(os.path.join(directory, 'log.txt'), 'w')
+        subprocess.check_call(['java', '-jar', binary, '-i', input_filename, '-p', prefix], stdout=log, stderr=subprocess.STDOUT, cwd=directory)
+        log.close()
+        return read_summary('%sSummary.csv' % prefix)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def run_raddose3d_job(job):
+    key, parameters, binary = job
+    return key, run_raddose3d(parameters, binary)
+
+class result_cache:
+    '''content addressed store of RADDOSE-3D summaries, one json file per normalized parameter set'''
+    
+    def __init__(self, directory='/nfs/data2/raddose3d/cache'):
+        self.directory = directory
+        
+    def get_filename(self, key):
+        return os.path.join(self.directory, key[:2], '%s.json' % key)
+    
+    def get(self, key):
+        filename = self.get_filename(key)
+        if not os.path.isfile(filename):
+            return None
+        return json.load(open(filename))['summary']
+    
+    def put(self, key, parameters, summary):
+        filename = self.get_filename(key)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        temporary = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(temporary, 'w')
+        json.dump({'parameters': normalize_parameters(parameters), 'summary': summary}, f, sort_keys=True)
+        f.close()
+        os.rename(temporary, filename)
+        
+    def items(self):
+        '''all cached (parameters, summary) pairs'''
+        for root, directories, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    record = json.load(open(os.path.join(root, filename)))
+                    yield record['parameters'], record['summary']
+
+def run_batch(parameter_sets, processes=None, cache_directory='/nfs/data2/raddose3d/cache', binary='/usr/local/bin/raddose3d.jar'):
+    '''
+    runs RADDOSE-3D for every parameter set (dictionaries overriding the raddose defaults) not already in the cache
+    on a local pool of processes and returns parameters and summaries of all sets as a numpy structured array
+    '''
+    cache = result_cache(cache_directory)
+    parameter_sets = [raddose(**parameters).get_parameters() for parameters in parameter_sets]
+    keys = [get_parameters_key(parameters) for parameters in parameter_sets]
+    summaries = dict([(key, cache.get(key)) for key in set(keys)])
+    jobs = dict([(key, parameters) for key, parameters in zip(keys, parameter_sets) if summaries[key] is None])
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for key, summary in pool.imap_unordered(run_raddose3d_job, [(key, jobs[key], binary) for key in jobs]):
+                cache.put(key, jobs[key], summary)
+                summaries[key] = summary
+        finally:
+            pool.close()
+            pool.join()
+    
+    defaults = raddose().get_parameters()
+    parameter_names = sorted(defaults.keys())
+    summary_names = []
+    for key in keys:
+        summary_names += [name for name in sorted(summaries[key]) if name not in summary_names]
+    dtype = [(str(name), np.int64 if isinstance(defaults[name], int) else np.float64) for name in parameter_names]
+    dtype += [(str(name), np.float64) for name in summary_names]
+    results = np.zeros(len(parameter_sets), dtype=dtype)
+    for k, (key, parameters) in enumerate(zip(keys, parameter_sets)):
+        for name in parameter_names:
+            results[k][name] = parameters[name]
+        for name in summary_names:
+            results[k][name] = summaries[key].get(name, np.nan)
+    return results
 
 class raddose:
     template = '''
@@ -96,7 +212,8 @@ ExposureTime {total_exposure_time} # Total time for entire angular range in seco
                  oscillation_end=360.,
                  total_exposure_time=90.,
                  prefix='output-',
-                 output_directory='/nfs/data2/raddose3d'):
+                 output_directory='/nfs/data2/raddose3d',
+                 cache_directory='/nfs/data2/raddose3d/cache'):
         
         self.size_x = size_x
         self.size_y = size_y
@@ -117,6 +234,7 @@ ExposureTime {total_exposure_time} # Total time for entire angular range in seco
         self.oscillation_end = oscillation_end
         self.total_exposure_time = total_exposure_time
         self.output_directory = output_directory
+        self.cache_directory = cache_directory
         self.prefix = prefix
         self.expected_files = ['%sSummary.csv' % self.prefix,
                                '%sSummary.txt' % self.prefix,
@@ -194,13 +312,7 @@ ExposureTime {total_exposure_time} # Total time for entire angular range in seco
     def save_summary_pickle(self):
         summary_filename = 'output-%s-Summary.csv' % self.get_template_name()
         filename = os.path.join(self.output_directory, summary_filename)
-        f = open(filename)
-        a = csv.reader(f)
-        lines = [i for i in a]
-        keys = [i.strip() for i in lines[0]]
-        values = [float(i.strip()) for i in lines[1]]
-        d = dict(zip(keys, values))
-        f.close()
+        d = read_summary(filename)
         summary_pickle_file = open(self.get_summary_pickle_name(), 'w')
         pickle.dump(d, summary_pickle_file)
         summary_pickle_file.close()
@@ -214,11 +326,137 @@ ExposureTime {total_exposure_time} # Total time for entire angular range in seco
             summary_pickle = pickle.load(open(self.get_summary_pickle_name()))
         return summary_pickle
     
+    def get_key(self):
+        return get_parameters_key(self.get_parameters())
+    
+    def get_summary(self):
+        cache = result_cache(self.cache_directory)
+        key = self.get_key()
+        summary = cache.get(key)
+        if summary is None:
+            summary = run_raddose3d(self.get_parameters(), self.get_raddose_binary_path())
+            cache.put(key, self.get_parameters(), summary)
+        return summary
+    
     def get_DWD(self):
-        return self.get_summary_pickle()['DWD']
+        return self.get_summary()['DWD']
+        
         
         
+class dose_surrogate:
+    '''
+    Gaussian process model of log(DWD) over the raddose parameters, trained on the cached RADDOSE-3D summaries.
+    
+    Parameters which are positive in the whole training set are modelled in log space, all are standardized
+    and parameters constant in the training set are not modelled: queries differing from them get an infinite
+    uncertainty. The reported uncertainty is the predicted standard deviation of log(DWD), i.e. approximately
+    the relative error. get_DWD falls back to a real RADDOSE-3D run when it is above threshold and adds the
+    result to the training set.
+    '''
+    
+    length_scales = [0.25, 0.5, 1., 2., 4.]
+    noise = 1.e-6
+    
+    def __init__(self, cache_directory='/nfs/data2/raddose3d/cache', threshold=0.05, binary='/usr/local/bin/raddose3d.jar'):
+        self.cache = result_cache(cache_directory)
+        self.threshold = threshold
+        self.binary = binary
+        self.names = sorted(raddose().get_parameters().keys())
+        values = []
+        targets = []
+        for parameters, summary in self.cache.items():
+            if 'DWD' in summary and summary['DWD'] > 0:
+                values.append(self.get_vector(parameters))
+                targets.append(np.log(summary['DWD']))
+        self.values = np.array(values, ndmin=2)
+        self.targets = np.array(targets)
+        self.fit()
+        
+    def get_vector(self, parameters):
+        parameters = raddose(**parameters).get_parameters()
+        return np.array([float(parameters[name]) for name in self.names])
         
+    def transform(self, values):
+        x = values[:, self.varying]
+        x[:, self.logarithmic] = np.log(x[:, self.logarithmic])
+        return (x - self.offset) / self.scale
+    
+    def fit(self):
+        self.trained = len(self.targets) > 1
+        if not self.trained:
+            return
+        values = self.values
+        self.varying = values.max(axis=0) > values.min(axis=0)
+        self.constants = values[0, ~self.varying]
+        self.logarithmic = np.all(values[:, self.varying] > 0, axis=0)
+        x = values[:, self.varying].copy()
+        x[:, self.logarithmic] = np.log(x[:, self.logarithmic])
+        self.offset = x.mean(axis=0)
+        self.scale = x.std(axis=0)
+        self.x = self.transform(values)
+        self.mean = self.targets.mean()
+        self.variance = max(self.targets.var(), 1.e-6)
+        y = self.targets - self.mean
+        distances = ((self.x[:, np.newaxis, :] - self.x[np.newaxis, :, :])**2).sum(axis=2)
+        best = None
+        for length_scale in self.length_scales:
+            K = self.variance * np.exp(-distances / (2 * length_scale**2)) + self.noise * self.variance * np.eye(len(y))
+            try:
+                L = np.linalg.cholesky(K)
+            except np.linalg.LinAlgError:
+                continue
+            L_inverse = np.linalg.inv(L)
+            alpha = np.dot(L_inverse.T, np.dot(L_inverse, y))
+            log_marginal_likelihood = -0.5 * np.dot(y, alpha) - np.log(np.diag(L)).sum()
+            if best is None or log_marginal_likelihood > best[0]:
+                best = (log_marginal_likelihood, length_scale, L_inverse, alpha)
+        if best is None:
+            self.trained = False
+            return
+        log_marginal_likelihood, self.length_scale, self.L_inverse, self.alpha = best
+        
+    def predict(self, **parameters):
+        '''returns DWD predicted for parameters (overriding the raddose defaults) and its relative uncertainty'''
+        vector = self.get_vector(parameters)
+        if not self.trained or not np.allclose(vector[~self.varying], self.constants, rtol=1.e-6, atol=0.):
+            return np.nan, np.inf
+        x = self.transform(vector[np.newaxis, :])[0]
+        k = self.variance * np.exp(-((self.x - x)**2).sum(axis=1) / (2 * self.length_scale**2))
+        v = np.dot(self.L_inverse, k)
+        uncertainty = np.sqrt(max(self.variance - np.dot(v, v), 0.))
+        return np.exp(self.mean + np.dot(k, self.alpha)), uncertainty
+    
+    def add(self, parameters, summary):
+        vector = self.get_vector(parameters)
+        self.values = np.vstack([self.values, vector]) if self.values.size else vector[np.newaxis, :]
+        self.targets = np.append(self.targets, np.log(summary['DWD']))
+        self.fit()
+        
+    def get_DWD(self, **parameters):
+        '''returns DWD and its relative uncertainty, running RADDOSE-3D when the model is not certain enough'''
+        DWD, uncertainty = self.predict(**parameters)
+        if uncertainty <= self.threshold:
+            return DWD, uncertainty
+        full_parameters = raddose(**parameters).get_parameters()
+        key = get_parameters_key(full_parameters)
+        summary = self.cache.get(key)
+        if summary is None:
+            summary = run_raddose3d(full_parameters, self.binary)
+            self.cache.put(key, full_parameters, summary)
+        self.add(parameters, summary)
+        return summary['DWD'], 0.
+    
+    def get_exposure_time_for_DWD(self, DWD, low=1.e-3, high=1.e4, tolerance=1.e-3, **parameters):
+        '''longest total_exposure_time keeping the DWD under DWD, by bisection in log space on the model'''
+        while high / low > 1 + tolerance:
+            middle = np.sqrt(low * high)
+            parameters['total_exposure_time'] = middle
+            if self.get_DWD(**parameters)[0] > DWD:
+                high = middle
+            else:
+                low = middle
+        return low
+
 if __name__ == '__main__':
     import optparse
     
@@ -174,10 +174,7 @@ class raster_scan(diffraction_experiment):
         grid, points = self.area.get_grid_and_points()
         self.grid = grid
         self.points = points
-        if self.scan_axis == 'vertical':
-            self.position_sequence = self.area.get_position_sequence(grid.T)
-        else:
-            self.position_sequence = self.area.get_position_sequence(grid)
+        self.position_sequence = self.area.get_position_sequence(self.area.get_ordering(grid, self.scan_axis))
         self.jumps = None
         
         if self.shutterless == True:
@@ -186,22 +183,14 @@ class raster_scan(diffraction_experiment):
                 self.angle_per_frame = self.scan_range / self.number_of_columns
                 self.ntrigger = self.number_of_rows
                 self.nimages = self.number_of_columns
-                if self.inverse_direction == True:
-                    raster_grid = self.area.get_horizontal_raster(grid)
-                    jumps = self.area.get_jump_sequence(raster_grid)
-                else:
-                    jumps = self.area.get_jump_sequence(grid)
             else:
                 self.line_scan_time = self.frame_time * self.number_of_rows
                 self.angle_per_frame = self.scan_range / self.number_of_rows
                 self.ntrigger = self.number_of_columns
                 self.nimages = self.number_of_rows
-                if self.inverse_direction == True:
-                    raster_grid = self.area.get_vertical_raster(grid)
-                    jumps = self.area.get_jump_sequence(raster_grid.T, against_gravity=self.against_gravity)
-                else:
-                    jumps = self.area.get_jump_sequence(grid.T, against_gravity=self.against_gravity)
             
+            lines = self.area.get_ordering(grid, self.scan_axis, inverse_direction=self.inverse_direction, against_gravity=self.against_gravity)
+            jumps = self.area.get_jump_sequence(lines)
             self.jumps = jumps
             self.collect_sequence = self.area.get_linearized_point_jumps(jumps, points)
             self.total_expected_exposure_time = self.line_scan_time * self.ntrigger
@@ -215,11 +204,8 @@ class raster_scan(diffraction_experiment):
             else:
                 self.line_scan_time = self.frame_time * self.nimages_per_point * self.number_of_rows
             self.total_expected_exposure_time = self.frame_time * self.nimages_per_point * self.ntrigger
-            #self.collect_sequence = [(self.points[position], self.points[position]) for position in self.position_sequence]
-            self.collect_sequence = []
-            for position in self.position_sequence:
-                for k in range(self.npasses):
-                    self.collect_sequence.append((self.points[position], self.points[position]))
+            jumps = np.repeat(np.column_stack([self.position_sequence, self.position_sequence]), self.npasses, axis=0)
+            self.collect_sequence = self.area.get_linearized_point_jumps(jumps, points)
             
         self.total_expected_wedges = self.ntrigger
     
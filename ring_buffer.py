@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Fixed capacity, time indexed ring buffer of packed binary records.
+
+The buffer is a single contiguous block of bytes holding a small header
+(number of records ever written, capacity, record size, number of records
+whose writing has started) followed by capacity
+float64 timestamps and capacity records packed according to a numpy dtype.
+The k-th record ever appended lives in slot k % capacity. Timestamps are
+appended in increasing order, so the stored records are sorted by time and
+a time window is found by binary search over the logical record indices.
+
+There is a single writer. It marks the record as started, writes the slot and
+increments the record count afterwards. Readers take the count before reading
+and the started count after and discard records that may have been
+overwritten in the meantime, so no handshake between the writer and the
+readers is necessary.
+
+The block lives either in a file on shared memory (/dev/shm by default),
+accessible to all processes on the machine without any service running,
+or in a redis string accessed through GETRANGE/SETRANGE.
+'''
+
+import os
+import struct
+import numpy as np
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+header_format = '<qqqq'
+header_size = 64
+
+class mmap_storage(object):
+
+    def __init__(self, name, size, directory='/dev/shm'):
+        self.filename = os.path.join(directory, '%s.ring' % name.replace('/', '_'))
+        if not os.path.isfile(self.filename) or os.path.getsize(self.filename) != size:
+            f = open(self.filename, 'wb')
+            f.truncate(size)
+            f.close()
+        self.buffer = np.memmap(self.filename, dtype=np.uint8, mode='r+', shape=(size,))
+
+    def read(self, offset, size):
+        return self.buffer[offset: offset+size].tobytes()
+
+    def write(self, items):
+        for offset, data in items:
+            self.buffer[offset: offset+len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+class redis_storage(object):
+
+    def __init__(self, name, size, host='localhost', port=6379):
+        self.key = '%s_ring' % name
+        self.redis = redis.StrictRedis(host=host, port=port)
+        if self.redis.strlen(self.key) != size:
+            self.redis.setrange(self.key, 0, b'\x00' * size)
+
+    def read(self, offset, size):
+        return self.redis.getrange(self.key, offset, offset + size - 1)
+
+    def write(self, items):
+        pipeline = self.redis.pipeline(transaction=True)
+        for offset, data in items:
+            pipeline.setrange(self.key, offset, data)
+        pipeline.execute()
+
+class ring_buffer(object):
+
+    def __init__(self, name, capacity=1000, dtype=np.float64, backend='mmap', **kwargs):
+        self.name = name
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        self.record_size = self.dtype.itemsize
+        self.timestamps_offset = header_size
+        self.records_offset = header_size + 8 * self.capacity
+        self.size = self.records_offset + self.record_size * self.capacity
+
+        if backend == 'mmap':
+            self.storage = mmap_storage(name, self.size, **kwargs)
+        elif backend == 'redis':
+            self.storage = redis_storage(name, self.size, **kwargs)
+        else:
+            raise ValueError('ring_buffer backend %s not supported, please use mmap or redis' % backend)
+
+        count, capacity, record_size, started = self.get_header()
+        if (capacity, record_size) != (self.capacity, self.record_size):
+            self.clear()
+
+    def get_header(self):
+        return struct.unpack(header_format, self.storage.read(0, struct.calcsize(header_format)))
+
+    def get_count(self):
+        return self.get_header()[0]
+
+    def clear(self):
+        self.storage.write([(0, struct.pack(header_format, 0, self.capacity, self.record_size, 0))])
+
+    def get_slot(self, index):
+        return index % self.capacity
+
+    def append(self, timestamp, record):
+        count = self.get_count()
+        slot = self.get_slot(count)
+        record = np.asarray(record, dtype=self.dtype.base).tobytes()
+        if len(record) != self.record_size:
+            raise ValueError('record of %d bytes does not match %s records of %d bytes' % (len(record), self.name, self.record_size))
+        self.storage.write([(0, struct.pack(header_format, count, self.capacity, self.record_size, count + 1))])
+        self.storage.write([(self.timestamps_offset + 8 * slot, struct.pack('<d', timestamp)),
+                            (self.records_offset + self.record_size * slot, record)])
+        self.storage.write([(0, struct.pack(header_format, count + 1, self.capacity, self.record_size, count + 1))])
+
+    def get_oldest_index(self, count):
+        return max(0, count - self.capacity)
+
+    def get_oldest_valid_index(self):
+        '''oldest index still intact after a read, the record being written may be overwriting the oldest one'''
+        count, capacity, record_size, started = self.get_header()
+        return self.get_oldest_index(max(count, started))
+
+    def get_timestamp(self, index):
+        slot = self.get_slot(index)
+        return struct.unpack('<d', self.storage.read(self.timestamps_offset + 8 * slot, 8))[0]
+
+    def bisect(self, timestamp, low, high, right=False):
+        '''returns the first logical index in [low, high) whose timestamp is greater (right=True) or greater or equal (right=False) than timestamp'''
+        while low < high:
+            middle = (low + high) // 2
+            middle_timestamp = self.get_timestamp(middle)
+            if middle_timestamp < timestamp or (right and middle_timestamp == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read_range(self, offset, item_size, first, last):
+        '''reads items of logical indices first to last, in at most two pieces as the range may wrap around'''
+        pieces = []
+        index = first
+        while index < last:
+            slot = self.get_slot(index)
+            n = min(last - index, self.capacity - slot)
+            pieces.append(self.storage.read(offset + item_size * slot, item_size * n))
+            index += n
+        return b''.join(pieces)
+
+    def get_range(self, first, last):
+        timestamps = np.frombuffer(self.read_range(self.timestamps_offset, 8, first, last), dtype='<f8')
+        records = np.frombuffer(self.read_range(self.records_offset, self.record_size, first, last), dtype=self.dtype)
+        return timestamps, records
+
+    def get_window(self, start=-np.inf, end=np.inf):
+        '''returns timestamps and records recorded between start and end'''
+        count = self.get_count()
+        oldest = self.get_oldest_index(count)
+        first = self.bisect(start, oldest, count)
+        last = self.bisect(end, first, count, right=True)
+        timestamps, records = self.get_range(first, last)
+        valid = max(0, self.get_oldest_valid_index() - first)
+        return timestamps[valid:], records[valid:]
+
+    def get_record_before(self, timestamp):
+        '''returns timestamp and record of the last record recorded at or before timestamp'''
+        count = self.get_count()
+        oldest = self.get_oldest_index(count)
+        index = self.bisect(timestamp, oldest, count, right=True) - 1
+        if index < oldest:
+            raise IndexError('no record at or before %s in %s' % (timestamp, self.name))
+        timestamps, records = self.get_range(index, index+1)
+        if index < self.get_oldest_valid_index():
+            raise IndexError('record at %s in %s already overwritten' % (timestamp, self.name))
+        return timestamps[0], records[0]
+
+    def get_last(self):
+        count = self.get_count()
+        if count == 0:
+            raise IndexError('%s is empty' % self.name)
+        timestamps, records = self.get_range(count-1, count)
+        return timestamps[0], records[0]
+
+    def __len__(self):
+        count = self.get_count()
+        return count - self.get_oldest_index(count)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Merging of successive readouts of a rolling buffer of samples (e.g. history
+buffers of sai channels), where each new readout repeats the tail of the
+previous one.
+
+Samples are compared bitwise as float64, so the overlap is always aligned
+on samples and exact. Only the last len(new) samples of the history are
+examined, so the cost does not depend on the length of the history.
+
+The overlap is the longest suffix of the history equal to a prefix of the
+new readout. Polynomial hashes of all the prefixes of new and of all the
+suffixes of the tail of the history are computed at once with cumulative
+sums, and only lengths with equal hashes are compared sample by sample,
+longest first. Flat or periodic signals (e.g. a diode behind the closed
+shutter) thus cost O(len(new)) as well.
+'''
+
+import numpy as np
+
+def as_samples(sequence):
+    if isinstance(sequence, bytes):
+        return np.frombuffer(sequence, dtype=np.float64)
+    return np.ascontiguousarray(sequence, dtype=np.float64)
+
+modulus = 2147483647
+base = 1000003
+powers = np.ones(1, dtype=np.int64)
+inverse_powers = np.ones(1, dtype=np.int64)
+
+def get_powers(n):
+    '''base**k and base**-k modulo modulus for k < n, extended by doubling and kept for the next calls'''
+    global powers, inverse_powers
+    inverse_base = pow(base, modulus - 2, modulus)
+    while len(powers) < n:
+        length = len(powers)
+        powers = np.hstack([powers, powers * pow(base, length, modulus) % modulus])
+        inverse_powers = np.hstack([inverse_powers, inverse_powers * pow(inverse_base, length, modulus) % modulus])
+    return powers[:n], inverse_powers[:n]
+
+def get_prefix_hashes(bits, weights):
+    '''hashes of bits[:k] for k from 0 to len(bits), the k-th sample weighted by base**k'''
+    terms = (bits % np.uint64(modulus)).astype(np.int64) * weights % modulus
+    return np.hstack([[0], np.cumsum(terms) % modulus])
+
+def find_overlap(old, new):
+    '''returns the number of samples at the end of new which are not already at the end of old'''
+    old = as_samples(old)
+    new = as_samples(new)
+    if len(old) == 0 or len(new) == 0:
+        return len(new)
+    m = min(len(old), len(new))
+    tail = old[len(old)-m:].view(np.uint64)
+    new_bits = new[:m].view(np.uint64)
+    weights, inverse_weights = get_powers(m)
+    tail_hashes = get_prefix_hashes(tail, weights)
+    new_hashes = get_prefix_hashes(new_bits, weights)
+    # hash of tail[start:] shifted so that its first sample has weight 1, like new[:m-start]
+    starts = np.arange(m)
+    suffix_hashes = (tail_hashes[m] - tail_hashes[starts]) % modulus * inverse_weights[starts] % modulus
+    # the first candidate start gives the longest overlap
+    for start in np.flatnonzero(suffix_hashes == new_hashes[m - starts]):
+        overlap = m - start
+        if np.array_equal(tail[start:], new_bits[:overlap]):
+            return len(new) - overlap
+    return len(new)
+
+def merge_overlapping(old, new):
+    '''returns old extended by the samples of new which are not already in it and the number of such samples'''
+    old = as_samples(old)
+    new = as_samples(new)
+    new_values = find_overlap(old, new)
+    return np.hstack([old, new[len(new) - new_values:]]), new_values
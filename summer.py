@@ -12,6 +12,7 @@ import math
 import random
 import logging
 import sys
+import multiprocessing
 
 log = logging.getLogger()
 stream_handler = logging.StreamHandler(sys.stdout)
@@ -51,12 +52,12 @@ def loose_the_image(image_index, images_to_loose, indices_of_images_to_loose):
     else:
         return False
     
-def get_ill(indices_of_images_to_loose, images_to_sum):
+def get_iil(indices_of_images_to_loose, images_to_sum, images_to_loose):
     if indices_of_images_to_loose == 'random':
         wedge_indices = range(images_to_sum)
         iil = []
         for k in range(images_to_loose):
-            iil.append(wedge_indices.pop(random.choice(wedge_indices)))
+            iil.append(wedge_indices.pop(random.randrange(len(wedge_indices))))
         log.debug('indices_of_images_to_loose %s' % indices_of_images_to_loose)
     elif images_to_sum == len(indices_of_images_to_loose):
         iil = indices_of_images_to_loose[:]
@@ -64,11 +65,12 @@ def get_ill(indices_of_images_to_loose, images_to_sum):
         iil = []
     return iil
         
-def sum_and_save_not_pretending_to_be_smart(master, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose):
+def sum_and_save_not_pretending_to_be_smart(master, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose, compression='bslz4'):
     datakeys = master['/entry/data'].keys()
     datakeys.sort()
     
     datafile_template = master.filename.replace('_master', '_data_%06d')
+    output_dtype = get_series_dtype(get_data_datasets(master), images_to_sum, images_to_loose, indices_of_images_to_loose)
     
     datafile_number = 0
     saved_images = 0
@@ -85,13 +87,12 @@ def sum_and_save_not_pretending_to_be_smart(master, images_to_sum, images_per_fi
         except KeyError:
             continue
         if key == datakeys[0]:
-            dtype = block.dtype
             nimages, image_height, image_width = block.shape
             new_image = np.zeros((image_height, image_width), dtype=np.int64)
             
         for image in block:
             if images_to_loose > 0 and since_last_summed == 0:
-                iil = get_iil(indices_of_images_to_loose, images_to_sum)
+                iil = get_iil(indices_of_images_to_loose, images_to_sum, images_to_loose)
             else:
                 iil = []
                 
@@ -119,7 +120,7 @@ def sum_and_save_not_pretending_to_be_smart(master, images_to_sum, images_per_fi
                 low = (datafile_number-1)*images_per_file + 1
                 high = low + len(to_write) - 1
                 saved_images += len(to_write)
-                save_datafile(data_filename, to_write, dtype, low, high)
+                save_datafile(data_filename, to_write, low, high, compression, output_dtype)
                 summed = []
             
             del image
@@ -134,15 +135,226 @@ def sum_and_save_not_pretending_to_be_smart(master, images_to_sum, images_per_fi
         low = (datafile_number-1)*images_per_file + 1
         high = low + len(to_write) - 1
         saved_images += len(to_write)
-        save_datafile(data_filename, to_write, dtype, low, high)
+        save_datafile(data_filename, to_write, low, high, compression, output_dtype)
     
     return saved_images, data_filenames
 
-def sum_and_save(master, images_to_sum, images_per_file):
+def get_data_datasets(master):
+    datasets = []
+    for key in sorted(master['/entry/data'].keys()):
+        try:
+            dataset = master['/entry/data/%s' % key]
+        except KeyError:
+            log.debug('%s not available, skipping' % key)
+            continue
+        datasets.append(dataset)
+    return datasets
+
+def get_accumulator_dtype(dtype, images_to_sum):
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui' and int(np.iinfo(dtype).max) * int(images_to_sum) <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def iterate_chunks(dataset, start=0, end=None):
+    '''yields consecutive blocks of frames start to end of the dataset, one HDF5 chunk at a time, all read into the same buffer'''
+    if end is None:
+        end = dataset.shape[0]
+    if dataset.chunks is not None:
+        step = dataset.chunks[0]
+    else:
+        step = 1
+    chunk_buffer = np.empty((step,) + dataset.shape[1:], dtype=dataset.dtype)
+    low = start
+    while low < end:
+        high = min((low // step + 1) * step, end)
+        dataset.read_direct(chunk_buffer, np.s_[low:high], np.s_[0:high-low])
+        yield chunk_buffer[:high-low]
+        low = high
+
+def iterate_sums(blocks, accumulator_dtype, image_shape, images_to_sum, images_to_loose=0, indices_of_images_to_loose=[]):
+    '''yields the sums of images_to_sum consecutive frames coming from the blocks iterator, 
+    all of them in the same buffer. Incomplete trailing sum is discarded.'''
+    summed = np.zeros(image_shape, dtype=accumulator_dtype)
+    since_last_summed = 0
+    iil = []
+    
+    for block in blocks:
+        position = 0
+        while position < len(block):
+            if images_to_loose > 0 and since_last_summed == 0:
+                iil = get_iil(indices_of_images_to_loose, images_to_sum, images_to_loose)
+            
+            to_add = min(images_to_sum - since_last_summed, len(block) - position)
+            wedge = block[position: position+to_add]
+            if iil:
+                keep = [k for k in range(to_add) if not loose_the_image(since_last_summed + k + 1, images_to_loose, iil)]
+                wedge = wedge[keep]
+            if len(wedge) > 0:
+                summed += wedge.sum(axis=0, dtype=accumulator_dtype)
+            
+            position += to_add
+            since_last_summed += to_add
+            
+            if since_last_summed == images_to_sum:
+                yield summed
+                summed[:] = 0
+                since_last_summed = 0
+
+def get_summed_maximum(blocks, dtype, image_shape, images_to_sum, images_to_loose=0, indices_of_images_to_loose=[]):
+    '''maximum of the summed frames, the random state is restored afterwards so that summing them again loses the same images'''
+    state = random.getstate()
+    maximum = 0
+    for summed in iterate_sums(blocks, get_accumulator_dtype(dtype, images_to_sum), image_shape, images_to_sum, images_to_loose, indices_of_images_to_loose):
+        maximum = max(maximum, int(summed.max()))
+    random.setstate(state)
+    return maximum
+
+def sum_and_save_blocks(blocks, dtype, image_shape, images_to_sum, images_per_file, datafile_template, datafile_number=0, images_to_loose=0, indices_of_images_to_loose=[], compression='bslz4', output_dtype=np.uint32):
+    '''Sums images_to_sum consecutive frames coming from the blocks iterator.
+    
+    Summed frames are accumulated into a single preallocated buffer of images_per_file
+    frames which is written out as soon as it fills, so peak memory does not depend
+    on the number of frames to process. Incomplete trailing sum is discarded.'''
+    image_height, image_width = image_shape
+    accumulator_dtype = get_accumulator_dtype(dtype, images_to_sum)
+    log.debug('accumulator_dtype %s' % np.dtype(accumulator_dtype))
+    summed = np.zeros((images_per_file, image_height, image_width), dtype=accumulator_dtype)
+    
+    saved_images = 0
+    slot = 0
+    
+    data_filenames = []
+    
+    for image in iterate_sums(blocks, accumulator_dtype, image_shape, images_to_sum, images_to_loose, indices_of_images_to_loose):
+        summed[slot] = image
+        slot += 1
+        
+        if slot == images_per_file:
+            datafile_number += 1
+            data_filename = datafile_template % datafile_number
+            data_filenames.append(data_filename)
+            low = (datafile_number-1)*images_per_file + 1
+            high = low + slot - 1
+            saved_images += slot
+            save_datafile(data_filename, summed, low, high, compression, output_dtype)
+            slot = 0
+    
+    if slot > 0:
+        datafile_number += 1
+        data_filename = datafile_template % datafile_number
+        data_filenames.append(data_filename)
+        low = (datafile_number-1)*images_per_file + 1
+        high = low + slot - 1
+        saved_images += slot
+        save_datafile(data_filename, summed[:slot], low, high, compression, output_dtype)
+    
+    return saved_images, data_filenames
+
+def iterate_datasets(datasets):
+    for dataset in datasets:
+        log.debug(dataset.name)
+        for block in iterate_chunks(dataset):
+            yield block
+            
+def sum_and_save_streaming(master, images_to_sum, images_per_file, images_to_loose=0, indices_of_images_to_loose=[], compression='bslz4'):
+    datasets = get_data_datasets(master)
+    datafile_template = master.filename.replace('_master', '_data_%06d')
+    dtype = datasets[0].dtype
+    image_shape = datasets[0].shape[1:]
+    output_dtype = get_series_dtype(datasets, images_to_sum, images_to_loose, indices_of_images_to_loose)
+    return sum_and_save_blocks(iterate_datasets(datasets), dtype, image_shape, images_to_sum, images_per_file, datafile_template, 0, images_to_loose, indices_of_images_to_loose, compression, output_dtype)
+
+def get_frame_range_pieces(datasets, start, end):
+    '''splits frame range start to end into (filename, dataset path, first, last) pieces of the underlying data files'''
+    pieces = []
+    offset = 0
+    for dataset in datasets:
+        nimages = dataset.shape[0]
+        low = max(start - offset, 0)
+        high = min(end - offset, nimages)
+        if low < high:
+            pieces.append((dataset.file.filename, dataset.name, low, high))
+        offset += nimages
+        if offset >= end:
+            break
+    return pieces
+
+def get_work_units(master, images_to_sum, images_per_file, images_to_loose=0, indices_of_images_to_loose=[], compression='bslz4', output_dtype=np.uint32):
+    '''one work unit per output data file'''
+    datasets = get_data_datasets(master)
+    datafile_template = master.filename.replace('_master', '_data_%06d')
+    dtype = datasets[0].dtype
+    image_shape = datasets[0].shape[1:]
+    nimages = sum([dataset.shape[0] for dataset in datasets])
+    new_nimages = nimages // images_to_sum
+    images_per_unit = images_per_file * images_to_sum
+    work_units = []
+    for k, start in enumerate(range(0, new_nimages*images_to_sum, images_per_unit)):
+        end = min(start + images_per_unit, new_nimages*images_to_sum)
+        pieces = get_frame_range_pieces(datasets, start, end)
+        work_units.append((pieces, dtype, image_shape, images_to_sum, images_per_file, datafile_template, k, images_to_loose, indices_of_images_to_loose, compression, output_dtype))
+    return work_units
+
+def iterate_pieces(pieces):
+    for filename, path, low, high in pieces:
+        log.debug('%s %s %d %d' % (filename, path, low, high))
+        data_file = h5py.File(filename, 'r')
+        for block in iterate_chunks(data_file[path], low, high):
+            yield block
+        data_file.close()
+        
+def sum_work_unit(work_unit):
+    pieces, dtype, image_shape, images_to_sum, images_per_file, datafile_template, datafile_number, images_to_loose, indices_of_images_to_loose, compression, output_dtype = work_unit
+    # the same images are lost when the maximum is determined and when summing
+    random.seed(datafile_number)
+    saved_images, data_filenames = sum_and_save_blocks(iterate_pieces(pieces), dtype, image_shape, images_to_sum, images_per_file, datafile_template, datafile_number, images_to_loose, indices_of_images_to_loose, compression, output_dtype)
+    return datafile_number, saved_images, data_filenames
+
+def get_work_unit_maximum(work_unit):
+    pieces, dtype, image_shape, images_to_sum, images_per_file, datafile_template, datafile_number, images_to_loose, indices_of_images_to_loose, compression, output_dtype = work_unit
+    random.seed(datafile_number)
+    return get_summed_maximum(iterate_pieces(pieces), dtype, image_shape, images_to_sum, images_to_loose, indices_of_images_to_loose)
+    
+def sum_and_save_parallel(master, images_to_sum, images_per_file, images_to_loose=0, indices_of_images_to_loose=[], n_cpu=0, compression='bslz4'):
+    '''Sums the dataset in a pool of processes, each of them reading its frames directly from the data files and writing one output data file.'''
+    work_units = get_work_units(master, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose, compression)
+    if n_cpu <= 0:
+        n_cpu = multiprocessing.cpu_count()
+    n_cpu = max(1, min(n_cpu, len(work_units)))
+    log.info('summing %d output data files using %d processes' % (len(work_units), n_cpu))
+    
+    start = time.time()
+    results = []
+    pool = multiprocessing.Pool(n_cpu)
+    try:
+        maximum = max(pool.map(get_work_unit_maximum, work_units) + [0])
+        output_dtype = get_output_dtype(maximum)
+        log.info('maximum of the summed images %d, writing them as %s, %.1f s so far' % (maximum, np.dtype(output_dtype), time.time() - start))
+        work_units = [work_unit[:-1] + (output_dtype,) for work_unit in work_units]
+        for result in pool.imap_unordered(sum_work_unit, work_units):
+            results.append(result)
+            log.info('%d of %d output data files done, %.1f s so far' % (len(results), len(work_units), time.time() - start))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+    results.sort(key=lambda x: x[0])
+    saved_images = sum([result[1] for result in results])
+    data_filenames = []
+    for result in results:
+        data_filenames += result[2]
+    return saved_images, data_filenames
+
+def sum_and_save(master, images_to_sum, images_per_file, compression='bslz4'):
     datakeys = master['/entry/data'].keys()
     datakeys.sort()
     
     datafile_template = master.filename.replace('_master', '_data_%06d')
+    output_dtype = get_series_dtype(get_data_datasets(master), images_to_sum)
     
     datafile_number = 0
     saved_images = 0
@@ -157,8 +369,6 @@ def sum_and_save(master, images_to_sum, images_per_file):
         log.debug(key)
         
         block = master['/entry/data/%s' % key][()]
-        if key == datakeys[0]:
-            dtype = block.dtype
         
         if remainder is not None:
             block = np.vstack([remainder, block])
@@ -207,7 +417,7 @@ def sum_and_save(master, images_to_sum, images_per_file):
                 low = (datafile_number-1)*images_per_file + 1
                 high = low + len(to_write) - 1
                 saved_images += len(to_write)
-                save_datafile(data_filename, to_write, dtype, low, high)
+                save_datafile(data_filename, to_write, low, high, compression, output_dtype)
                 
             if to_keep > 0:
                 summed = summed[to_dump*images_per_file:]
@@ -222,18 +432,45 @@ def sum_and_save(master, images_to_sum, images_per_file):
         low = (datafile_number-1)*images_per_file + 1
         high = low + len(to_write) - 1
         saved_images += len(to_write)
-        save_datafile(data_filename, to_write, dtype, low, high)
+        save_datafile(data_filename, to_write, low, high, compression, output_dtype)
         
     return saved_images, data_filenames
     
 
-def save_datafile(data_filename, to_write, dtype, low, high):
+def get_output_dtype(maximum):
+    if maximum <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+def get_series_dtype(datasets, images_to_sum, images_to_loose=0, indices_of_images_to_loose=[]):
+    '''output type of all the summed data files of a series, the smallest one holding the maximum of the summed frames'''
+    maximum = get_summed_maximum(iterate_datasets(datasets), datasets[0].dtype, datasets[0].shape[1:], images_to_sum, images_to_loose, indices_of_images_to_loose)
+    log.info('maximum of the summed images %d' % maximum)
+    return get_output_dtype(maximum)
+
+def get_compression_parameters(compression):
+    if compression == 'bslz4':
+        return {'compression': bitshuffle.h5.H5FILTER,
+                'compression_opts': (0, bitshuffle.h5.H5_COMPRESS_LZ4)}
+    elif compression == 'gzip':
+        return {'compression': 'gzip',
+                'compression_opts': 4}
+    elif compression in [None, 'none']:
+        return {}
+    raise ValueError('compression %s not supported, please use one of bslz4, gzip or none' % compression)
+    
+def save_datafile(data_filename, to_write, low, high, compression='bslz4', dtype=np.uint32):
+    '''Writes summed frames one frame per chunk, in dtype, the same for all the data files of a series (see get_series_dtype).
+    Values beyond its range (sums of masked pixels) are clipped to its maximum.'''
+    if to_write.max() > np.iinfo(dtype).max:
+        to_write = np.minimum(to_write, np.iinfo(dtype).max)
+    nimages, image_height, image_width = to_write.shape
     data_file = h5py.File(data_filename, 'w')
     data_file.create_dataset('/entry/data/data',
                              data=to_write, 
-                             #compression=bitshuffle.h5.H5FILTER, 
-                             #compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4), 
-                             dtype=dtype)
+                             chunks=(1, image_height, image_width),
+                             dtype=dtype,
+                             **get_compression_parameters(compression))
     data_file['/entry/data/data'].attrs.create('image_nr_low', low)
     data_file['/entry/data/data'].attrs.create('image_nr_high', high)
     data_file.close()
@@ -250,6 +487,9 @@ def main():
     parser.add_option('-p', '--images_per_file', type=int, default=10, help='number of images per data file')
     parser.add_option('-l', '--images_to_loose', type=int, default=0, help='number of original images not to include in the new images -- useful for simulating increased deadtime or random loss of images')
     parser.add_option('-i', '--indices_of_images_to_loose', type=str, default='-1', help='String specifying what images not to include. Depends on the nimages_to_loose value. Either integer, string that will evaluate to python tuple or list or "random" string if images are to be chosen randomly')
+    parser.add_option('-M', '--mode', type='choice', choices=['streaming', 'parallel', 'simple'], default='streaming', help='summation mode: streaming reads the data chunk by chunk in constant memory, parallel distributes output data files over a pool of processes, simple holds whole data blocks in memory')
+    parser.add_option('-C', '--compression', type='choice', choices=['bslz4', 'gzip', 'none'], default='bslz4', help='compression of the summed data files')
+    parser.add_option('-c', '--n_cpu', type=int, default=0, help='number of processes to use in parallel mode, by default all cores of the machine')
     
     options, args = parser.parse_args()
     
@@ -293,14 +533,25 @@ def main():
     #new_nimages, image_height, image_width = recube.shape
     if images_to_sum == 'all':
         images_to_sum = m['/entry/instrument/detector/detectorSpecific/nimages'][()]
-        
-    new_nimages, data_filenames = sum_and_save_not_pretending_to_be_smart(new_m, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose)
+    
+    if options.mode == 'streaming':
+        new_nimages, data_filenames = sum_and_save_streaming(new_m, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose, options.compression)
+    elif options.mode == 'parallel':
+        new_nimages, data_filenames = sum_and_save_parallel(new_m, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose, options.n_cpu, options.compression)
+    else:
+        new_nimages, data_filenames = sum_and_save_not_pretending_to_be_smart(new_m, images_to_sum, images_per_file, images_to_loose, indices_of_images_to_loose, options.compression)
     
     log.debug('new_nimages %s' % new_nimages)
     log.debug('data_filenames %s' % data_filenames)
     
     new_m['/entry/instrument/detector/detectorSpecific/nimages'].write_direct(np.array([new_nimages]))
     
+    if data_filenames and '/entry/instrument/detector/bit_depth_image' in new_m:
+        data_file = h5py.File(data_filenames[0], 'r')
+        output_dtype = data_file['/entry/data/data'].dtype
+        data_file.close()
+        new_m['/entry/instrument/detector/bit_depth_image'].write_direct(np.array([8 * output_dtype.itemsize]))
+    
     log.debug('confirm %s' % new_m['/entry/instrument/detector/detectorSpecific/nimages'][()])
     
     new_m.close()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+
+import sequence_overlap
+from sequence_overlap import find_overlap, merge_overlapping
+
+def find_overlap_brute_force(old, new):
+    for overlap in range(min(len(old), len(new)), 0, -1):
+        if list(old[len(old)-overlap:]) == list(new[:overlap]):
+            return len(new) - overlap
+    return len(new)
+
+class counting_array_equal(object):
+    '''counts the sample by sample comparisons made by find_overlap'''
+
+    def __enter__(self):
+        self.calls = 0
+        self.array_equal = sequence_overlap.np.array_equal
+        def array_equal(a, b):
+            self.calls += 1
+            return self.array_equal(a, b)
+        sequence_overlap.np.array_equal = array_equal
+        return self
+
+    def __exit__(self, *args):
+        sequence_overlap.np.array_equal = self.array_equal
+
+class test_find_overlap(unittest.TestCase):
+
+    def test_continuation(self):
+        old = np.random.random(1000)
+        new = np.hstack([old[-300:], np.random.random(50)])
+        self.assertEqual(find_overlap(old, new), 50)
+        merged, new_values = merge_overlapping(old, new)
+        self.assertEqual(new_values, 50)
+        self.assertTrue(np.array_equal(merged[-350:], new))
+
+    def test_no_overlap(self):
+        self.assertEqual(find_overlap(np.random.random(100), np.random.random(20)), 20)
+        self.assertEqual(find_overlap([], [1., 2.]), 2)
+
+    def test_old_shorter_than_new(self):
+        self.assertEqual(find_overlap([1., 2.], [1., 2., 3., 4.]), 2)
+
+    def test_against_brute_force(self):
+        random = np.random.RandomState(0)
+        for k in range(500):
+            # a small alphabet gives many partial matches
+            old = random.randint(0, 3, random.randint(0, 30)).astype(np.float64)
+            new = random.randint(0, 3, random.randint(0, 30)).astype(np.float64)
+            if len(old) and len(new) and random.rand() < 0.5:
+                new = np.hstack([old[-random.randint(1, len(old)+1):], new])
+            self.assertEqual(find_overlap(old, new), find_overlap_brute_force(old, new))
+
+    def test_constant_buffer(self):
+        # closed shutter, every length is a candidate and the longest is the right one
+        old = np.zeros(1000000)
+        new = np.hstack([np.zeros(100000), np.ones(10)])
+        with counting_array_equal() as counter:
+            self.assertEqual(find_overlap(old, new), 10)
+        self.assertEqual(counter.calls, 1)
+
+    def test_periodic_buffer(self):
+        period = np.array([0., 1., 2., 3., 2., 1.])
+        old = np.tile(period, 200000)
+        new = np.hstack([np.tile(period, 20000), [7., 8.]])
+        with counting_array_equal() as counter:
+            self.assertEqual(find_overlap(old, new), 2)
+        self.assertEqual(counter.calls, 1)
+
+if __name__ == '__main__':
+    unittest.main()
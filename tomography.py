@@ -8,12 +8,16 @@ import pickle
 import os
 
 from xray_experiment import xray_experiment
+from tracing import traced
+from observation_store import observation_store
 from monitor import xray_camera as detector
 
 class tomography(xray_experiment):
     
     actuator_names = ['Omega']
     
+    point_fields = ['position', 'image_id', 'chronos', 'image']
+    
     def __init__(self,
                  name_pattern,
                  directory,
@@ -65,6 +69,7 @@ class tomography(xray_experiment):
         self.images = None
         self.background = None
 
+    @traced
     def program_detector(self):
         self.detector.stop()
         self.detector.set_latency_time(0*1e3)
@@ -155,6 +160,7 @@ class tomography(xray_experiment):
         
         self.observations = []
         self.background = []
+        self.tomography_store = observation_store(self.get_tomography_filename(), mode='w')
         print 'tomography prepare took %s' % (time.time()-_start)
 
     def get_point(self, new_image_id, start_time):
@@ -162,6 +168,13 @@ class tomography(xray_experiment):
         position = self.goniometer.get_omega_position()
         image = self.detector.get_image()
         return [position, new_image_id, chronos, image]
+    
+    def get_tomography_filename(self):
+        return os.path.join(self.directory, '%s_tomography.h5' % self.name_pattern)
+    
+    def add_point(self, name, point):
+        getattr(self, name).append(point)
+        self.tomography_store.append(name, self.point_fields, [point])
                     
     def get_background(self):
         print 'get_background'
@@ -177,7 +190,7 @@ class tomography(xray_experiment):
             new_image_id = self.detector.get_current_image_id()
             if new_image_id != last_image:
                 last_image = new_image_id
-                self.background.append(self.get_point(new_image_id, self.background_start_time))
+                self.add_point('background', self.get_point(new_image_id, self.background_start_time))
         self.background_end_time = time.time()
         self.background_md2_task_info = self.goniometer.get_task_info(task_id)
         self.position['AlignmentY'] += 1.
@@ -198,14 +211,12 @@ class tomography(xray_experiment):
             new_image_id = self.detector.get_current_image_id()
             if new_image_id != last_image:
                 last_image = new_image_id
-                self.observations.append(self.get_point(new_image_id, self._start))
+                self.add_point('observations', self.get_point(new_image_id, self._start))
         self.md2_task_info = self.goniometer.get_task_info(task_id)
         self.scan_end_time = time.time()
     
     def save_results(self):
-        f = open(os.path.join(self.directory, '%s_tomography.pickle' % self.name_pattern), 'w')
-        pickle.dump({'observations': self.observations, 'background': self.background}, f)
-        f.close()
+        self.tomography_store.close()
         
     def save_parameters(self):
         self.parameters = {}
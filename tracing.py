@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tracing of experiments.
+
+An experiment opens a tracer when it starts executing. Its phases are
+recorded as nested spans (name, start, duration, parent) and every Tango
+or detector HTTP call increments a counter. Each span also carries the
+counters incremented while it was open, so that one can tell where the
+calls, and the seconds, between two sweeps go. The trace of an experiment
+is a jsonl file, one record per line: a header, one record per span in the
+order they end and the counter totals.
+
+Greenlets share a single stack of open spans, a span started in a greenlet
+spawned inside a span is attributed to that span.
+
+The summary tool aggregates traces, e.g. all traces of a shift:
+
+    tracing.py -d /nfs/data/2018_Run3/ -s "2018-06-12 08:00" -e "2018-06-12 16:00"
+'''
+
+import os
+import time
+import json
+import logging
+import functools
+import contextlib
+import numpy as np
+
+class span_record(object):
+    def __init__(self, span_id, name, parent, attributes, counters):
+        self.span_id = span_id
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.counters = counters
+        self.start = time.time()
+
+class null_tracer(object):
+    '''used when no experiment is being traced'''
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def close(self):
+        pass
+
+class tracer(object):
+
+    def __init__(self, filename, **attributes):
+        self.filename = filename
+        self.counters = {}
+        self.stack = []
+        self.span_id = 0
+        self.records = []
+        header = {'type': 'trace', 'start': time.time(), 'pid': os.getpid()}
+        header.update(attributes)
+        self.records.append(header)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_counter_deltas(self, before):
+        deltas = {}
+        for name, value in self.counters.items():
+            delta = value - before.get(name, 0)
+            if delta:
+                deltas[name] = delta
+        return deltas
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        self.span_id += 1
+        parent = self.stack[-1].span_id if self.stack else None
+        record = span_record(self.span_id, name, parent, attributes, dict(self.counters))
+        self.stack.append(record)
+        error = None
+        try:
+            yield record
+        except:
+            error = True
+            raise
+        finally:
+            end = time.time()
+            self.stack.remove(record)
+            span = {'type': 'span', 'name': name, 'id': record.span_id, 'parent': record.parent, 'start': record.start, 'duration': end - record.start}
+            counters = self.get_counter_deltas(record.counters)
+            if counters:
+                span['counters'] = counters
+            if record.attributes:
+                span['attributes'] = record.attributes
+            if error:
+                span['error'] = True
+            self.records.append(span)
+
+    def close(self):
+        self.records.append({'type': 'counters', 'end': time.time(), 'counters': self.counters})
+        try:
+            f = open(self.filename, 'a')
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+            f.close()
+        except IOError:
+            logging.exception('could not write trace %s' % self.filename)
+        self.records = []
+
+current = null_tracer()
+
+def get_tracer():
+    return current
+
+def set_tracer(new):
+    '''makes new the current tracer, returns the previous one'''
+    global current
+    previous = current
+    current = new
+    return previous
+
+def span(name, **attributes):
+    return current.span(name, **attributes)
+
+def count(name, n=1):
+    current.count(name, n)
+
+def traced(method):
+    '''decorator recording every call of method as a span named after it'''
+    @functools.wraps(method)
+    def traced_method(*args, **kwargs):
+        with current.span(method.__name__):
+            return method(*args, **kwargs)
+    return traced_method
+
+tango_instrumented = False
+
+def instrument_tango():
+    '''counts the calls of all PyTango.DeviceProxy instances, attribute access goes through read_attribute and write_attribute'''
+    global tango_instrumented
+    if tango_instrumented:
+        return
+    try:
+        import PyTango
+    except ImportError:
+        return
+    for method_name in ['read_attribute', 'read_attributes', 'write_attribute', 'write_attributes', 'command_inout']:
+        method = getattr(PyTango.DeviceProxy, method_name, None)
+        if method is None:
+            continue
+        def get_counted(method, method_name):
+            def counted(self, *args, **kwargs):
+                current.count('tango.%s' % method_name)
+                return method(self, *args, **kwargs)
+            return counted
+        setattr(PyTango.DeviceProxy, method_name, get_counted(method, method_name))
+    tango_instrumented = True
+
+# summary
+def read_trace(filename):
+    records = []
+    for line in open(filename):
+        line = line.strip()
+        if line:
+            records.append(json.loads(line))
+    return records
+
+def find_traces(directory, start=None, end=None):
+    filenames = []
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            if f.endswith('_trace.jsonl'):
+                filename = os.path.join(root, f)
+                modification = os.path.getmtime(filename)
+                if (start is None or modification >= start) and (end is None or modification <= end):
+                    filenames.append(filename)
+    return sorted(filenames)
+
+def summarize(filenames):
+    '''durations of the spans and counters aggregated by experiment and span name'''
+    durations = {}
+    counters = {}
+    experiments = {}
+    for filename in filenames:
+        try:
+            records = read_trace(filename)
+        except (IOError, ValueError):
+            logging.exception('could not read trace %s' % filename)
+            continue
+        experiment = 'unknown'
+        for record in records:
+            if record['type'] == 'trace':
+                experiment = record.get('experiment', 'unknown')
+                experiments[experiment] = experiments.get(experiment, 0) + 1
+            elif record['type'] == 'span':
+                durations.setdefault((experiment, record['name']), []).append(record['duration'])
+            elif record['type'] == 'counters':
+                for name, value in record['counters'].items():
+                    key = (experiment, name)
+                    counters[key] = counters.get(key, 0) + value
+    spans = {}
+    for key, values in durations.items():
+        values = np.array(values)
+        spans[key] = {'count': len(values), 'total': values.sum(), 'mean': values.mean(), 'median': np.median(values), 'p95': np.percentile(values, 95), 'max': values.max()}
+    return experiments, spans, counters
+
+def print_summary(experiments, spans, counters):
+    for experiment in sorted(experiments):
+        print '%s (%d traces)' % (experiment, experiments[experiment])
+        print '    %-32s %6s %10s %10s %10s %10s %10s' % ('span', 'count', 'total', 'mean', 'median', 'p95', 'max')
+        for key in sorted([key for key in spans if key[0] == experiment], key=lambda key: -spans[key]['total']):
+            s = spans[key]
+            print '    %-32s %6d %10.3f %10.3f %10.3f %10.3f %10.3f' % (key[1], s['count'], s['total'], s['mean'], s['median'], s['p95'], s['max'])
+        for key in sorted([key for key in counters if key[0] == experiment]):
+            print '    %-32s %6d' % (key[1], counters[key])
+
+def main():
+    import optparse
+    import glob
+
+    parser = optparse.OptionParser()
+    parser.add_option('-d', '--directory', default=None, type=str, help='Directory to search for traces recursively')
+    parser.add_option('-t', '--traces', default=None, type=str, help='Glob pattern of trace files')
+    parser.add_option('-s', '--start', default=None, type=str, help='Only traces written after start, format "%Y-%m-%d %H:%M"')
+    parser.add_option('-e', '--end', default=None, type=str, help='Only traces written before end, format "%Y-%m-%d %H:%M"')
+
+    options, args = parser.parse_args()
+
+    start, end = [time.mktime(time.strptime(t, '%Y-%m-%d %H:%M')) if t is not None else None for t in (options.start, options.end)]
+    filenames = list(args)
+    if options.traces is not None:
+        filenames += glob.glob(options.traces)
+    if options.directory is not None:
+        filenames += find_traces(options.directory, start=start, end=end)
+
+    print '%d traces' % len(filenames)
+    print_summary(*summarize(filenames))
+
+if __name__ == '__main__':
+    main()
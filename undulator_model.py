@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Fit of the undulator model to the harmonic peak positions of the gap scans.
+
+The magnetic field of the undulator at gap g is modeled as
+
+    B(g) = k0 * exp(k1 * x + k2 * x**2), x = g / period_length
+
+and the energy of harmonic n as
+
+    E(g, n) = 1000 * 9.5 * n * electron_energy**2 / (period_length * (1 + K**2 / 2)), K = c * period_length * B
+
+The model is evaluated over whole arrays of gaps and harmonics and the
+derivatives of E with respect to (k0, k1, k2) are analytic
+
+    dE/dki = -E * K**2 / (1 + K**2 / 2) * [1/k0, x, x**2]
+
+so that leastsq converges in a few evaluations even for the complete
+tuning table.
+
+The model is also solved the other way round: for a photon energy, the gap
+of every harmonic follows in closed form. undulator_table chooses the
+harmonic with the highest expected flux (interpolated from the measured
+peaks when available, from the angular flux density otherwise) for whole
+arrays of energies. The choice is precomputed on an energy grid and kept
+in a small npz table in data_directory (UNDULATOR_DATA_DIRECTORY in the
+environment, ~/undulator otherwise), written by undulator_peaks_analysis
+after each fit. get_lookup() loads it once and again only when the file
+changes.
+'''
+
+import os
+import pickle
+import logging
+import numpy as np
+from scipy.constants import elementary_charge, electron_mass, speed_of_light, pi
+from scipy.optimize import leastsq, OptimizeResult
+from scipy.special import jv
+
+k_default = (2.73096921, -3.84082989, 0.60382274)
+
+gap_range = (7.801, 30.)
+
+data_directory = os.getenv('UNDULATOR_DATA_DIRECTORY', os.path.join(os.getenv('HOME', '/tmp'), 'undulator'))
+
+def get_table_filename():
+    return os.path.join(data_directory, 'undulator_table.npz')
+
+strength_constant = 1e-3 * elementary_charge / (electron_mass * speed_of_light * 2 * pi)
+
+def get_model_terms(gaps, harmonics, k, period_length=24., electron_energy=2.75):
+    k0, k1, k2 = k
+    x = np.asarray(gaps, dtype=np.float64) / period_length
+    B = k0 * np.exp(k1 * x + k2 * x ** 2)
+    K = strength_constant * period_length * B
+    energies = 1000 * 9.5 * np.asarray(harmonics, dtype=np.float64) * electron_energy ** 2 / (period_length * (1 + K ** 2 / 2))
+    return x, K, energies
+
+def peak_energy(gaps, harmonics, k=k_default, period_length=24., electron_energy=2.75, N=80, detune=False):
+    '''energies [eV] of the harmonics at the gaps [mm]'''
+    x, K, energies = get_model_terms(gaps, harmonics, k, period_length=period_length, electron_energy=electron_energy)
+    if detune:
+        energies *= 1 - 2. / (np.asarray(harmonics, dtype=np.float64) * N)
+    return energies
+
+def peak_energy_jacobian(gaps, harmonics, k=k_default, period_length=24., electron_energy=2.75):
+    '''derivatives of peak_energy with respect to k0, k1 and k2, one row per (gap, harmonic)'''
+    x, K, energies = get_model_terms(gaps, harmonics, k, period_length=period_length, electron_energy=electron_energy)
+    factor = -energies * K ** 2 / (1 + K ** 2 / 2)
+    return np.vstack([factor / k[0], factor * x, factor * x ** 2]).T
+
+def residual(k, gaps, harmonics, energies):
+    return peak_energy(gaps, harmonics, k) - energies
+
+def jacobian(k, gaps, harmonics, energies):
+    return peak_energy_jacobian(gaps, harmonics, k)
+
+def fit(gaps, harmonics, energies, k=k_default):
+    '''least squares fit of k0, k1, k2 to the measured energies of the harmonics at the gaps'''
+    args = tuple(np.asarray(a, dtype=np.float64) for a in (gaps, harmonics, energies))
+    x, cov_x, infodict, message, ier = leastsq(residual, k, args=args, Dfun=jacobian, full_output=True)
+    fun = infodict['fvec']
+    return OptimizeResult(x=x,
+                          fun=fun,
+                          cost=np.sum(fun ** 2) / (2 * len(fun)),
+                          nfev=infodict['nfev'],
+                          success=ier in [1, 2, 3, 4],
+                          message=message)
+
+def fit_peaks(peaks, k=k_default):
+    '''peaks is an array of rows [gap, harmonic, energy, ...]'''
+    peaks = np.asarray(peaks)
+    return fit(peaks[:, 0], peaks[:, 1], peaks[:, 2], k=k)
+
+def load_data_matrix(filename):
+    return np.asarray(pickle.load(open(filename)))
+
+def peak_gap(energies, harmonics, k=k_default, period_length=24., electron_energy=2.75):
+    '''gaps [mm] at which the harmonics peak at the energies [eV], nan where the model has no solution'''
+    k0, k1, k2 = k
+    energies = np.asarray(energies, dtype=np.float64)
+    harmonics = np.asarray(harmonics, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        K = np.sqrt(2 * (1000 * 9.5 * harmonics * electron_energy ** 2 / (period_length * energies) - 1))
+        log_B = np.log(K / (strength_constant * period_length) / k0)
+        # k2 * x**2 + k1 * x - log_B = 0, the field decreases with the gap on the smaller root
+        x = (-k1 - np.sqrt(k1 ** 2 + 4 * k2 * log_B)) / (2 * k2)
+    return x * period_length
+
+def angular_flux_density(K, n, E=2.75, I=0.5, N=80):
+    chi = n / (1. + 0.5 * K ** 2)
+    Y = 0.25 * (K ** 2) * chi
+    return 1.74e14 * (N ** 2) * (E ** 2) * I * (chi ** 2) * (K ** 2) * (jv((n + 1) / 2., Y) - jv((n - 1) / 2., Y)) ** 2
+
+class undulator_table(object):
+    '''best harmonic, its gap and the expected flux for photon energies'''
+    
+    def __init__(self, k=k_default, peaks=None, harmonics=range(1, 21), gap_range=gap_range, energy_range=(4000., 20000.), energy_step=1.):
+        self.k = np.array(k, dtype=np.float64)
+        self.harmonics = np.array(harmonics)
+        self.gap_range = gap_range
+        self.peaks = None if peaks is None else np.asarray(peaks, dtype=np.float64)
+        self.energy_range = energy_range
+        self.energy_step = energy_step
+        self.table = None
+    
+    def get_expected_flux(self, gaps, harmonics):
+        '''flux interpolated from the measured peaks of each harmonic, or the angular flux density of the model without measurements'''
+        if self.peaks is None:
+            x, K, energies = get_model_terms(gaps, harmonics, self.k)
+            return angular_flux_density(K, harmonics)
+        flux = np.zeros(np.broadcast(gaps, harmonics).shape)
+        gaps = np.broadcast_to(gaps, flux.shape)
+        harmonics = np.broadcast_to(harmonics, flux.shape)
+        for n in self.harmonics:
+            selection = self.peaks[self.peaks[:, 1] == n]
+            if len(selection) == 0:
+                continue
+            selection = selection[selection[:, 0].argsort()]
+            this = harmonics == n
+            measured = np.interp(gaps[this], selection[:, 0], selection[:, 3], left=np.nan, right=np.nan)
+            flux[this] = np.where(np.isnan(measured), 0., measured)
+        return flux
+    
+    def solve(self, energies):
+        '''best harmonic, gap and expected flux for every energy, harmonic 0 and nan where no harmonic reaches it'''
+        energies = np.atleast_1d(np.asarray(energies, dtype=np.float64))
+        harmonics = self.harmonics[np.newaxis, :]
+        gaps = peak_gap(energies[:, np.newaxis], harmonics, self.k)
+        reachable = np.logical_and(gaps >= self.gap_range[0], gaps <= self.gap_range[1])
+        flux = np.where(reachable, self.get_expected_flux(np.where(reachable, gaps, self.gap_range[1]), harmonics), -np.inf)
+        best = flux.argmax(axis=1)
+        rows = np.arange(len(energies))
+        found = np.isfinite(flux[rows, best])
+        return (np.where(found, self.harmonics[best], 0), 
+                np.where(found, gaps[rows, best], np.nan), 
+                np.where(found, flux[rows, best], np.nan))
+    
+    def get_energies(self):
+        return np.arange(self.energy_range[0], self.energy_range[1] + self.energy_step, self.energy_step)
+    
+    def build(self):
+        harmonics, gaps, flux = self.solve(self.get_energies())
+        self.table = {'harmonics': harmonics.astype(np.uint8), 'gaps': gaps.astype(np.float32), 'flux': flux.astype(np.float32)}
+        
+    def save(self, filename=None):
+        if filename is None:
+            filename = get_table_filename()
+        if self.table is None:
+            self.build()
+        if not os.path.isdir(os.path.dirname(os.path.abspath(filename))):
+            os.makedirs(os.path.dirname(os.path.abspath(filename)))
+        parameters = {'k': self.k, 'harmonics': self.harmonics, 'gap_range': np.array(self.gap_range), 'energy_range': np.array(self.energy_range), 'energy_step': self.energy_step}
+        if self.peaks is not None:
+            parameters['peaks'] = self.peaks
+        parameters.update([('table_%s' % key, value) for key, value in self.table.items()])
+        # written aside and renamed so that get_lookup never loads a partial table
+        f = open(filename + '.tmp', 'wb')
+        np.savez(f, **parameters)
+        f.close()
+        os.rename(filename + '.tmp', filename)
+    
+    def load(self, filename=None):
+        '''takes the model, the measurements and the table from filename'''
+        if filename is None:
+            filename = get_table_filename()
+        cached = np.load(filename)
+        self.k = cached['k']
+        self.harmonics = cached['harmonics']
+        self.gap_range = tuple(cached['gap_range'])
+        self.energy_range = tuple(cached['energy_range'])
+        self.energy_step = float(cached['energy_step'])
+        self.peaks = cached['peaks'] if 'peaks' in cached.files else None
+        self.table = dict([(key, cached['table_%s' % key]) for key in ['harmonics', 'gaps', 'flux']])
+        cached.close()
+    
+    def lookup(self, energies):
+        '''harmonics, gaps and expected fluxes for the energies [eV], from the table within its range'''
+        if self.table is None:
+            self.build()
+        energies = np.atleast_1d(np.asarray(energies, dtype=np.float64))
+        indices = np.rint((energies - self.energy_range[0]) / self.energy_step).astype(int)
+        inside = np.logical_and(indices >= 0, indices < len(self.table['harmonics']))
+        if not inside.all():
+            return self.solve(energies)
+        harmonics = self.table['harmonics'][indices].astype(int)
+        # the harmonic comes from the nearest grid point, its gap is exact
+        gaps = np.where(harmonics > 0, peak_gap(energies, np.maximum(harmonics, 1), self.k), np.nan)
+        return harmonics, gaps, self.table['flux'][indices].astype(np.float64)
+    
+    def get_setting(self, energy):
+        '''harmonic, gap and expected flux for a single energy [eV]'''
+        harmonics, gaps, flux = self.lookup([energy])
+        return int(harmonics[0]), float(gaps[0]), float(flux[0])
+
+lookup = None
+lookup_source = None
+
+def get_lookup(filename=None):
+    '''undulator_table of the process, loaded from filename and reloaded when the file changes, 
+    built from the default model (and not saved) when there is no file'''
+    global lookup, lookup_source
+    if filename is None:
+        filename = get_table_filename()
+    if os.path.isfile(filename):
+        source = (filename, os.path.getmtime(filename))
+    else:
+        source = (filename, None)
+    if lookup is None or source != lookup_source:
+        table = undulator_table()
+        if source[1] is not None:
+            table.load(filename)
+        else:
+            logging.info('no undulator table %s, using the default model' % filename)
+            table.build()
+        lookup = table
+        lookup_source = source
+    return lookup
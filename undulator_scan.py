@@ -21,9 +21,12 @@ import pylab
 from xray_experiment import xray_experiment
 from scipy.constants import eV, h, c, angstrom, kilo, degree
 from monitor import Si_PIN_diode
+from analysis import undulator_scan_online_analysis
 
 class undulator_scan(xray_experiment):
     
+    online_analysis_sleep_time = 1.
+    
     def __init__(self,
                  name_pattern,
                  directory,
@@ -40,7 +43,8 @@ class undulator_scan(xray_experiment):
                  conclusion=None,
                  simulation=None,
                  display=False,
-                 extract=False):
+                 extract=False,
+                 online_analysis=False):
                  
         xray_experiment.__init__(self, 
                                  name_pattern, 
@@ -65,6 +69,7 @@ class undulator_scan(xray_experiment):
         self.diagnostic = diagnostic
         self.display = display
         self.extract = extract
+        self.online_analysis = online_analysis
         
         self.calibrated_diode = Si_PIN_diode()
         
@@ -139,6 +144,9 @@ class undulator_scan(xray_experiment):
         self.actuator.set_speed(self.scan_speed)
         
     def run(self):
+        self.scanning = True
+        if self.online_analysis and self.diagnostic:
+            analyzer = gevent.spawn(self.analyze_online)
         # sleep for darkcurrent_time while observation is already running
         gevent.sleep(self.darkcurrent_time)
         self.fast_shutter.open()
@@ -146,6 +154,37 @@ class undulator_scan(xray_experiment):
         move.join()
         self.fast_shutter.close()
         gevent.sleep(self.darkcurrent_time)
+        self.scanning = False
+        if self.online_analysis and self.diagnostic:
+            analyzer.join()
+    
+    def feed_online_analysis(self, analyzed):
+        for monitor_name, monitor in self.get_recorded_monitors():
+            try:
+                observations = monitor.get_observations()
+            except AttributeError:
+                continue
+            n = len(observations)
+            if n > analyzed.get(monitor_name, 0):
+                self.online_analysis_results.add_observations(monitor_name, observations[analyzed.get(monitor_name, 0):n])
+                analyzed[monitor_name] = n
+    
+    def analyze_online(self):
+        '''feeds the observations to the online analysis as they arrive, publishes the harmonic peaks at the end of the scan'''
+        self.online_analysis_results = undulator_scan_online_analysis(self.get_parameters_filename(), self.undulator.get_encoder_position())
+        analyzed = {}
+        while self.scanning:
+            gevent.sleep(self.online_analysis_sleep_time)
+            try:
+                self.feed_online_analysis(analyzed)
+                self.online_analysis_results.update()
+            except:
+                logging.error('online analysis failed %s' % traceback.format_exc())
+        try:
+            self.feed_online_analysis(analyzed)
+            self.online_analysis_results.finish()
+        except:
+            logging.error('online analysis failed %s' % traceback.format_exc())
         
     def clean(self):
         self.save_parameters()
@@ -157,6 +196,9 @@ class undulator_scan(xray_experiment):
             
     def save_results(self):
         self.results = self.get_results()
+        if os.path.isfile(self.get_observations_filename()):
+            # recorded in the observation store during the scan
+            return
         
         f = open(os.path.join(self.directory, '%s_results.pickle' % self.name_pattern), 'w')
         pickle.dump(self.results, f)
@@ -234,6 +276,7 @@ def main():
     parser.add_option('-o', '--optimize', action='store_true', help='Check current monochromator position and shuffle start, end to speed up the startup')
     parser.add_option('-D', '--display', action='store_true', help='display plot')
     parser.add_option('-E', '--extract', action='store_true', help='Extract the calibrated diode after the scan')
+    parser.add_option('-O', '--online_analysis', action='store_true', help='Analyze the scan while it runs and publish the harmonic peaks to the peaks index of the directory')
             
     options, args = parser.parse_args()
     
@@ -248,7 +291,8 @@ def main():
                         scan_speed=options.scan_speed,
                         optimize=options.optimize,
                         display=options.display,
-                        extract=options.extract)
+                        extract=options.extract,
+                        online_analysis=options.online_analysis)
   
     us.execute()
     
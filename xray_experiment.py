@@ -10,6 +10,8 @@ import traceback
 import logging
 
 from experiment import experiment
+from observation_store import observation_store
+from tracing import traced
 from detector import detector as detector
 from goniometer import goniometer
 from energy import energy as energy_motor
@@ -31,6 +33,10 @@ from slits import slits1, slits2, slits3, slits5, slits6, slits_mockup
 
 class xray_experiment(experiment):
     
+    slits = [1, 2, 3, 5, 6]
+    
+    record_sleep_time = 1.
+    
     specific_parameter_fields = [{'name': 'photon_energy', 'type': 'float', 'description': 'photon energy of the experiment in eV'},
                                  {'name': 'wavelength', 'type': 'float', 'description': 'experiment photon wavelength in A'},
                                  {'name': 'transmission_intention', 'type': 'float', 'description': 'intended photon beam transmission in %'},
@@ -269,12 +275,17 @@ class xray_experiment(experiment):
         return self.undulator.get_encoder_position()
         
 
+    def get_slits_configuration(self, k):
+        slits_configuration = {}
+        for direction in ['vertical', 'horizontal']:
+            for attribute in ['gap', 'position']:
+                slits_configuration['slits%d_%s_%s' % (k, direction, attribute)] = getattr(getattr(self, 'slits%d' % k), 'get_%s_%s' % (direction, attribute))()
+        return slits_configuration
+    
     def get_slit_configuration(self):
         slit_configuration = {}
-        for k in [1, 2, 3, 5, 6]:
-            for direction in ['vertical', 'horizontal']:
-                for attribute in ['gap', 'position']:
-                    slit_configuration['slits%d_%s_%s' % (k, direction, attribute)] = getattr(getattr(self, 'slits%d' % k), 'get_%s_%s' % (direction, attribute))()
+        for k in self.slits:
+            slit_configuration.update(self.get_slits_configuration(k))
         return slit_configuration
     
 
@@ -401,6 +412,9 @@ class xray_experiment(experiment):
         for monitor in self.monitors:
             monitor.observe = True
             self.observers.append(gevent.spawn(monitor.monitor, self.start_time))
+        self.observation_store = observation_store(self.get_observations_filename(), mode='a')
+        self.recorded = {}
+        self.recorder = gevent.spawn(self.record)
         
     
     def stop_monitor(self):
@@ -410,7 +424,40 @@ class xray_experiment(experiment):
             self.actuator.observe = False
         for monitor in self.monitors:
             monitor.observe = False
-        gevent.joinall(self.observers)
+        gevent.joinall(self.observers + [self.recorder])
+        self.record_observations()
+        self.observation_store.close()
+    
+    
+    def get_recorded_monitors(self):
+        recorded_monitors = zip(self.monitor_names, self.monitors)
+        if hasattr(self, 'actuator'):
+            recorded_monitors.append(('actuator', self.actuator))
+        return recorded_monitors
+    
+    
+    def record_observations(self):
+        '''appends the observations made since the last call to the observation store'''
+        for monitor_name, monitor in self.get_recorded_monitors():
+            try:
+                observations = monitor.get_observations()
+                observation_fields = monitor.get_observation_fields()
+            except AttributeError:
+                continue
+            recorded = self.recorded.get(monitor_name, 0)
+            if len(observations) > recorded:
+                self.observation_store.append(monitor_name, observation_fields, observations[recorded:len(observations)])
+                self.recorded[monitor_name] = len(observations)
+        self.observation_store.flush()
+    
+    
+    def record(self):
+        while self.observe == True:
+            gevent.sleep(self.record_sleep_time)
+            try:
+                self.record_observations()
+            except:
+                logging.error('record_observations failed %s' % traceback.format_exc())
     
     
     def get_observations(self):
@@ -483,12 +530,14 @@ class xray_experiment(experiment):
     def get_flux_intention(self):
         return self.flux
     
+    @traced
     def program_detector(self):
         _start = time.time()
         pass
         #print 'program_detector took %s' % (time.time()-_start)
     
 
+    @traced
     def program_goniometer(self):
         self.goniometer.set_scan_number_of_frames(1)
         self.goniometer.set_detector_gate_pulse_enabled(True)
@@ -527,6 +576,7 @@ class xray_experiment(experiment):
         return self.observations
 
     
+    @traced
     def save_diagnostic(self):
         _start = time.time()
         f = open(os.path.join(self.directory, '%s_diagnostics.pickle' % self.name_pattern), 'w')